@@ -0,0 +1,92 @@
+#モジュールごとの読み込み(import)にかかる時間を測るスクリプト
+#コールドスタートで何に時間がかかっているかを確認するために使う
+#
+#  python benchmarks/import_time.py            # 依存ライブラリとshared_code、各関数のモジュール
+#  python benchmarks/import_time.py requests   # 指定したモジュールだけ
+#
+#モジュールごとに新しいpythonプロセスを起動し、`python -X importtime`の出力から
+#そのモジュールの読み込みにかかった累積時間(そのモジュールが読み込んだモジュールを含む)を取り出す
+#関数のフォルダは、読み込んだ時点で重い依存ライブラリ(HEAVY)まで読み込まれていないかも表示する
+#(モジュールごとの時間だけでは、関数の読み込みでどのモジュールが連鎖して読み込まれたかが見えないため)
+import os
+import re
+import sys
+import glob
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEPENDENCIES = [
+    "azure.functions",
+    "cryptography.hazmat.primitives.asymmetric.ed25519",
+    "cryptography.fernet",
+    "azure.cosmosdb.table",
+    "requests",
+]
+
+#コールドスタートでは最初に必要になるまで読み込まないはずの依存ライブラリ
+HEAVY = ["azure.cosmosdb.table", "requests", "aiohttp", "cryptography.fernet"]
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+#shared_codeのモジュールと、関数のフォルダ(__init__.py)の一覧
+def default_targets():
+    targets = list(DEPENDENCIES)
+    for path in sorted(glob.glob(os.path.join(ROOT, "shared_code", "*.py"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name != "__init__":
+            targets.append("shared_code."+name)
+    for path in sorted(glob.glob(os.path.join(ROOT, "*", "function.json"))):
+        targets.append(os.path.basename(os.path.dirname(path)))
+    return targets
+
+#1つのモジュールを新しいプロセスで読み込み、(累積時間[ms], 読み込まれたモジュール数, 読み込まれたHEAVYのモジュール)を返す
+def measure(target):
+    if os.path.isfile(os.path.join(ROOT, target, "__init__.py")):
+        #関数のフォルダ名は"-"を含むのでimport文では読めない ファイルの場所から読み込む
+        code = (
+            "import importlib.util;"
+            f"spec = importlib.util.spec_from_file_location('function_app', {os.path.join(ROOT, target, '__init__.py')!r});"
+            "module = importlib.util.module_from_spec(spec);"
+            "spec.loader.exec_module(module)"
+        )
+    else:
+        code = "import "+target
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1], []
+    total_us = 0
+    count = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        count += 1
+        loaded.add(match.group(4))
+        #インデントがない行が、-cのコードから直接読み込まれたモジュール
+        if match.group(3) == " ":
+            total_us += int(match.group(2))
+    return total_us / 1000, count, [name for name in HEAVY if name in loaded]
+
+def main():
+    parser = argparse.ArgumentParser(description="モジュールごとのimport時間を測る")
+    parser.add_argument("targets", nargs="*", help="測るモジュール(省略時は依存ライブラリとこのリポジトリのモジュール)")
+    parser.add_argument("--repeat", type=int, default=3, help="測る回数(最小値を表示する)")
+    args = parser.parse_args()
+    targets = args.targets or default_targets()
+    print(f"{'module':<55} {'ms':>9} {'modules':>8}  heavy")
+    for target in targets:
+        results = [measure(target) for _ in range(args.repeat)]
+        if results[0][0] is None:
+            print(f"{target:<55} {'error':>9}  {results[0][1]}")
+            continue
+        best = min(results, key=lambda r: r[0])
+        print(f"{target:<55} {best[0]:>9.1f} {best[1]:>8}  {','.join(best[2]) if target not in DEPENDENCIES else ''}")
+
+if __name__ == "__main__":
+    main()
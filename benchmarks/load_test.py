@@ -0,0 +1,229 @@
+#署名つきのdiscord interactionを各関数のmainに直接流し込み、コマンドごとのレイテンシとスループットを測るスクリプト
+#
+#  azurite --silent &                          # Table Storage(とキュー)のローカル代替
+#  python benchmarks/load_test.py --requests 200 --concurrency 16
+#  python benchmarks/load_test.py --commands act end --mode sync --notion-latency 0.2
+#  python benchmarks/load_test.py --execution async --concurrency 64   # main_async(aiohttp)で同じ負荷を流す
+#
+#  - テスト用のEd25519の鍵ペアを作り、DISCORD_PUBLIC_KEYにその公開鍵を設定して署名する
+#  - notion APIとdiscord APIはプロセス内のスタブサーバー(benchmarks/stubs.py)に向ける
+#  - Table StorageはAzurite(STORAGE_CONNECTION_STRING=UseDevelopmentStorage=true)を使う
+#  - deferredで返したinteractionのキューのメッセージは、--run-workerでdiscord-notion-workerのmainにも流す
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = ["ping", "settoken", "notion-register", "act", "end", "report"]
+APPLICATION_ID = "900000000000000000"
+
+#関数のフォルダ名は"-"を含むのでimport文では読めない ファイルの場所から読み込む
+def load_function(name):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(ROOT, name, "__init__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#func.Out[str]の代わり
+class Out:
+    def __init__(self):
+        self.value = None
+
+    def set(self,value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+_snowflake = [int(time.time() * 1000) << 22]
+
+def next_id():
+    _snowflake[0] += 1
+    return str(_snowflake[0])
+
+def member(user_id):
+    return {"user": {"id": user_id, "username": "bench-"+user_id[-4:]}}
+
+#コマンドごとのinteractionを作る
+def build_interaction(command,user_id):
+    interaction = {"id": next_id(), "token": "bench-token-"+next_id(), "application_id": APPLICATION_ID, "version": 1}
+    if command == "ping":
+        interaction["type"] = 1
+        return interaction
+    interaction["member"] = member(user_id)
+    if command == "end":
+        interaction["type"] = 3
+        interaction["data"] = {"custom_id": "end", "component_type": 2}
+        interaction["message"] = {"id": next_id(), "interaction_metadata": {"id": next_id(), "type": 2}}
+        return interaction
+    interaction["type"] = 2
+    interaction["data"] = {"name": command}
+    if command == "settoken":
+        interaction["data"]["options"] = [{"name": "token", "type": 3, "value": "bench-secret"}]
+    elif command == "act":
+        interaction["data"]["options"] = [{"name": "name", "type": 3, "value": random.choice(["読書", "作業", "運動", "bench"])}]
+    elif command == "report":
+        interaction["data"]["options"] = [{"name": "range", "type": 3, "value": random.choice(["today", "week", "month"])}]
+    return interaction
+
+#nearest-rank法のパーセンタイル
+def percentile(values,p):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="署名つきinteractionを流し込む負荷試験")
+    parser.add_argument("--commands", nargs="+", default=COMMANDS, choices=COMMANDS)
+    parser.add_argument("--requests", type=int, default=100, help="コマンドごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20, help="リクエストを分散させるユーザー数")
+    parser.add_argument("--mode", choices=["deferred", "sync"], default="deferred", help="ACT_RESPONSE_MODE")
+    parser.add_argument("--notion-latency", type=float, default=0.05, help="スタブのnotion APIの応答時間(秒)")
+    parser.add_argument("--discord-latency", type=float, default=0.02, help="スタブのdiscord APIの応答時間(秒)")
+    parser.add_argument("--run-worker", action="store_true", help="キューのメッセージをdiscord-notion-workerでも処理する")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前に流すコマンドごとのリクエスト数")
+    parser.add_argument("--execution", choices=["sync", "async"], default="sync", help="EXECUTION_MODE")
+    args = parser.parse_args()
+
+    import stubs
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.fernet import Fernet
+
+    server, base_url = stubs.start(args.notion_latency, args.discord_latency)
+    private_key = Ed25519PrivateKey.generate()
+    public_key = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    #shared_codeのモジュールは読み込み時に環境変数を読むので、読み込む前に設定する
+    os.environ["DISCORD_PUBLIC_KEY"] = public_key.hex()
+    os.environ.setdefault("DISCORD_USER_ID_ENCRYPT_KEY", Fernet.generate_key().decode("utf-8"))
+    os.environ.setdefault("STORAGE_CONNECTION_STRING", "UseDevelopmentStorage=true")
+    os.environ["NOTION_API_BASE"] = base_url + stubs.NOTION_PREFIX
+    os.environ["DISCORD_API_BASE"] = base_url + stubs.DISCORD_PREFIX
+    os.environ["ACT_RESPONSE_MODE"] = args.mode
+    os.environ["EXECUTION_MODE"] = args.execution
+    #スタブ相手ならレート制限で待たせる必要はない
+    os.environ.setdefault("NOTION_RATE_PER_SECOND", "100000")
+    os.environ.setdefault("NOTION_RATE_BURST", "100000")
+
+    import azure.functions as func
+    from azure.cosmosdb.table.models import Entity
+    from shared_code import storage
+    register = load_function("discord-notion-register")
+    worker = load_function("discord-notion-worker") if args.run_worker else None
+
+    #ベンチマーク用のユーザーをAzuriteに登録しておく
+    user_ids = [str(800000000000000000 + i) for i in range(args.users)]
+    table_service = storage.get_table_service()
+    for user_id in user_ids:
+        entity = Entity()
+        entity.PartitionKey = storage.partition_key(user_id)
+        entity.RowKey = user_id
+        entity.notion_access_token = "bench-notion-token"
+        entity.action_page_id = "action-db"
+        entity.category_page_id = "category-db"
+        entity.task_page_id = "task-db"
+        table_service.insert_or_replace_entity(storage.TABLE_NAME, entity)
+    #settokenはユーザーの行を置き換えて連携(notion_access_tokenなど)を消すので、act/endとは別のユーザーで流す
+    settoken_user_ids = [str(810000000000000000 + i) for i in range(args.users)]
+
+    def build_request(command):
+        user_id = random.choice(settoken_user_ids if command == "settoken" else user_ids)
+        body = json.dumps(build_interaction(command, user_id), ensure_ascii=False).encode("utf-8")
+        timestamp = str(int(time.time()))
+        signature = private_key.sign(timestamp.encode("utf-8") + body).hex()
+        return func.HttpRequest(
+            method="POST",
+            url="http://localhost/api/discord-notion-register",
+            headers={"x-signature-ed25519": signature, "x-signature-timestamp": timestamp, "content-type": "application/json"},
+            params={},
+            body=body
+        )
+
+    def call(command):
+        req = build_request(command)
+        out = Out()
+        started = time.perf_counter()
+        response = register.main(req, out)
+        elapsed = time.perf_counter() - started
+        worker_elapsed = None
+        if worker and out.get():
+            started = time.perf_counter()
+            worker.main(func.QueueMessage(id=next_id(), body=out.get().encode("utf-8")))
+            worker_elapsed = time.perf_counter() - started
+        return response.status_code, elapsed, worker_elapsed
+
+    #main_asyncは1つのイベントループで同時にconcurrency個まで待たせる
+    async def call_async(command,semaphore):
+        async with semaphore:
+            req = build_request(command)
+            out = Out()
+            started = time.perf_counter()
+            response = await register.main(req, out)
+            elapsed = time.perf_counter() - started
+            worker_elapsed = None
+            if worker and out.get():
+                started = time.perf_counter()
+                await worker.main(func.QueueMessage(id=next_id(), body=out.get().encode("utf-8")))
+                worker_elapsed = time.perf_counter() - started
+            return response.status_code, elapsed, worker_elapsed
+
+    #actがnotionまで届いたか(連携していないユーザーとして返信だけしていないか)を、スタブの呼び出し回数で確かめる
+    #deferredでworkerを動かさないときは、notionを呼ぶのはworkerなので確かめない
+    failures = []
+    def check(command,before):
+        if command != "act" or (args.mode == "deferred" and not worker):
+            return
+        created = server.calls.get("POST notion/pages", 0) - before.get("POST notion/pages", 0)
+        if created < args.requests:
+            failures.append(f"act reached notion {created} times for {args.requests} requests")
+
+    def report(command,results,wall):
+        latencies = [r[1] * 1000 for r in results]
+        ok = sum(1 for r in results if r[0] == 200)
+        print(f"{command:<20} {ok:>5} {len(results) - ok:>5} {percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} {percentile(latencies, 99):>9.1f} {len(results) / wall:>9.1f}")
+        worker_latencies = [r[2] * 1000 for r in results if r[2] is not None]
+        if worker_latencies:
+            print(f"{'  worker:'+command:<20} {len(worker_latencies):>5} {'':>5} {percentile(worker_latencies, 50):>9.1f} {percentile(worker_latencies, 95):>9.1f} {percentile(worker_latencies, 99):>9.1f}")
+
+    async def run_async():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        for command in args.commands:
+            await asyncio.gather(*[call_async(command, semaphore) for _ in range(args.warmup)])
+            before = dict(server.calls)
+            started = time.perf_counter()
+            results = await asyncio.gather(*[call_async(command, semaphore) for _ in range(args.requests)])
+            report(command, results, time.perf_counter() - started)
+            check(command, before)
+
+    print(f"mode={args.mode} execution={args.execution} concurrency={args.concurrency} requests={args.requests} notion_latency={args.notion_latency}s")
+    print(f"{'command':<20} {'ok':>5} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+    if asyncio.iscoroutinefunction(register.main):
+        asyncio.run(run_async())
+    else:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for command in args.commands:
+                list(executor.map(call, [command] * args.warmup))
+                before = dict(server.calls)
+                started = time.perf_counter()
+                results = list(executor.map(call, [command] * args.requests))
+                report(command, results, time.perf_counter() - started)
+                check(command, before)
+    print("stub calls : "+json.dumps(server.calls))
+    server.shutdown()
+    for failure in failures:
+        print("FAILED : "+failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
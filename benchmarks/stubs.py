@@ -0,0 +1,81 @@
+#負荷試験用の、notion APIとdiscord APIのスタブサーバー
+#1つのHTTPサーバーで /notion/v1/... と /discord/api/v10/... の両方に答える
+#NOTION_API_BASEとDISCORD_API_BASEをこのサーバーに向けて使う
+import json
+import time
+import uuid
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+NOTION_PREFIX = "/notion/v1"
+DISCORD_PREFIX = "/discord/api/v10"
+
+_EMPTY_LIST = {"object": "list", "results": [], "has_more": False, "next_cursor": None}
+
+class StubHandler(BaseHTTPRequestHandler):
+    #keep-aliveで接続を使い回せるようにする
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self,status,payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        path = self.path.split("?", 1)[0]
+        server = self.server
+        #"POST notion/pages"のように、APIと最初のパスごとに数える
+        for name, prefix in (("notion", NOTION_PREFIX), ("discord", DISCORD_PREFIX)):
+            if path.startswith(prefix):
+                key = self.command+" "+name+"/"+path[len(prefix):].split("/")[1]
+                break
+        else:
+            key = self.command+" "+path
+        with server.lock:
+            server.calls[key] = server.calls.get(key, 0) + 1
+        if path.startswith(NOTION_PREFIX):
+            time.sleep(server.notion_latency)
+            self._reply(200, self._notion(path[len(NOTION_PREFIX):]))
+        elif path.startswith(DISCORD_PREFIX):
+            time.sleep(server.discord_latency)
+            self._reply(200, self._discord(path[len(DISCORD_PREFIX):]))
+        else:
+            self._reply(404, {"message": "not found"})
+
+    def _notion(self,path):
+        if self.command == "POST" and path == "/pages":
+            return {"object": "page", "id": str(uuid.uuid4())}
+        if self.command == "PATCH" and path.startswith("/pages/"):
+            return {"object": "page", "id": path.split("/")[2]}
+        return _EMPTY_LIST
+
+    def _discord(self,path):
+        if path == "/users/@me/channels":
+            return {"id": "100000000000000000"}
+        return {}
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PATCH = _handle
+    do_HEAD = _handle
+
+#スタブサーバーを別スレッドで起動し、(server, base_url)を返す
+def start(notion_latency=0.0,discord_latency=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.notion_latency = notion_latency
+    server.discord_latency = discord_latency
+    server.calls = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
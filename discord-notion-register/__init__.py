@@ -1,459 +1,427 @@
 import logging
-import os
 import azure.functions as func
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
-from cryptography.exceptions import InvalidSignature
-from cryptography.fernet import Fernet
 import json
-from azure.cosmosdb.table.tableservice import TableService
-from azure.cosmosdb.table.models import Entity
 import datetime
-import requests
+import time
+import asyncio
 import urllib.parse
+from shared_code import verifier
+from shared_code import timing
+from shared_code import log
+from shared_code import templates
+from shared_code import commands
+from shared_code.router import Router, SYNC, DEFERRED, json_response
+from shared_code.forms import parse_action_form, to_ISO8601
+from shared_code.aio import EXECUTION_MODE
+from shared_code import settings
+#Table Storage(azure.cosmosdb.table)やnotionへのHTTP(requests)、Fernetを使う処理は、
+#その分岐を初めて通るときに読み込む(discordのエンドポイント確認で来るpingでは読み込まない)
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
-        
-    #証明書を検証し、discordからのリクエストであることを確認する
-    #discordからのリクエストでない場合は、401を返す
-    #headerからx-signature-ed25519とx-signature-timestampを取得する
-    signature = req.headers.get('x-signature-ed25519')
-    timestamp = req.headers.get('x-signature-timestamp')
-    raw_body = req.get_body().decode('utf-8')
-    logging.info('signature : '+signature)
-    logging.info('timestamp : '+timestamp)
-    if not verify(signature, timestamp, raw_body):
-        response = func.HttpResponse("Unauthorized", status_code=401)
-        return response
-    logging.info('signature verified')
-    interaction = json.loads(raw_body)
-    logging.info('interaction : '+str(interaction))
-    #返信用のURLを作成
-    url = "https://discord.com/api/v10/interactions/"+interaction["id"]+"/"+interaction["token"]+"/callback"
-    #interactionのtypeが2の場合は、slash commandのリクエストである
-    if interaction and interaction['type'] == 2: #2: slash command
-        embed = None
-        component = None
-        logging.info('slash command')
-        #ここまで
-        command = interaction["data"]["name"]
-        if command == "settoken":
-            user_id = interaction["member"]["user"]["id"]
-            token = interaction["data"]["options"][0]["value"]
-            username = interaction["member"]["user"]["username"]
-            if settoken(username,user_id,token):
-                content_text = f"{username}のtokenを登録しました。"
-            else:
-                content_text = f"{username}のtokenの登録に失敗しました。"
-        elif command == "notion-register":
-            #notion-registerはnotionとの連携用のリンクを生成する
-            user_id = interaction["member"]["user"]["id"]
-            url = notion_auth_url(user_id)
-            content_text = f"notionとの連携用のリンクを生成しました。以下のリンクボタンからnotionと連携してください。n\n**このリンクはあなたのアカウントに紐づいています。他の人に決して教えないでください！**"
-            component = {
-                "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
-                "components": [
-                    {
-                        #notionとの連携用のリンクボタン
-                        "type": 2, #2: button https://discord.com/developers/docs/interactions/message-components#buttons
-                        "style": 5, #5: link
-                        "label": "notionと連携する",
-                        "url": url
-                    }
-                ]
-            }
-        elif command == "act":
-            #actはnotionのデータベースにアクションを登録する
-            #まず、tokenを取得する
-            user_id = interaction["member"]["user"]["id"]
-            token = gettoken(user_id)
-            #tokenが登録されていない場合は、tokenを登録するようにメッセージを返す
-            if token == None:
-                content_text = f"{username}はnotionと連携していません。notionと連携するには、/notion-registerコマンドを実行してください。"
-            else:
-                #tokenが登録されている場合は、notionにアクションを登録する
-                #アクション名がある場合は、アクション名を取得する
-                action_name = ""
-                #optionプロパティがある場合は、アクション名を取得する
-                if "options" in interaction["data"]:
-                    action_name = interaction["data"]["options"][0]["value"]
-                #現在時刻を取得
-                start_time = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-                action_active = True
-                #notionにアクションを登録する
-                #notionのデータベースのIDを取得する
-                database_id = get_database_id(user_id)
-                register_result = notion_register_action(token,database_id["action_page_id"],action_name,start_time,interaction["id"])
-                logging.info('register_result : '+register_result.text)
-                #返信用のコンポーネントを作成
-                #終了ボタンを作成
-                component = {
-                    "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
-                    "components": [
-                        {
-                            #終了ボタン
-                            "type": 2, #2: button https://discord.com/developers/docs/interactions/message-components#buttons
-                            "style": 2, #2: danger
-                            "label": "アクションを終了",
-                            "custom_id": "end"
-                        }
-                    ]
-                }
-                embed = {
-                    "title": "新しいアクション",
-                    "description": "",
-                    "color": 0x0060ff,
-                    "fields": [
-                        {
-                            "name": "アクションの名前",
-                            "value": (action_name if action_name != "" else "(未登録)"),
-                            "inline": False
-                        },
-                        {
-                            "name": "開始時刻",
-                            "value": start_time,
-                            "inline": False
-                        }
-                    ]
-                }
-                content_text = f"新しいアクションを開始しました。"
+#/actの返し方 "deferred"ならtype 5を即座に返してnotionへの登録はキューで行う、"sync"なら登録が終わってから返す
+ACT_RESPONSE_MODE = settings.ACT_RESPONSE_MODE
+#discordはinteractionに3秒以内の返信を求めるので、リクエストを受けた時点からこの秒数を締め切りとし、
+#notionへのリクエスト(待ち・再送・タイムアウト)はすべてこの締め切りまでに収める
+INTERACTION_DEADLINE = settings.INTERACTION_DEADLINE
 
-        body_data = {
-            "type": 4,
-            "data": {
-                "content": content_text
-            }
+#固定の文言のレスポンスは読み込み時にシリアライズしておく
+BAD_TIME_RESPONSE = templates.response(4, templates.EPHEMERAL_MESSAGE.render(content="時刻の書式が正しくありません。(書式 : yyyy/mm/dd hh:mm:ss)"))
+#notionが遅い・落ちているときは、書き込みをキューに回してその旨を返す(workerがあとでこのメッセージを書き換える)
+ACT_QUEUED_MESSAGE = templates.message("notionの応答が遅いため、アクションの登録をあとで行います。登録が終わるとこのメッセージが更新されます。")
+FINISH_QUEUED_MESSAGE = templates.message("notionの応答が遅いため、アクションの終了をあとで行います。終わるとこのメッセージが更新されます。")
+#notionとの連携用のリンクボタンのメッセージ
+NOTION_REGISTER_MESSAGE = templates.Template({
+    "content": "notionとの連携用のリンクを生成しました。以下のリンクボタンからnotionと連携してください。n\n**このリンクはあなたのアカウントに紐づいています。他の人に決して教えないでください！**",
+    "components": [
+        {
+            "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
+            "components": [
+                {
+                    #notionとの連携用のリンクボタン
+                    "type": 2, #2: button https://discord.com/developers/docs/interactions/message-components#buttons
+                    "style": 5, #5: link
+                    "label": "notionと連携する",
+                    "url": templates.slot("url")
+                }
+            ]
         }
+    ]
+})
 
-        if embed:
-            body_data["data"]["embeds"] = [embed]
+#interactionの振り分け先 ハンドラーはこのファイルの下の方で登録する
+router = Router(default_mode=DEFERRED if ACT_RESPONSE_MODE == "deferred" else SYNC)
 
-        if component:
-            body_data["data"]["components"] = [component]
-      
-        response = func.HttpResponse(
-            status_code=200,
-            mimetype="application/json",
-            body = json.dumps(body_data) 
-            )
+@timing.measured("discord-notion-register")
+def main_sync(req: func.HttpRequest, msg: func.Out[str]) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+    deadline = time.monotonic() + INTERACTION_DEADLINE
+    interaction, error = verifier.read_interaction(req)
+    if error:
+        return error
+    #pingとautocomplete以外は、再送されたinteractionを二重に処理しない
+    guarded = interaction['type'] in (2, 3, 5)
+    if guarded:
+        from shared_code import idempotency
+        claimed, cached_body = idempotency.claim(interaction["id"])
+        if not claimed:
+            return duplicate_response(interaction, cached_body)
+    try:
+        body = router.dispatch(interaction, msg, deadline)
+    except Exception:
+        #処理中の印を残すと、再送がすべてdeferredの返信だけで終わってしまうので消す
+        if guarded:
+            idempotency.release(interaction["id"])
+        raise
+    if body is None:
+        if guarded:
+            idempotency.release(interaction["id"])
+        return func.HttpResponse("Unknown interaction", status_code=400)
+    if guarded:
+        idempotency.remember_response(interaction["id"], body.decode('utf-8'))
+    return json_response(body)
 
+#mainの非同期版
+#再送の確認(idempotency)と、ハンドラーが使うプロフィールの読み出しは、どちらもTable Storageへの独立した呼び出しなので同時に待つ
+@timing.measured("discord-notion-register")
+async def main_async(req: func.HttpRequest, msg: func.Out[str]) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+    deadline = time.monotonic() + INTERACTION_DEADLINE
+    interaction, error = verifier.read_interaction(req)
+    if error:
+        return error
+    route, ctx = router.prepare(interaction, msg, deadline)
+    if route is None:
+        return func.HttpResponse("Unknown interaction", status_code=400)
+    guarded = interaction['type'] in (2, 3, 5)
+    from shared_code import aio
+    pending = []
+    if guarded:
+        from shared_code import idempotency
+        pending.append(aio.to_thread(idempotency.claim, interaction["id"]))
+    if route.fields:
+        pending.append(aio.to_thread(router.prefetch, route, ctx))
+    try:
+        if pending:
+            results = await asyncio.gather(*pending)
+            if guarded:
+                claimed, cached_body = results[0]
+                if not claimed:
+                    #この処理では受け取っていないので、印は消さない
+                    guarded = False
+                    return duplicate_response(interaction, cached_body)
+        body = await router.call_async(route, ctx)
+    except BaseException:
+        #失敗・キャンセルされたときは処理中の印を消し、再送をもう一度処理できるようにする
+        if guarded:
+            await aio.to_thread(idempotency.release, interaction["id"])
+        raise
+    if guarded:
+        idempotency.remember_response(interaction["id"], body.decode('utf-8'))
+    return json_response(body)
 
-        logging.info('response : '+content_text)
-        return response
-    
-    #コンポーネントのアクションの場合
-    elif interaction and interaction['type'] == 3: #3: component
-        logging.info('component')
-        #notionのtokenを取得
-        user_id = interaction["member"]["user"]["id"]
-        token = gettoken(user_id)
-        #コンポーネントのcustom_idを取得
-        custom_id = interaction["data"]["custom_id"]
-        #custom_idがend（終了ボタン）の場合
-        if custom_id == "end":
-            #アクションを終了する
-            #notionへ登録する情報を入れる入力フォームを作成
-            #暫定として入力済みのアクション名と開始時刻をnotionから取得する
+#EXECUTION_MODE(sync/async)で、Azure Functionsから呼ばれるmainを切り替える
+main = main_async if EXECUTION_MODE == "async" else main_sync
 
-            #notionから読みだす（あとでかく）
-            action_name = "name_test"
-            start_time = "time_test"
-            end_time = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-            body = json.dumps(create_action_form(action_name=action_name,start_time=start_time, end_time=end_time,token=token),ensure_ascii=False)
-            logging.info('register form body : '+body)
-            response = func.HttpResponse(
-                status_code=200,
-                mimetype="application/json",
-                body = body
-                )
-            #r = requests.post(url, data=body.encode("utf-8"), headers={'Content-Type': 'application/json'})
-            return response
+#再送されたinteractionには、最初の処理のレスポンスを返す
+def duplicate_response(interaction,cached_body):
+    log.event('duplicate interaction', interaction_id=interaction["id"])
+    #最初の処理がまだ終わっていなければ、deferredとして返す
+    if cached_body is None:
+        cached_body = templates.DEFERRED_CHANNEL_MESSAGE if interaction['type'] == 2 else templates.DEFERRED_UPDATE_MESSAGE
+    return json_response(cached_body)
 
+#pingの場合
+router.route(1, blocking=False)(commands.ping) #1: ping https://discord.com/developers/docs/interactions/receiving-and-responding#interaction-object-interaction-type
 
-    #pingコマンドの場合
-    else:
-        response = func.HttpResponse(
-            status_code=200,
-            mimetype="application/json",
-            body= json.dumps({
-                "type": 1 # 1: pong https://discord.com/developers/docs/interactions/receiving-and-responding#interaction-object-interaction-type
-            })
-        )
-        return response
+#/settoken : notionのtokenを登録する
+@router.route(2, "settoken")
+def settoken_command(ctx):
+    return commands.settoken(ctx, ctx.option())
 
-    name = req.params.get('name')
-    if not name:
-        try:
-            req_body = req.get_json()
-        except ValueError:
-            pass
-        else:
-            name = req_body.get('name')
+#/notion-register : notionとの連携用のリンクを生成する
+@router.route(2, "notion-register", blocking=False)
+def notion_register_command(ctx):
+    url = notion_auth_url(ctx.user_id)
+    return templates.response(4, NOTION_REGISTER_MESSAGE.render(url=url))
 
-    if name:
-        return func.HttpResponse(f"Hello, {name}. This HTTP triggered function executed successfully.")
-    else:
-        return func.HttpResponse(
-             "This HTTP triggered function executed successfully. Pass a name in the query string or in the request body for a personalized response.",
-             status_code=200
-        )
-    
-#discordからのリクエストを検証する関数
-def verify(signature, timestamp, raw_body):
-    # Load the public key
-    public_key_bytes = bytes.fromhex(os.environ.get("DISCORD_PUBLIC_KEY"))
-    public_key = Ed25519PublicKey.from_public_bytes(public_key_bytes)
+#/act : notionのデータベースにアクションを登録する
+#notionと連携していないユーザーには、キューを通さずにその場で返す
+@router.route(2, "act", mode=DEFERRED, fields=["notion_access_token", "action_page_id"])
+def act_command(ctx):
+    action_name, start_time, body = act_prelude(ctx)
+    if body:
+        return body
+    #同期モードでは、notionへの登録が終わってから返す
+    #締め切りまでに終わらない(notionが遅い・サーキットブレーカーが開いている)ときは、キューに回してすぐ返す
+    from shared_code import notion_scheduler
+    from shared_code.action import start_action
+    try:
+        data = start_action(ctx.user_id,ctx.username,action_name,start_time,ctx.interaction["id"],deadline=ctx.deadline)
+    except notion_scheduler.NotionUnavailable as e:
+        log.event('act queued', interaction_id=ctx.interaction["id"], reason=e, sent=e.sent, level=logging.WARNING)
+        #送ったあとの失敗(読み込みのタイムアウトなど)なら、ページはできているかもしれないので、workerに探させてから作らせる
+        enqueue_act(ctx,action_name,start_time,maybe_created=e.sent)
+        data = ACT_QUEUED_MESSAGE
+    return templates.response(4, data) #4: channel message with source
 
+@router.route_async(2, "act")
+async def act_command_async(ctx):
+    action_name, start_time, body = act_prelude(ctx)
+    if body:
+        return body
+    from shared_code import notion_scheduler
+    from shared_code.action import start_action_async
     try:
-        # Verify the signature
-        public_key.verify(bytes.fromhex(signature),(timestamp + raw_body).encode('utf-8')) 
-        return True
-    except InvalidSignature:
-        return False
+        #プロフィールは振り分けるときに読み済み
+        data = await start_action_async(ctx.user_id,ctx.username,action_name,start_time,ctx.interaction["id"],deadline=ctx.deadline,profile=ctx.profile)
+    except notion_scheduler.NotionUnavailable as e:
+        log.event('act queued', interaction_id=ctx.interaction["id"], reason=e, sent=e.sent, level=logging.WARNING)
+        #送ったあとの失敗(読み込みのタイムアウトなど)なら、ページはできているかもしれないので、workerに探させてから作らせる
+        enqueue_act(ctx,action_name,start_time,maybe_created=e.sent)
+        data = ACT_QUEUED_MESSAGE
+    return templates.response(4, data) #4: channel message with source
+
+#/actのうち、notionを呼ばずに返せる場合(未連携・deferred)
+#(アクション名, 開始時刻, その場で返すbody(なければNone))を返す
+def act_prelude(ctx):
+    #アクション名がある場合は、アクション名を取得する
+    action_name = ctx.option("")
+    #現在時刻を取得
+    start_time = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    if not ctx.profile or not ctx.profile["notion_access_token"]:
+        return action_name, start_time, templates.response(4, templates.MESSAGE.render(content=f"{ctx.username}はnotionと連携していません。notionと連携するには、/notion-registerコマンドを実行してください。"))
+    if ctx.mode == DEFERRED:
+        #deferredモードでは、notionへの登録はキュートリガー(discord-notion-worker)に任せ、
+        #ここではtype 5(deferred)だけを返す。返信内容はworkerがwebhookをPATCHして書き換える
+        enqueue_act(ctx,action_name,start_time)
+        log.event('act deferred', interaction_id=ctx.interaction["id"])
+        return action_name, start_time, templates.DEFERRED_CHANNEL_MESSAGE
+    return action_name, start_time, None
+
+#/actの続きをキュートリガーに渡す
+#maybe_created=Trueなら、workerはnotionにページが既にないかをインタラクションIDで探してから作る
+def enqueue_act(ctx,action_name,start_time,maybe_created=False):
+    ctx.msg.set(json.dumps({
+        "kind": "act",
+        "application_id": ctx.interaction["application_id"],
+        "interaction_token": ctx.interaction["token"],
+        "interaction_id": ctx.interaction["id"],
+        "user_id": ctx.user_id,
+        "username": ctx.username,
+        "action_name": action_name,
+        "start_time": start_time,
+        "maybe_created": maybe_created
+    },ensure_ascii=False))
 
-#tokenをDBに登録する関数
-def settoken(user_name,user_id,token):
+#/actのアクション名の補完
+@router.route(4, "act", blocking=False) #4: application command autocomplete
+def act_autocomplete(ctx):
+    #入力中のオプションの値を前方一致で探す
+    prefix = ""
+    for option in ctx.data.get("options", []):
+        if option.get("focused"):
+            prefix = str(option.get("value", ""))
+    from shared_code import autocomplete
+    #インデックスには100文字(CHOICE_MAX_LENGTH)以下の名前しか入っていないので、nameもvalueもそのまま返せる
+    choices = [{"name": name, "value": name} for name in autocomplete.suggest(ctx.user_id,prefix)]
+    return templates.response(8, templates.dumps({"choices": choices})) #8: application command autocomplete result
+
+#/report [range] : 日ごとの集計から、期間内の合計時間・アクション数・カテゴリ別の時間を返す
+#Table Storageの範囲クエリ1回だけで返せるので、キューには回さない
+@router.route(2, "report")
+def report_command(ctx):
+    from shared_code import report
+    return templates.response(4, report.create_report(ctx.user_id,ctx.option())) #4: channel message with source
+
+#終了ボタン : notionへ登録する情報を入れる入力フォームを返す
+@router.route(3, "end", fields=["notion_access_token", "category_page_id"]) #3: component
+def end_button(ctx):
+    from shared_code import active_actions
+    from shared_code import categories
+    token = ctx.profile["notion_access_token"] if ctx.profile else None
+    category_page_id = ctx.profile["category_page_id"] if ctx.profile else None
+    #入力済みのアクション名と開始時刻は、/actのinteraction IDから進行中のアクションを読みだす
+    origin_id = active_actions.origin_interaction_id(ctx.interaction)
+    active = active_actions.get_active_action(ctx.user_id,origin_id) if origin_id else None
+    action_name = active["action_name"] if active else ""
+    start_time = active["start_time"] if active else ""
+    end_time = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    #カテゴリの選択肢はキャッシュから作る(notionへの問い合わせは一定間隔で差分だけ)
+    category_list = []
+    if token and category_page_id:
+        try:
+            category_list = categories.get_category_options(ctx.user_id,token,category_page_id,deadline=ctx.deadline)
+        except Exception as e:
+            logging.error(e)
+    with timing.stage("serialize"):
+        body = create_action_form(action_name=action_name,start_time=start_time, end_time=end_time,token=token,category_list=category_list,interaction_id=origin_id)
+    log.payload('register form body', body)
+    return body
+
+#アクション登録フォームの送信 custom_idの":"以降は/actのinteraction ID
+@router.route(5, "action_register_modal", mode=DEFERRED) #5: modal submit
+def action_register_modal(ctx):
+    origin_id, form, body = modal_prelude(ctx)
+    if body:
+        return body
+    from shared_code import notion_scheduler
+    from shared_code.action import finish_action
     try:
-        #tokenをDBに登録する
-        #DBに登録するためのオブジェクトを作成
-        #Azure Table Storageのアカウント名とキー
-        storage_account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
-        storage_account_key = os.environ.get("STORAGE_ACCOUNT_KEY")
-        table_name = "NotionToken"
-        #tableserviceオブジェクトを作成
-        table_service = TableService(account_name=storage_account_name, account_key=storage_account_key)
-        #テーブルがなければ作成
-        table_service.create_table(table_name)
-        #エンティティを作成
-        entity = Entity()
-        entity.PartitionKey = "discord"
-        entity.RowKey = user_id
-        entity.token = token
-        entity.user_name = user_name
-        #エンティティを登録または置換
-        table_service.insert_or_replace_entity(table_name, entity)
-        return True
-    except Exception as e:
-        logging.error(e)
-        return False
-    
-#IDからtokenを取得する
-def gettoken(user_id):
-    #Tabel Storageからtokenを取得する
-    #Azure Table Storageのアカウント名とキー
-    storage_account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
-    storage_account_key = os.environ.get("STORAGE_ACCOUNT_KEY")
-    table_name = "NotionToken"
-    #tableserviceオブジェクトを作成 
-    table_service = TableService(account_name=storage_account_name, account_key=storage_account_key)
-    #user_idを指定してエンティティを取得(あれば)
-    entity = table_service.get_entity(table_name, "discord", user_id)
-    #なければNoneを返す
-    if not entity:
-        return None
-    #tokenを返す
-    return entity.notion_access_token
+        finish_data = finish_action(ctx.user_id,origin_id,form,deadline=ctx.deadline)
+    except notion_scheduler.NotionUnavailable as e:
+        log.event('finish queued', interaction_id=ctx.interaction["id"], reason=e, level=logging.WARNING)
+        enqueue_finish(ctx,origin_id,form)
+        finish_data = FINISH_QUEUED_MESSAGE
+    return templates.response(7, finish_data) #7: update message
 
-def get_database_id(user_id):
-    #Tabel Storageから各種notion databaseのIDを取得する
-    #Azure Table Storageのアカウント名とキー
-    storage_account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
-    storage_account_key = os.environ.get("STORAGE_ACCOUNT_KEY")
-    table_name = "NotionToken"
-    #tableserviceオブジェクトを作成 
-    table_service = TableService(account_name=storage_account_name, account_key=storage_account_key)
-    #user_idを指定してエンティティを取得(あれば)
-    entity = table_service.get_entity(table_name, "discord", user_id)
-    #なければNoneを返す
-    if not entity:
-        return None
-    return {
-        "task_page_id": entity.task_page_id,
-        "action_page_id": entity.action_page_id,
-        "category_page_id": entity.category_page_id
-    }
+@router.route_async(5, "action_register_modal")
+async def action_register_modal_async(ctx):
+    origin_id, form, body = modal_prelude(ctx)
+    if body:
+        return body
+    from shared_code import notion_scheduler
+    from shared_code.action import finish_action_async
+    try:
+        finish_data = await finish_action_async(ctx.user_id,origin_id,form,deadline=ctx.deadline)
+    except notion_scheduler.NotionUnavailable as e:
+        log.event('finish queued', interaction_id=ctx.interaction["id"], reason=e, level=logging.WARNING)
+        enqueue_finish(ctx,origin_id,form)
+        finish_data = FINISH_QUEUED_MESSAGE
+    return templates.response(7, finish_data) #7: update message
 
-#notionからカテゴリのリストを取得する
-#引数はtoken、オプションとしてparent_idを指定できる
-def get_category_list(token,parent_id=None):
-    #parent_idが指定されていない場合は、rootになっているカテゴリのみを取得する
-    if not parent_id:
-        pass
-    #parent_idが指定されている場合は、そのカテゴリの子カテゴリを取得する
-    else:
-        pass
-    #テスト用のカテゴリのリストを返す
-    category_list = [
-        {
-            "label": "category1",
-            "value": "category1",
-            "description": "category1の説明"
-        },
-        {
-            "label": "category2",
-            "value": "category2",
-            "description": "category2の説明"
-        },
-        {
-            "label": "category3",
-            "value": "category3",
-            "description": "category3の説明"
-        }
-    ]
-    return category_list
+#フォームの送信のうち、notionを呼ばずに返せる場合(時刻の書式の誤り・deferred)
+#(/actのinteraction ID, フォームの値, その場で返すbody(なければNone))を返す
+def modal_prelude(ctx):
+    custom_id = ctx.data["custom_id"]
+    origin_id = custom_id.split(":",1)[1] if ":" in custom_id else None
+    form = parse_action_form(ctx.data)
+    #開始時刻と終了時刻はここで一度だけISO8601に変換する
+    form["start_time_ISO8601"] = to_ISO8601(form["start_time"])
+    form["end_time_ISO8601"] = to_ISO8601(form["end_time"])
+    if form["start_time_ISO8601"] is None or form["end_time_ISO8601"] is None:
+        return origin_id, form, BAD_TIME_RESPONSE
+    if ctx.mode == DEFERRED:
+        #notionの更新はキュートリガーに任せ、type 6(deferred update)だけを返す
+        #終了ボタンのあったメッセージはworkerがwebhookをPATCHして書き換える
+        enqueue_finish(ctx,origin_id,form)
+        return origin_id, form, templates.DEFERRED_UPDATE_MESSAGE
+    return origin_id, form, None
 
-#アクション登録用のフォームを作成する
-def create_action_form(token,action_name="",start_time="",end_time="",category_list=[],selected_category=None,note=""):
-    #discord用もアクション登録用のフォームを作成する
-    register_form = {
-        "type": 9,
-        "data": {
-            "title": "アクション登録",
-            "custom_id": "action_register_modal",
-            "components": [
-                {
-                    "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows                    
-                    "components": [
-                        {
-                            #アクション名を入力するフォーム
-                            "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
-                            "custom_id": "action_name_input",
-                            "label": "アクション名を入力してください",
-                            "placeholder": "ここにアクション名を入力",
-                            "value": action_name,
-                            "max_length": 100,
-                            "min_length": 1,
-                            "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
-                        }
-                        ]
-                },{
-                    "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
-                    "components": [
-                        {
-                            #開始時刻を入力するフォーム
-                            "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
-                            "custom_id": "start_time_input",
-                            "label": "開始時刻",
-                            "placeholder": "(書式 : yyyy/mm/dd hh:mm:ss)",
-                            "value": start_time,
-                            "max_length": 30,
-                            "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
-                        }
-                        ]
-                },{
-                    "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
-                    "components": [
-                        {
-                            #終了時刻を入力するフォーム
-                            "type": 4, #4: select menu https://discord.com/developers/docs/interactions/message-components#select-menus
-                            "custom_id": "end_time_input",
-                            "label": "終了時刻",
-                            "placeholder": "(書式 : yyyy/mm/dd hh:mm:ss)",
-                            "value": end_time,
-                            "max_length": 30,
-                            "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
-                        }
-                        ]
-                },{
-                    "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
-                    "components": [
-                        {
-                            #備考テキストを入力するフォーム
-                            "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
-                            "custom_id": "note_input",
-                            "label": "備考（あれば）",
-                            "placeholder": "ここに備考を入力",
-                            "max_length": 4000,
-                            "min_length": 0,
-                            "value": "",
-                            "style": 2,
-                            "required": False
-                        }
-                    ]    
-                }
-            ]
-        }
+#アクション登録フォームの送信の続きをキュートリガーに渡す
+def enqueue_finish(ctx,origin_id,form):
+    ctx.msg.set(json.dumps({
+        "kind": "finish",
+        "application_id": ctx.interaction["application_id"],
+        "interaction_token": ctx.interaction["token"],
+        "user_id": ctx.user_id,
+        "origin_interaction_id": origin_id,
+        "form": form
+    },ensure_ascii=False))
+    
+#アクション登録用のフォームのテンプレート
+#固定の部分(4つの入力欄)は読み込み時に一度だけシリアライズし、入力済みの値だけを差し込む
+_action_form = {
+    "type": 9,
+    "data": {
+        "title": "アクション登録",
+        "custom_id": templates.slot("custom_id"),
+        "components": [
+            {
+                "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows                    
+                "components": [
+                    {
+                        #アクション名を入力するフォーム
+                        "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
+                        "custom_id": "action_name_input",
+                        "label": "アクション名を入力してください",
+                        "placeholder": "ここにアクション名を入力",
+                        "value": templates.slot("action_name"),
+                        "max_length": 100,
+                        "min_length": 1,
+                        "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
+                    }
+                    ]
+            },{
+                "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
+                "components": [
+                    {
+                        #開始時刻を入力するフォーム
+                        "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
+                        "custom_id": "start_time_input",
+                        "label": "開始時刻",
+                        "placeholder": "(書式 : yyyy/mm/dd hh:mm:ss)",
+                        "value": templates.slot("start_time"),
+                        "max_length": 30,
+                        "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
+                    }
+                    ]
+            },{
+                "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
+                "components": [
+                    {
+                        #終了時刻を入力するフォーム
+                        "type": 4, #4: text input https://discord.com/developers/docs/interactions/message-components#text-inputs
+                        "custom_id": "end_time_input",
+                        "label": "終了時刻",
+                        "placeholder": "(書式 : yyyy/mm/dd hh:mm:ss)",
+                        "value": templates.slot("end_time"),
+                        "max_length": 30,
+                        "style": 1, #1: blurple https://discord.com/developers/docs/interactions/message-components#button-object-button-styles
+                    }
+                    ]
+            },{
+                "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
+                "components": [
+                    {
+                        #備考テキストを入力するフォーム
+                        "type": 4, #4: input https://discord.com/developers/docs/interactions/message-components#action-rows
+                        "custom_id": "note_input",
+                        "label": "備考（あれば）",
+                        "placeholder": "ここに備考を入力",
+                        "max_length": 4000,
+                        "min_length": 0,
+                        "value": templates.slot("note"),
+                        "style": 2,
+                        "required": False
+                    }
+                ]    
+            }
+        ]
+    }
+}
+ACTION_FORM = templates.Template(_action_form)
+#カテゴリを選ぶセレクトメニューを追加したフォーム(選択肢は差し込む)
+_action_form["data"]["components"] = _action_form["data"]["components"] + [{
+    "type": 18, #18: label https://discord.com/developers/docs/components/reference#label
+    "label": "カテゴリ",
+    "component": {
+        "type": 3, #3: string select https://discord.com/developers/docs/components/reference#string-select
+        "custom_id": "category_select",
+        "placeholder": "カテゴリを選択",
+        "required": False,
+        "options": templates.slot("options")
     }
+}]
+ACTION_FORM_WITH_CATEGORY = templates.Template(_action_form)
+del _action_form
 
-    return register_form
-
-#notionの情報を検索し、ページ名が一致するページのIDを返す
-def notion_get_rootpage(token,page_name):
-    url=url = f"https://api.notion.com/v1/search"
-    headers = json.dumps({
-        "accept": "application/json",
-        "notion_version": "2022-06-28",
-        "Authorization": "Bearer "+token
-        })
-    payload = json.dumps({
-        "query": page_name,
-        "filter": {
-            "property": "object",
-            "value": "page"
-        },
-        "sort": {
-            "direction": "ascending",
-            "timestamp": "last_edited_time"
-        }
-    })
-    response = requests.request("POST", url, headers=headers, data=payload)
-    reslut = json.loads(response.text)
-    #ページが見つかった場合は、ページのIDを返す
-    if reslut["results"]:
-        return reslut["results"][0]["id"]
-    #ページが見つからなかった場合は、Noneを返す
-    else:
-        return None
+#アクション登録用のフォームを作成する(シリアライズ済みのbytesを返す)
+#interaction_idを渡すと、モーダルのcustom_idに/actのinteraction IDを含める(送信時に進行中のアクションを引くため)
+def create_action_form(token,action_name="",start_time="",end_time="",category_list=[],selected_category=None,note="",interaction_id=None):
+    custom_id = "action_register_modal" + (":"+interaction_id if interaction_id else "")
+    #カテゴリがなければ、カテゴリのセレクトメニューのないフォームにする
+    if not category_list:
+        return ACTION_FORM.render(custom_id=custom_id,action_name=action_name,start_time=start_time,end_time=end_time,note=note)
+    options = [dict(option, default=(option["value"] == selected_category)) for option in category_list]
+    return ACTION_FORM_WITH_CATEGORY.render(custom_id=custom_id,action_name=action_name,start_time=start_time,end_time=end_time,note=note,options=options)
 
 #notion認証用のURLを作成する
 def notion_auth_url(user_id):
-    url_base = "https://api.notion.com/v1/oauth/authorize?client_id=1747a4a7-f6ba-49b0-9258-9a51b8b6e9a5&response_type=code&owner=user&redirect_uri=https%3A%2F%2Fnotion-action-register.azurewebsites.net%2Fapi%2Fnotion-registration-redirect"
-    #user_idを暗号化する
-    #暗号化するためのキーを取得する
-    key = os.environ.get("DISCORD_USER_ID_ENCRYPT_KEY")
-    #キーを元にFernetオブジェクトを作成する
-    f = Fernet(key)
-    #user_idを暗号化する
-    user_id_encrypted = f.encrypt(user_id.encode('utf-8')).decode('utf-8')
+    from shared_code import settings
+    from shared_code import registration
+    url_base = "https://api.notion.com/v1/oauth/authorize?client_id="+settings.NOTION_CLIENT_ID+"&response_type=code&owner=user&redirect_uri="+urllib.parse.quote(settings.NOTION_REDIRECT_URI, safe="")
+    #user_idを暗号化する(キーから作ったFernetオブジェクトはプロセスで共有する)
+    user_id_encrypted = registration.encrypt_state(user_id)
     url_suffix = urllib.parse.quote(user_id_encrypted)
     #urlに暗号化されたuser_idを追加する
     url = url_base + "&state=" + url_suffix
     return url
-
-#notionにアクションを登録する
-def notion_register_action(token,database_id,action_name,start_time,intaraction_id):
-    #start_timeは開始時刻(yyyy/mm/dd HH:MM:SS)の文字列なので、ISO8601形式に変換する
-    start_time_ISO8601 = datetime.datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S').isoformat()
-    url = "https://api.notion.com/v1/pages"
-
-    body = json.dumps({
-    "parent": { 
-        "database_id": database_id 
-        },
-    "properties": {
-        "アクション名" : {
-            "type": "title",
-            "title": [{
-                "text": {"content": action_name}
-            }] 
-        },
-        "時刻" : {
-            "date": {"start": start_time_ISO8601}
-        },
-        "ステータス" :{
-            "status": {"name": "進行中"}
-        },
-        "インタラクションID":{
-            "rich_text": [{"type": "text","text": {"content": intaraction_id}}]
-        }
-        }
-    }   
-    )
-    headers = {
-        "Authorization": "Bearer "+token,
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28"
-    }
-    logging.info('notion register action body : '+body)
-    response = requests.request("POST", url, headers=headers, data=body)
-    return response
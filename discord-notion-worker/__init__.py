@@ -0,0 +1,120 @@
+import logging
+import json
+import azure.functions as func
+from shared_code import timing
+from shared_code.aio import EXECUTION_MODE
+from shared_code import settings
+#notionやdiscordへのHTTP(requests)、Table Storage(azure.cosmosdb.table)を使う処理は、
+#ジョブの種類ごとに、その分岐を初めて通るときに読み込む
+
+#notionから応答がない(タイムアウト・サーキットブレーカーが開いている)ときに、キューの再配信に任せる回数
+#host.jsonのqueues.maxDequeueCount(既定値5)以下にする
+MAX_ATTEMPTS = settings.WORKER_MAX_ATTEMPTS
+
+#HTTPトリガーがリクエストの外に回した処理を行うキュートリガー
+#act : discord-notion-registerがdeferred(type 5)で返したinteractionの続き
+#      notionへの書き込みと、discordへの返信(webhookのPATCH)を行う
+#finish : アクション登録フォームの送信の続き notionのページを更新し、終了ボタンのあったメッセージを書き換える
+#notion_register : notion-registration-redirectが保存した保留中の登録を完了させる
+@timing.measured("discord-notion-worker")
+def main_sync(msg: func.QueueMessage) -> None:
+    job = json.loads(msg.get_body().decode('utf-8'))
+    logging.info('queue job : '+job["kind"])
+    timing.tag("command", job["kind"])
+    if job["kind"] in ("act", "finish"):
+        from shared_code.action import start_action, finish_action, ACT_FAILED_MESSAGE, FINISH_FAILED_MESSAGE
+        from shared_code.discord_api import edit_original_response
+        from shared_code.notion_scheduler import NotionUnavailable
+    if job["kind"] == "act":
+        try:
+            #既に作ったページがあればそれを使う(再配信やHTTPトリガーでのタイムアウトのあとに、ページを二重に作らない)
+            action_data = start_action(job["user_id"],job["username"],job["action_name"],job["start_time"],job["interaction_id"],resume=True,check_notion=may_exist(msg,job))
+        except NotionUnavailable as e:
+            retry_later(msg,e)
+            action_data = ACT_FAILED_MESSAGE
+        except Exception as e:
+            #失敗してもdiscord側が「考え中」のままにならないよう、エラーを返信する
+            logging.error(e)
+            action_data = ACT_FAILED_MESSAGE
+        reply(edit_original_response,job,action_data)
+    elif job["kind"] == "finish":
+        try:
+            finish_data = finish_action(job["user_id"],job["origin_interaction_id"],job["form"])
+        except NotionUnavailable as e:
+            retry_later(msg,e)
+            finish_data = FINISH_FAILED_MESSAGE
+        except Exception as e:
+            logging.error(e)
+            finish_data = FINISH_FAILED_MESSAGE
+        reply(edit_original_response,job,finish_data)
+    elif job["kind"] == "notion_register":
+        from shared_code import registration
+        registration.complete_registration(job["user_id"])
+    else:
+        logging.warning('unknown job kind : '+job["kind"])
+
+#mainの非同期版
+#notionへの書き込みのあとの、進行中のアクションの行の保存・削除と、discordへの返信(webhookのPATCH)を同時に待つ
+@timing.measured("discord-notion-worker")
+async def main_async(msg: func.QueueMessage) -> None:
+    job = json.loads(msg.get_body().decode('utf-8'))
+    logging.info('queue job : '+job["kind"])
+    timing.tag("command", job["kind"])
+    if job["kind"] in ("act", "finish"):
+        from shared_code.action import start_action_async, finish_action_async, ACT_FAILED_MESSAGE, FINISH_FAILED_MESSAGE
+        from shared_code.discord_api import edit_original_response_async
+        from shared_code.notion_scheduler import NotionUnavailable
+        sent = []
+        #返信に失敗しても例外は送出しない(notionへの書き込みをやり直したり、成功の返信を失敗の返信で上書きしたりしない)
+        async def send(data):
+            sent.append(data)
+            try:
+                response = await edit_original_response_async(job["application_id"],job["interaction_token"],data)
+                logging.info('followup status : '+str(response.status_code))
+            except Exception as e:
+                logging.error('followup failed : '+type(e).__name__+' '+str(e))
+        failed_message = ACT_FAILED_MESSAGE if job["kind"] == "act" else FINISH_FAILED_MESSAGE
+        try:
+            if job["kind"] == "act":
+                await start_action_async(job["user_id"],job["username"],job["action_name"],job["start_time"],job["interaction_id"],send=send,resume=True,check_notion=may_exist(msg,job))
+            else:
+                await finish_action_async(job["user_id"],job["origin_interaction_id"],job["form"],send=send)
+        except NotionUnavailable as e:
+            retry_later(msg,e)
+            if not sent:
+                await send(failed_message)
+        except Exception as e:
+            #失敗してもdiscord側が「考え中」のままにならないよう、まだ返信していなければエラーを返信する
+            logging.error(e)
+            if not sent:
+                await send(failed_message)
+    elif job["kind"] == "notion_register":
+        from shared_code import registration
+        await registration.complete_registration_async(job["user_id"])
+    else:
+        logging.warning('unknown job kind : '+job["kind"])
+
+#EXECUTION_MODE(sync/async)で、Azure Functionsから呼ばれるmainを切り替える
+main = main_async if EXECUTION_MODE == "async" else main_sync
+
+#notionが応答しないときは例外を送出してメッセージをキューに戻し、あとで再配信させる
+#最後の1回は例外を送出せず、失敗の返信をする(discord側が「考え中」のままにならないように)
+def retry_later(msg,error):
+    if (msg.dequeue_count or 1) < MAX_ATTEMPTS:
+        logging.warning('notion unavailable, job will be retried : '+str(msg.dequeue_count))
+        raise error
+    logging.error(error)
+
+#notionにこの/actのページが既にあるかもしれないか
+#(キューから再配信された、HTTPトリガーでのページの作成がnotionに届いたあとで失敗した)
+def may_exist(msg,job):
+    return (msg.dequeue_count or 1) > 1 or job.get("maybe_created", False)
+
+#discordへの返信(webhookのPATCH)
+#返信に失敗しても例外は送出しない(キューに戻すと、notionへの書き込みからやり直してしまう)
+def reply(edit,job,data):
+    try:
+        response = edit(job["application_id"],job["interaction_token"],data)
+        logging.info('followup status : '+str(response.status_code))
+    except Exception as e:
+        logging.error('followup failed : '+type(e).__name__+' '+str(e))
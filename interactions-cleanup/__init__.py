@@ -0,0 +1,13 @@
+import logging
+import azure.functions as func
+from shared_code import timing
+
+#再送の確認用の行(Interactionsテーブル)のうち、期限(IDEMPOTENCY_CACHE_TTL)を過ぎたものを消すタイマー
+#行のPartitionKeyは10分ごとに区切った時刻なので、10分ごとに動かせば古いパーティションは溜まらない
+#(1回で消すのはcleanupのlimit件まで 残りは次の回に消す)
+@timing.measured("interactions-cleanup")
+def main(timer: func.TimerRequest) -> None:
+    from shared_code import idempotency
+    with timing.stage("cleanup"):
+        deleted = idempotency.cleanup()
+    logging.info('expired interactions deleted : '+str(deleted))
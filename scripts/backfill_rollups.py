@@ -0,0 +1,120 @@
+#/report用の日ごとの集計(ActionRollupsテーブル)を、notionのアクションのデータベースから作り直すスクリプト
+#アクションを終了するたびに差分だけ足しているが、導入前のアクションや、notionで直接直したアクションはこれで反映する
+#
+#  python scripts/backfill_rollups.py                        # 連携済みの全ユーザー
+#  python scripts/backfill_rollups.py --user 123456789012345678
+#  python scripts/backfill_rollups.py --resume               # 中断したところ(チェックポイント)から続ける
+#
+#アクションのデータベースはnext_cursorで100件ずつ読み、読んだそばから集計してアクションの行を書き込む
+#(全ページをメモリに載せない) 1ユーザー終わるごとにチェックポイントを書く
+#作り直している間に終了したアクションは上書きされることがあるので、利用の少ない時間に実行するか、もう一度実行する
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_code import storage
+from shared_code import rollups
+from shared_code import categories
+from shared_code.notion_api import query_database
+
+#アクションのデータベースのプロパティ(notion_api.notion_finish_actionで書き込むもの)
+TIME_PROPERTY = "時刻"
+CATEGORY_PROPERTY = "カテゴリ"
+STATUS_PROPERTY = "ステータス"
+FINISHED_STATUS = "完了"
+
+#連携済みのユーザー(tokenとアクションのデータベースがある行)を順に返す
+def users(table_service,user_ids=None):
+    marker = None
+    seen = set()
+    while True:
+        page = table_service.query_entities(
+            storage.TABLE_NAME,
+            select="RowKey,notion_access_token,action_page_id,category_page_id",
+            num_results=1000,
+            marker=marker
+        )
+        for entity in page:
+            user_id = entity["RowKey"]
+            #移行中は同じユーザーの行が移行前のパーティションにも残っている
+            if user_id in seen or (user_ids and user_id not in user_ids):
+                continue
+            if not entity.get("notion_access_token") or not entity.get("action_page_id"):
+                continue
+            seen.add(user_id)
+            yield entity
+        marker = page.next_marker or None
+        if not marker:
+            return
+
+#終了済みのアクションを1件ずつ(ページID, contributionの結果, カテゴリ名)で返す
+def actions(user_id,profile,names):
+    pages = query_database(profile["action_page_id"], profile["notion_access_token"], filter={
+        "property": STATUS_PROPERTY,
+        "status": {"equals": FINISHED_STATUS}
+    })
+    for page in pages:
+        date = (page["properties"].get(TIME_PROPERTY) or {}).get("date") or {}
+        if not date.get("start") or not date.get("end"):
+            continue
+        relation = (page["properties"].get(CATEGORY_PROPERTY) or {}).get("relation") or []
+        category_id = relation[0]["id"] if relation else None
+        item = rollups.contribution(date["start"], date["end"], category_id)
+        if item is None:
+            continue
+        yield page["id"], item, names.get(category_id)
+
+#カテゴリのページIDから名前を引く表(カテゴリのデータベースがなければ空)
+def category_names(user_id,profile):
+    if not profile.get("category_page_id"):
+        return {}
+    tree = categories.get_tree(user_id, profile["notion_access_token"], profile["category_page_id"])
+    return {category_id: category["name"] for category_id, category in tree["categories"].items()}
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {"done": []}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_checkpoint(path,checkpoint):
+    #書き込み途中で止まっても壊れないよう、別のファイルに書いてから置き換える
+    with open(path+".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(path+".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser(description="notionのアクションから、/report用の日ごとの集計を作り直す")
+    parser.add_argument("--user", action="append", default=None, help="このユーザーだけ作り直す(複数指定できる)")
+    parser.add_argument("--checkpoint", default="backfill_rollups.checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="チェックポイントに記録したユーザーを飛ばす")
+    parser.add_argument("--dry-run", action="store_true", help="notionを読んで集計するだけで書き込まない")
+    args = parser.parse_args()
+
+    table_service = storage.get_table_service()
+    checkpoint = load_checkpoint(args.checkpoint) if args.resume else {"done": []}
+    done = set(checkpoint["done"])
+    failed = 0
+    for profile in users(table_service, set(args.user) if args.user else None):
+        user_id = profile["RowKey"]
+        if user_id in done:
+            continue
+        try:
+            result = rollups.rebuild(user_id, actions(user_id, profile, category_names(user_id, profile)), dry_run=args.dry_run)
+        except Exception as e:
+            #tokenが失効しているユーザーなどは飛ばして続ける
+            failed += 1
+            print(f"{user_id} failed : {type(e).__name__} {e}")
+            continue
+        print(f"{user_id} actions={result['actions']} days={result['days']} deleted={result['deleted']}")
+        done.add(user_id)
+        checkpoint["done"] = sorted(done)
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, checkpoint)
+    print(f"done users={len(done)} failed={failed}")
+
+if __name__ == "__main__":
+    main()
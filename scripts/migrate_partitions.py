@@ -0,0 +1,161 @@
+#NotionTokenテーブルの行を、user_idのハッシュで分けたパーティション(storage.partition_key)へ移し替えるスクリプト
+#アプリを止めずに実行できる
+#  - アプリは新しいパーティションを先に読み、なければ移行前のパーティションを読む
+#    (分割する前の"discord"パーティションはNOTION_TOKEN_LEGACY_FALLBACK、
+#     分割数を変えたときは変える前の分割数をNOTION_TOKEN_PREVIOUS_PARTITIONSに設定しておく)
+#  - アプリは新しいパーティションにだけ書き込むので、移行では既にある行を上書きしない(insertが競合したらその行は飛ばす)
+#
+#  python scripts/migrate_partitions.py                     # "discord"パーティションの行をコピーする
+#  python scripts/migrate_partitions.py --delete-source     # コピーしたあと元の行を消す
+#  python scripts/migrate_partitions.py --resume            # 中断したところ(チェックポイント)から続ける
+#  python scripts/migrate_partitions.py --from-partitions 16  # パーティション数を16から変えたとき
+#                                                             # (NOTION_TOKEN_PARTITIONSは新しい数、NOTION_TOKEN_PREVIOUS_PARTITIONSは16にしておく)
+#
+#行は--page-size件ずつ読み、1ページごとに移行先のパーティションでまとめて(entity group transaction)書き込む
+#1ページ終わるごとに続きの位置をチェックポイントのファイルに書くので、途中で止めても--resumeで続けられる
+#全部移し終えたら、NOTION_TOKEN_LEGACY_FALLBACK=false(またはNOTION_TOKEN_PREVIOUS_PARTITIONS=0)にして移行前のパーティションを読まないようにする
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError, AzureException
+from azure.cosmosdb.table.tablebatch import TableBatch
+from shared_code import storage
+
+#entity group transactionに入れられる行数の上限
+BATCH_LIMIT = 100
+
+#移行元の行を読む条件
+def source_filter(from_partitions):
+    if from_partitions:
+        #from_partitions個に分けたパーティション("discord-00"〜)
+        #番号は2桁以上の16進数なので、256個以下なら文字列の範囲で絞れる(それより多ければis_sourceだけで見分ける)
+        first = storage.LEGACY_PARTITION_KEY+"-00"
+        if from_partitions <= 256:
+            last = storage.LEGACY_PARTITION_KEY+"-"+format(from_partitions - 1, "02x")
+            return f"PartitionKey ge '{first}' and PartitionKey le '{last}'"
+        return f"PartitionKey ge '{first}' and PartitionKey lt '{storage.LEGACY_PARTITION_KEY}.'"
+    return f"PartitionKey eq '{storage.LEGACY_PARTITION_KEY}'"
+
+#移行元の行か(from_partitions個に分けたときのPartitionKeyにある行か)
+#範囲の中には、新しい分割数で書き込まれた行もあるので、それは動かさない
+def is_source(entity,from_partitions):
+    if from_partitions:
+        return entity["PartitionKey"] == storage.partition_key(entity["RowKey"], from_partitions)
+    return True
+
+#Table Storageが付ける列を除いて、PartitionKeyを付け替えた行を作る
+def copy_entity(entity,partition_key):
+    copied = {k: v for k, v in entity.items() if k not in ("Timestamp", "etag")}
+    copied["PartitionKey"] = partition_key
+    return copied
+
+#PartitionKeyごとにBATCH_LIMIT件ずつに分ける(entity group transactionは同じパーティションの行しかまとめられない)
+def group_by_partition(entities):
+    groups = {}
+    for entity in entities:
+        groups.setdefault(entity["PartitionKey"], []).append(entity)
+    for partition_key, rows in groups.items():
+        for i in range(0, len(rows), BATCH_LIMIT):
+            yield partition_key, rows[i:i + BATCH_LIMIT]
+
+#行をまとめて挿入し、挿入できた行を返す
+#既にある行(アプリが新しいパーティションに書き込んだ行)があるとバッチ全体が失敗するので、そのときは1行ずつ入れ直す
+def insert_rows(table_service,rows,dry_run):
+    if dry_run:
+        return rows
+    batch = TableBatch()
+    for row in rows:
+        batch.insert_entity(row)
+    try:
+        table_service.commit_batch(storage.TABLE_NAME, batch)
+        return rows
+    except AzureException:
+        pass
+    inserted = []
+    for row in rows:
+        try:
+            table_service.insert_entity(storage.TABLE_NAME, row)
+            inserted.append(row)
+        except AzureConflictHttpError:
+            pass
+    return inserted
+
+#移し終えた元の行をまとめて消す
+def delete_rows(table_service,rows,dry_run):
+    if dry_run:
+        return
+    for partition_key, group in group_by_partition(rows):
+        batch = TableBatch()
+        for row in group:
+            batch.delete_entity(partition_key, row["RowKey"])
+        try:
+            table_service.commit_batch(storage.TABLE_NAME, batch)
+        except AzureException:
+            #別の実行が先に消していた行などがあれば1行ずつ消す
+            for row in group:
+                try:
+                    table_service.delete_entity(storage.TABLE_NAME, partition_key, row["RowKey"])
+                except AzureMissingResourceHttpError:
+                    pass
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {"marker": None, "read": 0, "copied": 0, "skipped": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_checkpoint(path,checkpoint):
+    #書き込み途中で止まっても壊れないよう、別のファイルに書いてから置き換える
+    with open(path+".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(path+".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser(description="NotionTokenテーブルの行を、分割したパーティションへ移し替える")
+    parser.add_argument("--from-partitions", type=int, default=None, help="移行元もパーティション分けされている場合の、その分割数")
+    parser.add_argument("--page-size", type=int, default=1000, help="1回に読む行数")
+    parser.add_argument("--delete-source", action="store_true", help="コピーしたあと、移行元の行を消す")
+    parser.add_argument("--checkpoint", default="migrate_partitions.checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="チェックポイントの位置から続ける")
+    parser.add_argument("--dry-run", action="store_true", help="読むだけで書き込まない")
+    args = parser.parse_args()
+
+    table_service = storage.get_table_service()
+    checkpoint = load_checkpoint(args.checkpoint) if args.resume else {"marker": None, "read": 0, "copied": 0, "skipped": 0}
+    marker = checkpoint["marker"]
+    print(f"partitions={storage.PARTITION_COUNT} source={source_filter(args.from_partitions)}")
+    while True:
+        page = table_service.query_entities(
+            storage.TABLE_NAME,
+            filter=source_filter(args.from_partitions),
+            num_results=args.page_size,
+            marker=marker
+        )
+        entities = [entity for entity in page if is_source(entity, args.from_partitions)]
+        #移行先が今のPartitionKeyと同じ行(パーティション数の変更で動かない行)はそのまま
+        moves = [(entity, storage.partition_key(entity["RowKey"])) for entity in entities]
+        moves = [(entity, target) for entity, target in moves if target != entity["PartitionKey"]]
+        copied = []
+        for _, rows in group_by_partition([copy_entity(entity, target) for entity, target in moves]):
+            copied.extend(insert_rows(table_service, rows, args.dry_run))
+        if args.delete_source:
+            #既に新しいパーティションにあって挿入しなかった行も、移行元からは消してよい
+            delete_rows(table_service, [entity for entity, _ in moves], args.dry_run)
+        checkpoint["read"] += len(entities)
+        checkpoint["copied"] += len(copied)
+        checkpoint["skipped"] += len(moves) - len(copied)
+        marker = page.next_marker or None
+        checkpoint["marker"] = marker
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, checkpoint)
+        print(f"read={checkpoint['read']} copied={checkpoint['copied']} skipped(already migrated)={checkpoint['skipped']}")
+        if not marker:
+            break
+    print("done")
+
+if __name__ == "__main__":
+    main()
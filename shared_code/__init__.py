@@ -0,0 +1,2 @@
+#各関数(HttpTrigger / QueueTrigger)から共通で使う処理をまとめたパッケージ
+#Azure Functionsではアプリのルートがsys.pathに入るので、`from shared_code import ...`で読み込める
@@ -0,0 +1,230 @@
+import asyncio
+from shared_code.user_profile import gettoken, get_profile
+from shared_code.notion_api import notion_register_action, notion_finish_action, notion_register_action_async, notion_finish_action_async, query_database
+from shared_code import active_actions
+from shared_code import autocomplete
+from shared_code import log
+from shared_code import templates
+from shared_code import aio
+from shared_code import rollups
+from shared_code import categories
+
+#/actで使うプロフィールの列
+ACT_FIELDS = ["notion_access_token", "action_page_id"]
+#アクションのページに/actのinteraction IDを書き込むプロパティ(notion_api.notion_register_actionで書き込む)
+INTERACTION_ID_PROPERTY = "インタラクションID"
+
+#/actの処理本体
+#notionにアクションを登録し、discordへ返すメッセージ(interaction responseの"data"をシリアライズしたbytes)を作成する
+#同期モードではHTTPトリガーから、deferredモードではキュートリガーから呼ばれる
+#deadlineはnotionへのリクエストの締め切り時刻(time.monotonic()基準)
+#resume=Trueなら(キューの再配信など、同じ/actを処理し直すとき)、既に登録したページがあればそれを使い、新しく作らない
+#check_notion=Trueなら、進行中のアクションの行がなくてもnotionのデータベースをインタラクションIDで探す
+#(ページの作成がタイムアウトしたあとなど、notionにだけページができているかもしれないとき)
+def start_action(user_id,username,action_name,start_time,interaction_id,deadline=None,resume=False,check_notion=False):
+    #tokenとアクションのデータベースのIDを一度に取得する
+    profile = get_profile(user_id,ACT_FIELDS)
+    token = profile["notion_access_token"] if profile else None
+    #tokenが登録されていない場合は、tokenを登録するようにメッセージを返す
+    if token == None:
+        return create_not_linked_message(username)
+    if resume:
+        page_id = find_registered_page(user_id,token,profile["action_page_id"],interaction_id,check_notion=check_notion,deadline=deadline)
+        if page_id is not None:
+            log.event('act resumed', interaction_id=interaction_id)
+            active_actions.save_active_action_safely(user_id,interaction_id,page_id,action_name,start_time)
+            return create_action_message(action_name,start_time)
+    #notionにアクションを登録する
+    data, page_id = register_outcome(notion_register_action(token,profile["action_page_id"],action_name,start_time,interaction_id,deadline=deadline),action_name,start_time)
+    if page_id is not None:
+        #作成したページを、/actのinteraction IDで引けるように保存する
+        active_actions.save_active_action_safely(user_id,interaction_id,page_id,action_name,start_time)
+        #アクション名の補完候補に追加する
+        autocomplete.record(user_id,action_name)
+    return data
+
+#/actのinteraction IDで既に登録したページのIDを返す なければNone
+#まず進行中のアクションの行を読み、check_notionならnotionのデータベースもインタラクションIDのプロパティで探す
+def find_registered_page(user_id,token,database_id,interaction_id,check_notion=False,deadline=None):
+    active = active_actions.get_active_action(user_id,interaction_id)
+    if active is not None:
+        return active["page_id"]
+    if not check_notion:
+        return None
+    for page in query_database(database_id,token,filter={"property": INTERACTION_ID_PROPERTY, "rich_text": {"equals": interaction_id}},deadline=deadline):
+        return page["id"]
+    return None
+
+#notionと連携していないユーザーへの返信を作成する
+def create_not_linked_message(username):
+    return templates.MESSAGE.render(content=f"{username}はnotionと連携していません。notionと連携するには、/notion-registerコマンドを実行してください。")
+
+#notionへの登録結果から、(返信, 作成したページのID)を返す 登録に失敗したらページのIDはNone
+#(同期版と非同期版で共通 保存などの書き込みは呼び出し側で行う)
+def register_outcome(register_result,action_name,start_time):
+    log.event('register_result', status=register_result.status_code)
+    log.payload('register_result', register_result.text)
+    if not register_result.ok:
+        #ページができていないので、終了ボタンつきの「開始しました」は返さない
+        return ACT_FAILED_MESSAGE, None
+    return create_action_message(action_name,start_time), register_result.json()["id"]
+
+#アクション開始時の返信のテンプレート
+#終了ボタンのコンポーネントとembedの固定部分は読み込み時に一度だけシリアライズする
+ACTION_MESSAGE = templates.Template({
+    "content": "新しいアクションを開始しました。",
+    "embeds": [
+        {
+            "title": "新しいアクション",
+            "description": "",
+            "color": 0x0060ff,
+            "fields": [
+                {
+                    "name": "アクションの名前",
+                    "value": templates.slot("action_name"),
+                    "inline": False
+                },
+                {
+                    "name": "開始時刻",
+                    "value": templates.slot("start_time"),
+                    "inline": False
+                }
+            ]
+        }
+    ],
+    "components": [
+        {
+            "type": 1, #1: action row https://discord.com/developers/docs/interactions/message-components#action-rows
+            "components": [
+                {
+                    #終了ボタン
+                    "type": 2, #2: button https://discord.com/developers/docs/interactions/message-components#buttons
+                    "style": 2, #2: danger
+                    "label": "アクションを終了",
+                    "custom_id": "end"
+                }
+            ]
+        }
+    ]
+})
+
+#アクション開始時の返信を作成する
+def create_action_message(action_name,start_time):
+    return ACTION_MESSAGE.render(action_name=(action_name if action_name != "" else "(未登録)"), start_time=start_time)
+
+#固定の文言の返信
+ACT_FAILED_MESSAGE = templates.message("notionへのアクションの登録に失敗しました。")
+NOT_FOUND_MESSAGE = templates.message("終了するアクションが見つかりませんでした。")
+FINISH_FAILED_MESSAGE = templates.message("notionのアクションの更新に失敗しました。")
+
+#アクションを終了する処理本体
+#進行中のアクションのページを1回のPATCHで更新し、discordへ返すメッセージを作成する
+def finish_action(user_id,origin_interaction_id,form,deadline=None):
+    token = gettoken(user_id)
+    active = active_actions.get_active_action(user_id,origin_interaction_id) if origin_interaction_id else None
+    if token == None or active == None:
+        return NOT_FOUND_MESSAGE
+    data, finished = finish_outcome(notion_finish_action(token,active["page_id"],form["action_name"],form["start_time_ISO8601"],form["end_time_ISO8601"],note=form["note"],category_id=form["category_id"],deadline=deadline),form)
+    if finished:
+        active_actions.delete_active_action(user_id,origin_interaction_id)
+        #/report用の日ごとの集計に、このアクションの分を足す
+        record_rollup(user_id,active["page_id"],form)
+    return data
+
+#notionの更新結果から、(返信, 更新できたか)を返す
+def finish_outcome(finish_result,form):
+    log.event('finish_result', status=finish_result.status_code)
+    if not finish_result.ok:
+        return FINISH_FAILED_MESSAGE, False
+    return create_finished_message(form["action_name"],form["start_time"],form["end_time"]), True
+
+#終了したアクションを日ごとの集計(rollups)に足す
+#カテゴリ名はフォームを作ったときに読んだカテゴリのキャッシュから引く(なければ名前なしで足し、/reportで名前不明と表示する)
+def record_rollup(user_id,page_id,form):
+    category_name = categories.cached_name(user_id,form["category_id"]) if form["category_id"] else None
+    rollups.record_action_safely(user_id,page_id,form["start_time_ISO8601"],form["end_time_ISO8601"],form["category_id"],category_name)
+
+#アクション終了時の返信のテンプレート(終了ボタンは消す)
+FINISHED_MESSAGE = templates.Template({
+    "content": "アクションを終了しました。",
+    "embeds": [
+        {
+            "title": "アクションを終了しました",
+            "description": "",
+            "color": 0x00b050,
+            "fields": [
+                {
+                    "name": "アクションの名前",
+                    "value": templates.slot("action_name"),
+                    "inline": False
+                },
+                {
+                    "name": "開始時刻",
+                    "value": templates.slot("start_time"),
+                    "inline": True
+                },
+                {
+                    "name": "終了時刻",
+                    "value": templates.slot("end_time"),
+                    "inline": True
+                }
+            ]
+        }
+    ],
+    "components": []
+})
+
+#アクション終了時の返信を作成する
+def create_finished_message(action_name,start_time,end_time):
+    return FINISHED_MESSAGE.render(action_name=(action_name if action_name != "" else "(未登録)"), start_time=start_time, end_time=end_time)
+
+#start_actionの非同期版
+#sendを渡すと、notionへの登録のあとの進行中のアクションの保存と、discordへの返信(send(data))を同時に待つ
+#profileを渡すと(振り分けるときに読み済みなら)、Table Storageを読まない
+#resumeとcheck_notionはstart_actionと同じ
+async def start_action_async(user_id,username,action_name,start_time,interaction_id,deadline=None,send=None,profile=None,resume=False,check_notion=False):
+    if profile is None:
+        profile = await aio.to_thread(get_profile,user_id,ACT_FIELDS)
+    token = profile["notion_access_token"] if profile else None
+    pending = []
+    page_id = None
+    if token != None and resume:
+        page_id = await aio.to_thread(find_registered_page,user_id,token,profile["action_page_id"],interaction_id,check_notion=check_notion,deadline=deadline)
+    if token == None:
+        data = create_not_linked_message(username)
+    elif page_id is not None:
+        log.event('act resumed', interaction_id=interaction_id)
+        data = create_action_message(action_name,start_time)
+        pending.append(aio.to_thread(active_actions.save_active_action_safely,user_id,interaction_id,page_id,action_name,start_time))
+    else:
+        data, page_id = register_outcome(await notion_register_action_async(token,profile["action_page_id"],action_name,start_time,interaction_id,deadline=deadline),action_name,start_time)
+        if page_id is not None:
+            pending.append(aio.to_thread(active_actions.save_active_action_safely,user_id,interaction_id,page_id,action_name,start_time))
+            autocomplete.record(user_id,action_name)
+    if send:
+        pending.append(send(data))
+    await asyncio.gather(*pending)
+    return data
+
+#finish_actionの非同期版
+#tokenと進行中のアクションは同時に読み、notionの更新のあとの行の削除とdiscordへの返信(send(data))も同時に待つ
+async def finish_action_async(user_id,origin_interaction_id,form,deadline=None,send=None):
+    if origin_interaction_id:
+        token, active = await asyncio.gather(
+            aio.to_thread(gettoken,user_id),
+            aio.to_thread(active_actions.get_active_action,user_id,origin_interaction_id)
+        )
+    else:
+        token, active = None, None
+    pending = []
+    if token == None or active == None:
+        data = NOT_FOUND_MESSAGE
+    else:
+        data, finished = finish_outcome(await notion_finish_action_async(token,active["page_id"],form["action_name"],form["start_time_ISO8601"],form["end_time_ISO8601"],note=form["note"],category_id=form["category_id"],deadline=deadline),form)
+        if finished:
+            pending.append(aio.to_thread(active_actions.delete_active_action,user_id,origin_interaction_id))
+            pending.append(aio.to_thread(record_rollup,user_id,active["page_id"],form))
+    if send:
+        pending.append(send(data))
+    await asyncio.gather(*pending)
+    return data
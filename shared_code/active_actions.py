@@ -0,0 +1,63 @@
+import logging
+from azure.common import AzureMissingResourceHttpError
+from azure.cosmosdb.table.models import Entity
+from shared_code import storage
+from shared_code import timing
+
+#進行中のアクションを、開始したinteraction(/act)のIDで引けるようにしておくテーブル
+#PartitionKeyはdiscordのuser_id、RowKeyは/actのinteraction ID
+#終了ボタンやモーダルの送信時に、notionのデータベースを検索せずに1回の読み込みでページを特定できる
+ACTIVE_TABLE_NAME = "ActiveActions"
+
+#notionにアクションを登録したときに呼ぶ
+@timing.timed("storage", call="table")
+def save_active_action(user_id,interaction_id,page_id,action_name,start_time):
+    table_service = storage.ensure_table(ACTIVE_TABLE_NAME)
+    entity = Entity()
+    entity.PartitionKey = user_id
+    entity.RowKey = interaction_id
+    entity.page_id = page_id
+    entity.action_name = action_name
+    entity.start_time = start_time
+    table_service.insert_or_replace_entity(ACTIVE_TABLE_NAME, entity)
+
+#save_active_actionの失敗で、notionへの登録まで済んだ/actを失敗させない
+#(失敗を返すと再送でページが二重に作られる 行がなければ、終了ボタンで「見つかりませんでした」と返すだけで済む)
+def save_active_action_safely(user_id,interaction_id,page_id,action_name,start_time):
+    try:
+        save_active_action(user_id,interaction_id,page_id,action_name,start_time)
+        return True
+    except Exception as e:
+        logging.error('active action save failed : '+interaction_id+' '+type(e).__name__+' '+str(e))
+        return False
+
+#進行中のアクションを取得する なければNoneを返す
+@timing.timed("storage", call="table")
+def get_active_action(user_id,interaction_id):
+    table_service = storage.ensure_table(ACTIVE_TABLE_NAME)
+    try:
+        entity = table_service.get_entity(ACTIVE_TABLE_NAME, user_id, interaction_id, select="page_id,action_name,start_time")
+    except AzureMissingResourceHttpError:
+        return None
+    return {
+        "page_id": entity.get("page_id"),
+        "action_name": entity.get("action_name"),
+        "start_time": entity.get("start_time")
+    }
+
+#アクションが終了したら消す
+@timing.timed("storage", call="table")
+def delete_active_action(user_id,interaction_id):
+    table_service = storage.ensure_table(ACTIVE_TABLE_NAME)
+    try:
+        table_service.delete_entity(ACTIVE_TABLE_NAME, user_id, interaction_id)
+    except AzureMissingResourceHttpError:
+        pass
+
+#ボタンが押されたメッセージを作成したinteraction(/act)のIDを返す
+def origin_interaction_id(interaction):
+    message = interaction.get("message") or {}
+    origin = message.get("interaction_metadata") or message.get("interaction")
+    if not origin:
+        return None
+    return origin["id"]
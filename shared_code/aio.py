@@ -0,0 +1,17 @@
+import asyncio
+import functools
+from shared_code import timing
+from shared_code import settings
+
+#関数のmainを同期(def)で動かすか、非同期(async def)で動かすか
+#  EXECUTION_MODE=sync  : これまで通り、外部への呼び出しごとにワーカーのスレッドを1つ使う
+#  EXECUTION_MODE=async : notionやdiscordへのHTTPはaiohttpで待ち、独立した呼び出しは同時に待つ
+#同じホストで両方を切り替えて比べられるよう、各関数はmain_syncとmain_asyncを持ち、mainはこの設定で決まる
+EXECUTION_MODE = settings.EXECUTION_MODE
+ASYNC = EXECUTION_MODE == "async"
+
+#同期の関数(Table Storageなど非同期のクライアントがないもの)をスレッドで動かして待つ
+#呼び出し元のinteractionの記録(timing)を引き継ぐ
+async def to_thread(func,*args,**kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, timing.bind(functools.partial(func, *args, **kwargs)))
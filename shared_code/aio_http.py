@@ -0,0 +1,97 @@
+import time
+import json
+import asyncio
+import aiohttp
+import requests
+from urllib.parse import urlsplit
+from shared_code import http_client
+from shared_code import circuit_breaker
+from shared_code import timing
+
+#http_clientの非同期版(aiohttp)
+#タイムアウト・締め切り・サーキットブレーカー・呼び出しの記録は同期版と同じように扱い、
+#エラーも同期版と同じrequestsの例外にして返すので、呼び出し側は同じexceptで扱える
+
+#イベントループで共有するセッション
+#一度つないだapi.notion.comやdiscord.comへのコネクションをkeep-aliveで使い回す
+#(セッションは作ったイベントループでしか使えないので、ループが変わったら作り直す)
+_session = None
+_session_loop = None
+
+def get_session():
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=http_client.POOL_CONNECTIONS * http_client.POOL_MAXSIZE, limit_per_host=http_client.POOL_MAXSIZE)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+#requests.Responseと同じように使える、読み終えたレスポンス
+class Response:
+    def __init__(self,url,status_code,headers,content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(f"{self.status_code} for url: {self.url}", response=self)
+
+#共有セッションでリクエストを送り、bodyまで読んだResponseを返す
+#deadline(time.monotonic()基準の締め切り時刻)を渡すと、全体のタイムアウトを締め切りまでの残り時間にする
+async def request(method,url,deadline=None,timeout=None,**kwargs):
+    timeout = timeout or (http_client.CONNECT_TIMEOUT, http_client.READ_TIMEOUT)
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    total = None
+    if deadline is not None:
+        total = deadline - time.monotonic()
+        if total <= 0:
+            raise http_client.DeadlineExceeded(url)
+    host = urlsplit(url).hostname
+    breaker = circuit_breaker.get(host)
+    if not breaker.allow():
+        raise circuit_breaker.CircuitOpen(host)
+    timing.count_call(host)
+    client_timeout = aiohttp.ClientTimeout(total=total, sock_connect=connect_timeout, sock_read=read_timeout)
+    try:
+        with timing.stage(host):
+            async with get_session().request(method, url, timeout=client_timeout, **kwargs) as response:
+                content = await response.read()
+    except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+        #接続の段階の失敗 リクエストは相手に届いていない
+        breaker.record_failure()
+        raise http_client.ConnectFailed(url) from e
+    except asyncio.TimeoutError as e:
+        breaker.record_failure()
+        raise requests.exceptions.Timeout(url) from e
+    except aiohttp.ClientError as e:
+        breaker.record_failure()
+        raise requests.exceptions.ConnectionError(url) from e
+    except BaseException:
+        #キャンセル(asyncio.CancelledError)などはホストの失敗ではないので数えないが、half-openの試しの枠は返す
+        breaker.release_trial()
+        raise
+    if response.status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return Response(url, response.status, response.headers, content)
+
+#notion APIにリクエストを送る pathは"/pages"のような/v1以下のパス
+async def notion_request(method,path,token,deadline=None,**kwargs):
+    headers = http_client.notion_headers(token)
+    headers.update(kwargs.pop("headers", {}))
+    return await request(method, http_client.NOTION_API_BASE+path, deadline=deadline, headers=headers, **kwargs)
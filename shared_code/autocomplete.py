@@ -0,0 +1,125 @@
+import time
+import bisect
+import calendar
+import logging
+import threading
+from shared_code.cache import TTLCache
+from shared_code import settings
+
+#/actのアクション名の補完(autocomplete)用に、ユーザーごとの最近のアクション名をメモリに持っておく
+#キーストロークごとに呼ばれるので、notionには問い合わせずに前方一致で返す
+#最初はアクションデータベースの最近のページから作り、以降はnotion_register_actionが成功するたびに追加する
+INDEX_SIZE = settings.AUTOCOMPLETE_INDEX_SIZE
+#discordのautocompleteで返せる候補の上限
+CHOICE_LIMIT = 25
+#候補のnameとvalueの文字数の上限 1つでも超えると、discordは候補全体を受け付けない
+CHOICE_MAX_LENGTH = 100
+#インデックスの作成(notionの読み込み)に失敗したあと、もう一度試すまでの秒数
+#(notionの障害中に、キーストロークごとに読み込みを始めない)
+SEED_RETRY_INTERVAL = settings.AUTOCOMPLETE_SEED_RETRY_INTERVAL
+
+class PrefixIndex:
+    def __init__(self,maxsize=INDEX_SIZE):
+        self.maxsize = maxsize
+        #小文字にしたアクション名 -> (表示用の名前, 最後に使った時刻)
+        self._names = {}
+        #小文字にしたアクション名のソート済みリスト 前方一致はbisectで探す
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def add(self,name,used_at=None):
+        name = name.strip()
+        #候補として返せない長さの名前は入れない(途中で切ると、違う名前のアクションとして登録されてしまう)
+        if not name or len(name) > CHOICE_MAX_LENGTH:
+            return
+        key = name.lower()
+        used_at = used_at if used_at is not None else time.time()
+        with self._lock:
+            if key in self._names:
+                if self._names[key][1] > used_at:
+                    return
+            else:
+                bisect.insort(self._keys, key)
+            self._names[key] = (name, used_at)
+            #上限を超えたら、最も古いものから捨てる
+            if len(self._keys) > self.maxsize:
+                oldest = min(self._names, key=lambda k: self._names[k][1])
+                del self._names[oldest]
+                self._keys.pop(bisect.bisect_left(self._keys, oldest))
+
+    #prefixで始まるアクション名を、最近使った順に返す
+    def search(self,prefix,limit=CHOICE_LIMIT):
+        prefix = prefix.strip().lower()
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            matches = []
+            for key in self._keys[start:]:
+                if not key.startswith(prefix):
+                    break
+                matches.append(self._names[key])
+        matches.sort(key=lambda item: item[1], reverse=True)
+        return [name for name, used_at in matches[:limit]]
+
+_indexes = TTLCache(maxsize=settings.AUTOCOMPLETE_CACHE_SIZE, ttl=settings.AUTOCOMPLETE_CACHE_TTL)
+#作成に失敗したユーザー SEED_RETRY_INTERVALの間は作成を始めない
+_failed = TTLCache(maxsize=settings.AUTOCOMPLETE_CACHE_SIZE, ttl=SEED_RETRY_INTERVAL)
+#作成中のユーザー(同じユーザーの作成を重ねて始めないため)
+_seeding = set()
+_seeding_lock = threading.Lock()
+
+#ユーザーのインデックスを返す まだなければ、裏で作成を始めてNoneを返す
+def get_index(user_id):
+    index = _indexes.get(user_id)
+    if index is None and _failed.get(user_id) is None:
+        seed_async(user_id)
+    return index
+
+#アクション名の候補を返す
+def suggest(user_id,prefix):
+    index = get_index(user_id)
+    if index is None:
+        return []
+    return index.search(prefix)
+
+#アクションを登録したときに呼ぶ
+def record(user_id,action_name):
+    index = _indexes.get(user_id)
+    if index is not None:
+        index.add(action_name)
+
+def seed_async(user_id):
+    with _seeding_lock:
+        if user_id in _seeding:
+            return
+        _seeding.add(user_id)
+    threading.Thread(target=_seed, args=(user_id,), daemon=True).start()
+
+#アクションデータベースの最近のページ(最大100件)からインデックスを作る
+def _seed(user_id):
+    #notionやTable Storageを使うのはここだけなので、候補を返す処理のために読み込まない
+    from shared_code.notion_api import query_database, page_title
+    from shared_code import user_profile
+    try:
+        index = PrefixIndex()
+        token = user_profile.gettoken(user_id)
+        database_id = user_profile.get_database_id(user_id)
+        if token and database_id and database_id["action_page_id"]:
+            pages = query_database(database_id["action_page_id"], token, sorts=[{"timestamp": "created_time", "direction": "descending"}])
+            for count, page in enumerate(pages):
+                if count >= 100:
+                    break
+                index.add(page_title(page), _created_at(page))
+        _indexes.set(user_id, index)
+    except Exception as e:
+        logging.error(e)
+        _failed.set(user_id, True)
+    finally:
+        with _seeding_lock:
+            _seeding.discard(user_id)
+
+def _created_at(page):
+    #"2023-01-01T00:00:00.000Z"の形式
+    try:
+        return calendar.timegm(time.strptime(page["created_time"][:19], "%Y-%m-%dT%H:%M:%S"))
+    except (KeyError, ValueError):
+        return 0
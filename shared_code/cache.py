@@ -0,0 +1,45 @@
+import time
+import threading
+from collections import OrderedDict
+
+#プロセス内で使う、件数の上限と有効期限(TTL)つきのLRUキャッシュ
+#同期関数はスレッドプールで並行に動くので、ロックをとって操作する
+class TTLCache:
+    def __init__(self,maxsize,ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    #キーに対応する値を返す なければ、または期限切れならNoneを返す
+    def get(self,key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            #最近使ったものとして末尾に移動する
+            self._data.move_to_end(key)
+            return value
+
+    def set(self,key,value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            #上限を超えたら、最も長く使われていないものから捨てる
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self,key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,101 @@
+import time
+import datetime
+from shared_code.cache import TTLCache
+from shared_code.notion_api import query_database, page_title
+from shared_code import settings
+
+#ユーザーごとに、notionのカテゴリデータベースの内容(カテゴリの木)をキャッシュする
+#REFRESH_INTERVAL秒ごとに、前回から更新されたページだけをlast_edited_timeで絞り込んで取得する
+#アーカイブ(削除)されたページはqueryで返らないので、最後に全件読んでからCACHE_TTL秒たったら全件読み直す
+#(差分を読むたびにキャッシュの期限は延びるので、全件読んだ時刻(loaded)を木に持っておいて判断する)
+REFRESH_INTERVAL = settings.CATEGORY_REFRESH_INTERVAL
+CACHE_TTL = settings.CATEGORY_CACHE_TTL
+#親カテゴリを表すrelationプロパティの名前
+PARENT_PROPERTY = settings.CATEGORY_PARENT_PROPERTY
+#discordのセレクトメニューに並べられる選択肢の上限
+SELECT_OPTION_LIMIT = 25
+
+_trees = TTLCache(maxsize=settings.CATEGORY_CACHE_SIZE, ttl=CACHE_TTL)
+
+#notionのページからカテゴリの情報を取り出す
+def _category(page):
+    parent = page["properties"].get(PARENT_PROPERTY)
+    parent_id = None
+    if parent and parent["type"] == "relation" and parent["relation"]:
+        parent_id = parent["relation"][0]["id"]
+    return {
+        "id": page["id"],
+        "name": page_title(page),
+        "parent_id": parent_id
+    }
+
+#カテゴリの木を返す {"categories": {id: category}, "synced_at": 最後に読んだ時刻(ISO8601), "checked": time.monotonic(), "loaded": 全件読んだtime.monotonic()}
+def get_tree(user_id,token,database_id,deadline=None):
+    tree = _trees.get(user_id)
+    if tree is not None and time.monotonic() - tree["checked"] < REFRESH_INTERVAL:
+        return tree
+    if tree is not None and time.monotonic() - tree["loaded"] >= CACHE_TTL:
+        #消されたカテゴリを落とすため、全件読み直す
+        tree = None
+    #notionのlast_edited_timeは分単位に丸められるので、少し前から読み直す
+    now = datetime.datetime.now(datetime.timezone.utc)
+    synced_at = (now - datetime.timedelta(minutes=1)).isoformat()
+    if tree is None:
+        categories = {}
+        loaded = time.monotonic()
+        pages = query_database(database_id, token, deadline=deadline)
+    else:
+        loaded = tree["loaded"]
+        categories = dict(tree["categories"])
+        pages = query_database(database_id, token, deadline=deadline, filter={
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": tree["synced_at"]}
+        })
+    for page in pages:
+        category = _category(page)
+        categories[category["id"]] = category
+    tree = {"categories": categories, "synced_at": synced_at, "checked": time.monotonic(), "loaded": loaded}
+    _trees.set(user_id, tree)
+    return tree
+
+#キャッシュにあるカテゴリの名前を返す notionには問い合わせない(なければNone)
+def cached_name(user_id,category_id):
+    tree = _trees.get(user_id)
+    if tree is None or category_id not in tree["categories"]:
+        return None
+    return tree["categories"][category_id]["name"]
+
+#キャッシュを捨てる(次は全件読み直す)
+def invalidate(user_id):
+    _trees.invalidate(user_id)
+
+#notionからカテゴリのリストを取得する
+#parent_idが指定されていない場合は、rootになっているカテゴリのみ、指定されている場合はその子カテゴリを返す
+def get_category_list(user_id,token,database_id,parent_id=None,deadline=None):
+    categories = get_tree(user_id, token, database_id, deadline=deadline)["categories"]
+    children = [c for c in categories.values() if c["parent_id"] == parent_id]
+    return sorted(children, key=lambda c: c["name"])
+
+#セレクトメニュー用に、カテゴリの木を親から順に並べた選択肢を返す
+#子カテゴリのラベルは「親 > 子」の形にする
+def get_category_options(user_id,token,database_id,deadline=None):
+    categories = get_tree(user_id, token, database_id, deadline=deadline)["categories"]
+    children = {}
+    for category in categories.values():
+        parent_id = category["parent_id"] if category["parent_id"] in categories else None
+        children.setdefault(parent_id, []).append(category)
+    options = []
+    #親子関係が循環していても止まるように、たどったカテゴリを覚えておく
+    seen = set()
+    def walk(parent_id,prefix):
+        for category in sorted(children.get(parent_id, []), key=lambda c: c["name"]):
+            if len(options) >= SELECT_OPTION_LIMIT:
+                return
+            if category["id"] in seen:
+                continue
+            seen.add(category["id"])
+            label = prefix + category["name"]
+            options.append({"label": label[:100], "value": category["id"]})
+            walk(category["id"], label+" > ")
+    walk(None, "")
+    return options
@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+import requests
+from shared_code import log
+from shared_code import settings
+
+#ホストごとのサーキットブレーカー
+#連続して失敗(タイムアウト・接続エラー・5xx)したホストへは、しばらくリクエストを送らずにすぐ失敗させる
+#  closed    : 通常どおり送る
+#  open      : RESET_TIMEOUT秒の間は送らずにCircuitOpenを送出する
+#  half-open : RESET_TIMEOUT秒たったら1回だけ試し、成功すればclosed、失敗すればまたopenにする
+#              試しの結果がRESET_TIMEOUT秒たっても記録されなければ(キャンセルなど)、もう1回試す
+FAILURE_THRESHOLD = settings.CIRCUIT_FAILURE_THRESHOLD
+RESET_TIMEOUT = settings.CIRCUIT_RESET_TIMEOUT
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+#ブレーカーが開いているため送らなかったときの例外
+#接続エラーの一種として扱えるよう、requestsのConnectionErrorを継承する
+class CircuitOpen(requests.exceptions.ConnectionError):
+    def __init__(self,host):
+        super().__init__("circuit open : "+str(host))
+        self.host = host
+
+class CircuitBreaker:
+    def __init__(self,host,threshold=FAILURE_THRESHOLD,reset_timeout=RESET_TIMEOUT):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self._lock = threading.Lock()
+
+    #送ってよければTrueを返す half-openでは試しの1回だけを通す
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.trial_started_at = now
+                return True
+            if self.state == HALF_OPEN and now - self.trial_started_at >= self.reset_timeout:
+                self.trial_started_at = now
+                return True
+            return False
+
+    #送ったリクエストが、ホストの成否と関係なく終わった(キャンセル・requests以外の例外)ときに呼ぶ
+    #half-openの試しだったなら、すぐに次の試しを通せるようにする
+    def release_trial(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.trial_started_at = time.monotonic() - self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.event('circuit closed', host=self.host)
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    log.event('circuit opened', host=self.host, failures=self.failures, level=logging.WARNING)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+#ホストのブレーカーを返す(プロセスで共有する)
+def get(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+        return breaker
+
+#ホストごとの状態を返す
+def get_states():
+    with _breakers_lock:
+        return {host: breaker.state for host, breaker in _breakers.items()}
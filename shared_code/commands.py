@@ -0,0 +1,46 @@
+import time
+import azure.functions as func
+from shared_code import verifier
+from shared_code import templates
+from shared_code import log
+from shared_code import settings
+from shared_code.router import Router, SYNC, json_response
+
+#discord-notion-register・discord-notion-handler・HttpTrigger1で共通のハンドラー
+
+#pingの場合
+def ping(ctx):
+    return templates.PONG
+
+#/settoken : notionのtokenを登録する
+def settoken(ctx,token):
+    #Table Storage(azure.cosmosdb.table)はsettokenを初めて受け取ったときに読み込む(pingでは読み込まない)
+    from shared_code import user_profile
+    username = ctx.username
+    if user_profile.settoken(username,ctx.user_id,token):
+        content_text = f"{username}のtokenを登録しました。"
+    else:
+        content_text = f"{username}のtokenの登録に失敗しました。"
+    log.event('response', content=content_text)
+    return templates.response(4, templates.message(content_text)) #4: channel message with source
+
+#discord-notion-handlerとHttpTrigger1(pingと/settokenだけを受ける以前のエンドポイント)の振り分け先
+#どちらもその場で処理して返す
+legacy_router = Router(default_mode=SYNC)
+legacy_router.route(1, blocking=False)(ping) #1: ping https://discord.com/developers/docs/interactions/receiving-and-responding#interaction-object-interaction-type
+
+#以前のエンドポイントの/settokenは、tokenをサブコマンドのオプションに入れて送ってくる
+@legacy_router.route(2, "settoken")
+def legacy_settoken(ctx):
+    return settoken(ctx, ctx.data["options"][0]["options"][0]["value"])
+
+#以前のエンドポイントのリクエストを検証し、legacy_routerで振り分けてレスポンスを返す
+def handle_legacy(req):
+    interaction, error = verifier.read_interaction(req)
+    if error:
+        return error
+    deadline = time.monotonic() + settings.INTERACTION_DEADLINE
+    body = legacy_router.dispatch(interaction, None, deadline)
+    if body is None:
+        return func.HttpResponse("Unknown interaction", status_code=400)
+    return json_response(body)
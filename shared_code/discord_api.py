@@ -0,0 +1,48 @@
+import json
+from shared_code import http_client
+from shared_code import settings
+
+#ローカルでの負荷試験ではスタブのサーバーに向ける
+DISCORD_API_BASE = settings.DISCORD_API_BASE
+
+#interactionのwebhookのURLを作成する
+#deferred(type 5)で返したあとは、このURLで最初の返信を書き換える
+def interaction_webhook_url(application_id,interaction_token):
+    return DISCORD_API_BASE+"/webhooks/"+application_id+"/"+interaction_token+"/messages/@original"
+
+#deferredで返したinteractionの返信内容を書き換える
+#dataはinteraction responseの"data"と同じ形式(content, embeds, components)
+#テンプレートでシリアライズ済みのbytesはそのまま送る
+def edit_original_response(application_id,interaction_token,data):
+    url = interaction_webhook_url(application_id,interaction_token)
+    if not isinstance(data, bytes):
+        data = json.dumps(data,ensure_ascii=False).encode("utf-8")
+    response = http_client.request("PATCH", url, data=data, headers={'Content-Type': 'application/json'})
+    return response
+
+#botからユーザーにDMを送る
+#DMのチャンネルを作成(既にあればそれが返る)してからメッセージを送信する
+def send_direct_message(user_id,content):
+    headers = settings.discord_bot_headers()
+    response = http_client.request("POST", DISCORD_API_BASE+"/users/@me/channels", headers=headers, data=json.dumps({"recipient_id": user_id}))
+    response.raise_for_status()
+    channel_id = response.json()["id"]
+    response = http_client.request("POST", DISCORD_API_BASE+"/channels/"+channel_id+"/messages", headers=headers, data=json.dumps({"content": content},ensure_ascii=False).encode("utf-8"))
+    return response
+
+#edit_original_responseの非同期版
+async def edit_original_response_async(application_id,interaction_token,data):
+    from shared_code import aio_http
+    url = interaction_webhook_url(application_id,interaction_token)
+    if not isinstance(data, bytes):
+        data = json.dumps(data,ensure_ascii=False).encode("utf-8")
+    return await aio_http.request("PATCH", url, data=data, headers={'Content-Type': 'application/json'})
+
+#send_direct_messageの非同期版
+async def send_direct_message_async(user_id,content):
+    from shared_code import aio_http
+    headers = settings.discord_bot_headers()
+    response = await aio_http.request("POST", DISCORD_API_BASE+"/users/@me/channels", headers=headers, data=json.dumps({"recipient_id": user_id}))
+    response.raise_for_status()
+    channel_id = response.json()["id"]
+    return await aio_http.request("POST", DISCORD_API_BASE+"/channels/"+channel_id+"/messages", headers=headers, data=json.dumps({"content": content},ensure_ascii=False).encode("utf-8"))
@@ -0,0 +1,36 @@
+import datetime
+
+#discordのフォーム(モーダル)の入力値を扱う処理
+#重いライブラリに依存しないので、HTTPトリガーのホットパスからそのまま読み込める
+
+#アクション登録フォーム(action_register_modal)の送信内容から入力値を取り出す
+#テキスト入力はaction row(type 1)の中、カテゴリのセレクトメニューはlabel(type 18)の中にある
+def parse_action_form(data):
+    values = {}
+    for row in data.get("components", []):
+        if row["type"] == 1:
+            components = row["components"]
+        elif row["type"] == 18:
+            components = [row["component"]]
+        else:
+            continue
+        for component in components:
+            if component["type"] == 3:
+                values[component["custom_id"]] = component.get("values", [])
+            else:
+                values[component["custom_id"]] = component.get("value", "")
+    category = values.get("category_select") or []
+    return {
+        "action_name": values.get("action_name_input", ""),
+        "start_time": values.get("start_time_input", ""),
+        "end_time": values.get("end_time_input", ""),
+        "note": values.get("note_input", ""),
+        "category_id": category[0] if category else None
+    }
+
+#yyyy/mm/dd HH:MM:SSの文字列をISO8601形式に変換する 書式が違えばNoneを返す
+def to_ISO8601(time_text):
+    try:
+        return datetime.datetime.strptime(time_text.strip(), '%Y/%m/%d %H:%M:%S').isoformat()
+    except ValueError:
+        return None
@@ -0,0 +1,103 @@
+import time
+import requests
+import urllib3
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from shared_code import timing
+from shared_code import circuit_breaker
+from shared_code import settings
+
+#ローカルでの負荷試験ではスタブのサーバーに向ける
+NOTION_API_BASE = settings.NOTION_API_BASE
+NOTION_VERSION = "2022-06-28"
+
+#接続タイムアウトと読み込みタイムアウト(秒) 環境変数で変更できる
+CONNECT_TIMEOUT = settings.HTTP_CONNECT_TIMEOUT
+READ_TIMEOUT = settings.HTTP_READ_TIMEOUT
+#ホストごとに保持するコネクション数と、コネクションプールを持つホストの数
+POOL_MAXSIZE = settings.HTTP_POOL_MAXSIZE
+POOL_CONNECTIONS = settings.HTTP_POOL_CONNECTIONS
+
+#ワーカープロセスで共有するセッション
+#一度つないだapi.notion.comやdiscord.comへのコネクションをkeep-aliveで使い回す
+_session = None
+
+def get_session():
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+#締め切りを過ぎていて送れなかったときの例外(タイムアウトの一種として扱う)
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+#接続できなかった(名前解決・接続の拒否など)ときの例外 リクエストは相手に届いていない
+class ConnectFailed(requests.exceptions.ConnectionError):
+    pass
+
+#リクエストが相手に届く前に失敗した例外か
+#(接続できなかった・接続がタイムアウトした・締め切りを過ぎていた・サーキットブレーカーが開いていた)
+#これらはPOSTでも送り直してよい 読み込みのタイムアウトなどは、相手が処理を終えている可能性がある
+def not_sent(error):
+    return isinstance(error, (ConnectFailed, requests.exceptions.ConnectTimeout, DeadlineExceeded, circuit_breaker.CircuitOpen))
+
+#requestsのConnectionErrorのうち、接続の段階で失敗したもの
+def _connect_failed(error):
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+#共有セッションでリクエストを送る timeoutを指定しなければデフォルトのタイムアウトを使う
+#deadline(time.monotonic()基準の締め切り時刻)を渡すと、タイムアウトを締め切りまでの残り時間に縮める
+#(読み込みタイムアウトは1回の受信ごとの待ち時間なので、合計時間の目安として使う)
+#ホストのサーキットブレーカーが開いているときは送らずにcircuit_breaker.CircuitOpenを送出する
+def request(method,url,deadline=None,**kwargs):
+    timeout = kwargs.pop("timeout", None) or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(url)
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    #ホストごとに所要時間と呼び出し回数を記録する
+    host = urlsplit(url).hostname
+    breaker = circuit_breaker.get(host)
+    if not breaker.allow():
+        raise circuit_breaker.CircuitOpen(host)
+    timing.count_call(host)
+    try:
+        with timing.stage(host):
+            response = get_session().request(method, url, timeout=(connect_timeout, read_timeout), **kwargs)
+    except requests.exceptions.RequestException as e:
+        breaker.record_failure()
+        if isinstance(e, requests.exceptions.ConnectionError) and _connect_failed(e):
+            raise ConnectFailed(url) from e
+        raise
+    except BaseException:
+        #ホストの失敗ではないので数えないが、half-openの試しの枠は返す
+        breaker.release_trial()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+#notion APIの共通ヘッダー
+def notion_headers(token):
+    return {
+        "Authorization": "Bearer "+token,
+        "Content-Type": "application/json",
+        "Notion-Version": NOTION_VERSION
+    }
+
+#notion APIにリクエストを送る pathは"/pages"のような/v1以下のパス
+def notion_request(method,path,token,deadline=None,**kwargs):
+    headers = notion_headers(token)
+    headers.update(kwargs.pop("headers", {}))
+    return request(method, NOTION_API_BASE+path, deadline=deadline, headers=headers, **kwargs)
@@ -0,0 +1,142 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError, AzureException
+from azure.cosmosdb.table.models import Entity
+from azure.cosmosdb.table.tablebatch import TableBatch
+from shared_code.cache import TTLCache
+from shared_code import storage
+from shared_code import timing
+from shared_code import settings
+
+#同じinteraction(再送されたもの)を二重に処理しないためのガード
+#まずプロセス内のキャッシュを見て、なければTable Storageへの条件付き挿入(既にあれば失敗する)で最初の1回だけを通す
+#処理が終わったらレスポンスを保存し、再送にはそれをそのまま返す
+#ハンドラーが失敗したときはrelease()で印を消し、再送をもう一度処理できるようにする
+INTERACTIONS_TABLE_NAME = "Interactions"
+#discordのinteraction tokenの有効期限は15分なので、それより長く覚えておく必要はない
+TTL = settings.IDEMPOTENCY_CACHE_TTL
+_seen = TTLCache(maxsize=settings.IDEMPOTENCY_CACHE_SIZE, ttl=TTL)
+#処理中の印がこの秒数より古ければ、受け取ったインスタンスが落ちたものとみなして横取りする
+#(discordは3秒以内の返信を求めるので、それより長く処理中のままのinteractionは返信されていない)
+CLAIM_TIMEOUT = settings.IDEMPOTENCY_CLAIM_TIMEOUT
+#処理中でレスポンスがまだない状態
+_PENDING = ""
+
+#PartitionKeyは、interaction IDに含まれる作成時刻を10分ごとに区切ったもの(例: "202410181230")
+#古いパーティションから順に範囲クエリで見つけて消せる(cleanup)
+BUCKET_SECONDS = 600
+#discordのIDの時刻の基準(2015-01-01T00:00:00Z)のミリ秒
+DISCORD_EPOCH = 1420070400000
+
+def partition_key(interaction_id):
+    created = ((int(interaction_id) >> 22) + DISCORD_EPOCH) / 1000
+    return time.strftime("%Y%m%d%H%M", time.gmtime(created - created % BUCKET_SECONDS))
+
+#レスポンスの保存はdiscordへの返信を待たせないよう、別のスレッドで行う
+_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="idempotency")
+
+def _entity(interaction_id,response):
+    entity = Entity()
+    entity.PartitionKey = partition_key(interaction_id)
+    entity.RowKey = interaction_id
+    entity.response = response
+    entity.claimed_at = time.time()
+    return entity
+
+#interactionを処理してよいかを返す
+#(True, None) : 初めてのinteractionなので処理する
+#(False, response) : 再送なので処理しない responseは保存済みのレスポンス(まだ処理中ならNone)
+def claim(interaction_id):
+    #このインスタンスで受け取ったことがあれば、Table Storageは読まない
+    cached = _seen.get(interaction_id)
+    if cached is not None:
+        return False, (cached or None)
+    table_service = storage.ensure_table(INTERACTIONS_TABLE_NAME)
+    timing.count_call("table")
+    try:
+        with timing.stage("storage"):
+            table_service.insert_entity(INTERACTIONS_TABLE_NAME, _entity(interaction_id, _PENDING))
+    except AzureConflictHttpError:
+        #他のインスタンスが先に受け取っている
+        claimed, response = _existing_claim(table_service, interaction_id)
+        if not claimed:
+            return claimed, response
+    except Exception as e:
+        #Table Storageに書けなくても、interactionの処理は止めない
+        logging.error(e)
+    #処理中の印は、このインスタンスが受け取ったときだけキャッシュする
+    #(他のインスタンスが処理しているものをキャッシュすると、保存されたレスポンスを読まずに返し続けてしまう)
+    _seen.set(interaction_id, _PENDING)
+    return True, None
+
+#既にある行を読み、レスポンスがあれば返す
+#処理中のままCLAIM_TIMEOUTを過ぎていれば、etagを条件に書き換えて処理を引き継ぐ
+@timing.timed("storage", call="table")
+def _existing_claim(table_service,interaction_id):
+    try:
+        entity = table_service.get_entity(INTERACTIONS_TABLE_NAME, partition_key(interaction_id), interaction_id)
+    except AzureMissingResourceHttpError:
+        #挿入と読み込みの間に消された(release)
+        return True, None
+    response = entity.get("response") or None
+    if response:
+        _seen.set(interaction_id, response)
+        return False, response
+    if time.time() - float(entity.get("claimed_at") or 0) < CLAIM_TIMEOUT:
+        return False, None
+    try:
+        table_service.update_entity(INTERACTIONS_TABLE_NAME, _entity(interaction_id, _PENDING), if_match=entity.etag)
+    except AzureException:
+        #他のインスタンスが先に引き継いだ
+        return False, None
+    logging.warning('stale interaction claim taken over : '+interaction_id)
+    return True, None
+
+#処理したinteractionのレスポンス(bodyの文字列)を保存する
+#プロセス内のキャッシュはすぐに更新し、Table Storageへの書き込みは返信を待たせずに行う
+def remember_response(interaction_id,body):
+    _seen.set(interaction_id, body)
+    #(関数の記録は返信までで終わっているので、この書き込みは記録に含めない)
+    _writer.submit(_write_response, interaction_id, body)
+
+def _write_response(interaction_id,body):
+    try:
+        storage.ensure_table(INTERACTIONS_TABLE_NAME).insert_or_replace_entity(INTERACTIONS_TABLE_NAME, _entity(interaction_id, body))
+    except Exception as e:
+        logging.error(e)
+
+#ハンドラーが失敗したときに呼び、処理中の印を消す(再送をもう一度処理できるようにする)
+@timing.timed("storage", call="table")
+def release(interaction_id):
+    _seen.invalidate(interaction_id)
+    try:
+        storage.ensure_table(INTERACTIONS_TABLE_NAME).delete_entity(INTERACTIONS_TABLE_NAME, partition_key(interaction_id), interaction_id)
+    except AzureMissingResourceHttpError:
+        pass
+    except Exception as e:
+        logging.error(e)
+
+#TTLより古いパーティションの行を消す(interactions-cleanupのタイマーから呼ぶ) 消した行数を返す
+#パーティションは時刻順なので、PartitionKeyの範囲クエリで古い行だけを読む
+def cleanup(limit=1000):
+    table_service = storage.ensure_table(INTERACTIONS_TABLE_NAME)
+    cutoff = time.strftime("%Y%m%d%H%M", time.gmtime(time.time() - TTL - BUCKET_SECONDS))
+    rows = table_service.query_entities(INTERACTIONS_TABLE_NAME, filter=f"PartitionKey lt '{cutoff}'", select="PartitionKey,RowKey", num_results=limit)
+    groups = {}
+    for row in rows:
+        groups.setdefault(row["PartitionKey"], []).append(row["RowKey"])
+    deleted = 0
+    for partition, row_keys in groups.items():
+        #entity group transactionは同じパーティションの100行まで
+        for i in range(0, len(row_keys), 100):
+            batch = TableBatch()
+            for row_key in row_keys[i:i + 100]:
+                batch.delete_entity(partition, row_key)
+            try:
+                table_service.commit_batch(INTERACTIONS_TABLE_NAME, batch)
+                deleted += len(row_keys[i:i + 100])
+            except AzureException as e:
+                #他のインスタンスが同時に消していたら、次の回に残りを消す
+                logging.warning(e)
+    return deleted
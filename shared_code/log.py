@@ -0,0 +1,64 @@
+import json
+import random
+import logging
+from shared_code import settings
+
+#ホットパス用の軽いログ出力
+#  - 文字列の組み立ては、そのレベルのログが実際に出力されるときだけ行う(%sの遅延フォーマット)
+#  - tokenなどの秘密情報は伏せ字にする
+#  - interactionの中身などの大きなダンプは、DEBUGのときにLOG_PAYLOAD_SAMPLE_RATEの割合だけ出す
+logger = logging.getLogger("actiluca")
+logger.setLevel(settings.LOG_LEVEL)
+
+PAYLOAD_SAMPLE_RATE = settings.LOG_PAYLOAD_SAMPLE_RATE
+#値を伏せるキー
+SECRET_KEYS = {"token", "access_token", "notion_access_token", "interaction_token", "authorization", "password", "secret"}
+MASK = "***"
+
+#秘密情報を伏せたコピーを返す
+#{"name": "token", "value": ...}の形(slash commandのオプション)の値も伏せる
+def redact(value):
+    if isinstance(value, dict):
+        if str(value.get("name", "")).lower() in SECRET_KEYS and "value" in value:
+            value = dict(value, value=MASK)
+        return {k: (MASK if str(k).lower() in SECRET_KEYS else redact(v)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+#ログが出力されるときに初めて、伏せ字にしたJSONへ変換する
+class Redacted:
+    __slots__ = ("value",)
+
+    def __init__(self,value):
+        self.value = value
+
+    def __str__(self):
+        if isinstance(self.value, (bytes, str)):
+            try:
+                value = json.loads(self.value)
+            except ValueError:
+                return "<"+str(len(self.value))+" bytes>"
+        else:
+            value = self.value
+        return json.dumps(redact(value), ensure_ascii=False, default=str)
+
+#ログが出力されるときに初めて、key=valueの形に変換する
+class Fields:
+    __slots__ = ("fields",)
+
+    def __init__(self,fields):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(f"{k}={MASK if k.lower() in SECRET_KEYS else v}" for k, v in self.fields.items())
+
+#構造化されたイベントのログ 例: log.event("act deferred", interaction_id=...)
+def event(message,level=logging.INFO,**fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", message, Fields(fields))
+
+#interactionやリクエストbodyなどの大きなダンプ DEBUGかつサンプリングに当たったときだけ出す
+def payload(label,value):
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_SAMPLE_RATE:
+        logger.debug("%s : %s", label, Redacted(value))
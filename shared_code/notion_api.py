@@ -0,0 +1,139 @@
+import json
+import datetime
+from shared_code import notion_scheduler
+from shared_code import log
+
+#notionにアクションを登録する
+#deadlineはtime.monotonic()基準の締め切り時刻(レート制限の待ちや再送はそれまでに打ち切る)
+def notion_register_action(token,database_id,action_name,start_time,intaraction_id,deadline=None):
+    body = _register_action_body(database_id,action_name,start_time,intaraction_id)
+    response = notion_scheduler.request("POST", "/pages", token, deadline=deadline, data=body)
+    return response
+
+#notion_register_actionの非同期版
+async def notion_register_action_async(token,database_id,action_name,start_time,intaraction_id,deadline=None):
+    body = _register_action_body(database_id,action_name,start_time,intaraction_id)
+    return await notion_scheduler.request_async("POST", "/pages", token, deadline=deadline, data=body)
+
+#アクションを登録するリクエストのbody
+def _register_action_body(database_id,action_name,start_time,intaraction_id):
+    #start_timeは開始時刻(yyyy/mm/dd HH:MM:SS)の文字列なので、ISO8601形式に変換する
+    start_time_ISO8601 = datetime.datetime.strptime(start_time, '%Y/%m/%d %H:%M:%S').isoformat()
+    body = json.dumps({
+    "parent": {
+        "database_id": database_id
+        },
+    "properties": {
+        "アクション名" : {
+            "type": "title",
+            "title": [{
+                "text": {"content": action_name}
+            }]
+        },
+        "時刻" : {
+            "date": {"start": start_time_ISO8601}
+        },
+        "ステータス" :{
+            "status": {"name": "進行中"}
+        },
+        "インタラクションID":{
+            "rich_text": [{"type": "text","text": {"content": intaraction_id}}]
+        }
+        }
+    }
+    )
+    log.payload('notion register action body', body)
+    return body
+
+
+#アクションを終了する
+#日時の範囲・ステータス・アクション名・備考・カテゴリを1回のPATCHでまとめて更新する
+#start_time_ISO8601とend_time_ISO8601は変換済みのISO8601の文字列
+def notion_finish_action(token,page_id,action_name,start_time_ISO8601,end_time_ISO8601,note="",category_id=None,deadline=None):
+    body = _finish_action_body(action_name,start_time_ISO8601,end_time_ISO8601,note,category_id)
+    response = notion_scheduler.request("PATCH", f"/pages/{page_id}", token, deadline=deadline, data=body)
+    return response
+
+#notion_finish_actionの非同期版
+async def notion_finish_action_async(token,page_id,action_name,start_time_ISO8601,end_time_ISO8601,note="",category_id=None,deadline=None):
+    body = _finish_action_body(action_name,start_time_ISO8601,end_time_ISO8601,note,category_id)
+    return await notion_scheduler.request_async("PATCH", f"/pages/{page_id}", token, deadline=deadline, data=body)
+
+#アクションを終了するリクエストのbody
+def _finish_action_body(action_name,start_time_ISO8601,end_time_ISO8601,note,category_id):
+    properties = {
+        "アクション名" : {
+            "title": [{"text": {"content": action_name}}]
+        },
+        "時刻" : {
+            "date": {"start": start_time_ISO8601, "end": end_time_ISO8601}
+        },
+        "ステータス" :{
+            "status": {"name": "完了"}
+        },
+        "備考" : {
+            "rich_text": [{"type": "text","text": {"content": note}}] if note else []
+        }
+    }
+    if category_id:
+        properties["カテゴリ"] = {"relation": [{"id": category_id}]}
+    return json.dumps({"properties": properties})
+
+#next_cursorをたどって読むAPI(1回で返ってくるのは最大100件)の、1回分の指定を返す
+#extraの値が空のもの(filterやsortの指定なし)は含めない
+def page_params(start_cursor=None,**extra):
+    params = {"page_size": 100}
+    params.update({key: value for key, value in extra.items() if value})
+    if start_cursor:
+        params["start_cursor"] = start_cursor
+    return params
+
+#next_cursorをたどって読むAPIの応答から、(結果のリスト, 続きのstart_cursor)を返す 最後まで読んだらstart_cursorはNone
+def read_page(response):
+    response.raise_for_status()
+    response_json = response.json()
+    return response_json["results"], (response_json["next_cursor"] if response_json.get("has_more") else None)
+
+#ブロックの子ブロックをすべて取得する
+#1回で返ってくるのは最大100件なので、next_cursorをたどって最後まで読む
+def list_block_children(block_id,token,deadline=None):
+    results = []
+    start_cursor = None
+    while True:
+        response = notion_scheduler.request("GET", f"/blocks/{block_id}/children", token, deadline=deadline, params=page_params(start_cursor))
+        page, start_cursor = read_page(response)
+        results.extend(page)
+        if start_cursor is None:
+            return results
+
+#list_block_childrenの非同期版
+async def list_block_children_async(block_id,token,deadline=None):
+    results = []
+    start_cursor = None
+    while True:
+        response = await notion_scheduler.request_async("GET", f"/blocks/{block_id}/children", token, deadline=deadline, params=page_params(start_cursor))
+        page, start_cursor = read_page(response)
+        results.extend(page)
+        if start_cursor is None:
+            return results
+
+#データベースのページを順に返す
+#1回で返ってくるのは最大100件なので、next_cursorをたどって最後まで読む
+#filterやsortsはnotionのdatabase queryの形式で指定する
+def query_database(database_id,token,filter=None,sorts=None,deadline=None):
+    start_cursor = None
+    while True:
+        payload = page_params(start_cursor, filter=filter, sorts=sorts)
+        response = notion_scheduler.request("POST", f"/databases/{database_id}/query", token, deadline=deadline, data=json.dumps(payload))
+        page, start_cursor = read_page(response)
+        for result in page:
+            yield result
+        if start_cursor is None:
+            return
+
+#ページのタイトル(type: titleのプロパティ)の文字列を返す
+def page_title(page):
+    for prop in page["properties"].values():
+        if prop["type"] == "title":
+            return "".join(text["plain_text"] for text in prop["title"])
+    return ""
@@ -0,0 +1,210 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import requests
+from shared_code import http_client
+from shared_code import circuit_breaker
+from shared_code.cache import TTLCache
+from shared_code import timing
+from shared_code import settings
+
+#notion APIはインテグレーション(ワークスペース)ごとに平均3リクエスト/秒の制限がある
+#tokenごとにトークンバケットを持ち、制限を超えないように送信を待たせる
+RATE_PER_SECOND = settings.NOTION_RATE_PER_SECOND
+BURST = settings.NOTION_RATE_BURST
+#429や5xxのときに再送する回数と、バックオフの基準秒数(ページの作成などは429と接続の失敗のときだけ再送する)
+MAX_RETRIES = settings.NOTION_MAX_RETRIES
+BACKOFF_BASE = settings.NOTION_BACKOFF_BASE
+#deadlineが指定されないときの猶予(秒)
+DEFAULT_BUDGET = settings.NOTION_DEFAULT_BUDGET
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+#POSTでも、読むだけなので何度送ってもよいパス(ページの作成などは、送り直すと重複して作られることがある)
+READ_ONLY_POSTS = ("/search", "/query")
+
+#締め切りまでにnotionから応答を得られなかったときの例外
+#(レート制限で送れなかった、タイムアウトした、サーキットブレーカーが開いていた)
+#sentは、リクエストがnotionに届いて処理された可能性があるか
+#(Trueなら、ページの作成などは既にできているかもしれないので、送り直す前に確かめる)
+class NotionUnavailable(Exception):
+    def __init__(self,message,sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+#送り直しても結果が変わらないリクエストか
+def idempotent(method,path):
+    return method != "POST" or path.endswith(READ_ONLY_POSTS)
+
+class TokenBucket:
+    def __init__(self,rate,capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    #1回分の送信枠を予約し、送信できるまで待つべき秒数を返す
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    #待てなかった予約を返す
+    def cancel(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    #429を受け取ったときに、指定秒数は送信しないようにする
+    def pause(self,seconds):
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+_buckets = TTLCache(maxsize=4096, ttl=3600)
+_buckets_lock = threading.Lock()
+
+_counters = {"requests": 0, "queued": 0, "throttled": 0, "retried": 0, "gave_up": 0}
+_counters_lock = threading.Lock()
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+#キュー待ち・429・再送の回数を返す
+def get_counters():
+    with _counters_lock:
+        return dict(_counters)
+
+def _bucket(token):
+    with _buckets_lock:
+        bucket = _buckets.get(token)
+        if bucket is None:
+            bucket = TokenBucket(RATE_PER_SECOND, BURST)
+            _buckets.set(token, bucket)
+        return bucket
+
+#Retry-Afterヘッダーの秒数を返す なければNone
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+#送信枠を予約し、送信できるまで待つべき秒数を返す
+#締め切りまでに待ちきれなければ予約を返してNotionUnavailableを送出する
+def _reserve(bucket,path,deadline):
+    wait = bucket.reserve()
+    if wait > 0:
+        _count("queued")
+        if time.monotonic() + wait >= deadline:
+            bucket.cancel()
+            _count("gave_up")
+            logging.warning('notion request gave up waiting for rate limit : '+path)
+            raise NotionUnavailable(path)
+    return wait
+
+#送信に失敗した(例外が出た)ときに、再送までに待つ秒数を返す 再送しないならNotionUnavailableを送出する
+#ページの作成など送り直すと重複するリクエストは、notionに届く前の失敗(接続できなかったなど)のときだけ再送する
+def _delay_after_error(error,method,path,attempt,deadline):
+    if isinstance(error, circuit_breaker.CircuitOpen):
+        #notionが落ちている間は待たずにすぐ諦める
+        _count("gave_up")
+        raise NotionUnavailable(path) from error
+    sent = not http_client.not_sent(error)
+    logging.warning('notion request failed : '+path+' '+type(error).__name__)
+    if sent and not idempotent(method, path):
+        _count("gave_up")
+        raise NotionUnavailable(path, sent=True) from error
+    #タイムアウトや接続エラー 締め切りまでに余裕があれば再送する
+    delay = random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+    if attempt == MAX_RETRIES or time.monotonic() + delay >= deadline:
+        _count("gave_up")
+        raise NotionUnavailable(path, sent=sent) from error
+    _count("retried")
+    return delay
+
+#応答を受け取ったときに、再送までに待つ秒数を返す そのまま返してよい応答ならNoneを返す
+#再送しても締め切りに間に合わないならNotionUnavailableを送出する
+#送り直すと重複するリクエストは、429(処理されていない)のときだけ再送し、5xxはNotionUnavailable(sent=True)にする
+def _delay_after_response(response,bucket,method,path,attempt,deadline):
+    if response.status_code not in RETRY_STATUS:
+        return None
+    #5xxはnotionが処理を終えたあとに返していることもある
+    sent = response.status_code != 429
+    if attempt == MAX_RETRIES or (sent and not idempotent(method, path)):
+        _count("gave_up")
+        raise NotionUnavailable(path+" status "+str(response.status_code), sent=sent)
+    retry_after = None
+    if response.status_code == 429:
+        _count("throttled")
+        retry_after = _retry_after(response)
+    #Retry-Afterがあればその秒数、なければ指数バックオフ + ジッター
+    delay = retry_after if retry_after is not None else random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+    if time.monotonic() + delay >= deadline:
+        _count("gave_up")
+        raise NotionUnavailable(path+" status "+str(response.status_code), sent=sent)
+    _count("retried")
+    logging.info('notion request retry : '+path+' status '+str(response.status_code))
+    if retry_after is not None:
+        #同じtokenの他のリクエストも止める 待つのは次の_reserve()で行う
+        bucket.pause(retry_after)
+        return 0.0
+    return delay
+
+#notion APIにリクエストを送る
+#deadlineはtime.monotonic()基準の締め切り時刻 それを超えて待つ・再送することはしない
+#締め切りまでに429や5xx以外の応答を得られなかった場合(再送しても429や5xxが続いた場合も)はNotionUnavailableを送出し、
+#呼び出し側がキューに回したり、キュートリガーが再試行したりできるようにする
+#待つ・再送するかの判断は_reserve/_delay_after_error/_delay_after_responseで行い、ここでは送信と待ちだけを行う
+def request(method,path,token,deadline=None,**kwargs):
+    if deadline is None:
+        deadline = time.monotonic() + DEFAULT_BUDGET
+    bucket = _bucket(token)
+    for attempt in range(MAX_RETRIES + 1):
+        wait = _reserve(bucket, path, deadline)
+        if wait > 0:
+            with timing.stage("notion_rate_limit_wait"):
+                time.sleep(wait)
+        _count("requests")
+        try:
+            response = http_client.notion_request(method, path, token, deadline=deadline, **kwargs)
+        except (circuit_breaker.CircuitOpen, requests.exceptions.RequestException) as e:
+            delay = _delay_after_error(e, method, path, attempt, deadline)
+        else:
+            delay = _delay_after_response(response, bucket, method, path, attempt, deadline)
+            if delay is None:
+                return response
+        if delay > 0:
+            with timing.stage("notion_backoff"):
+                time.sleep(delay)
+
+#requestの非同期版(aio_http) 待ちはasyncio.sleepで行い、イベントループを止めない
+async def request_async(method,path,token,deadline=None,**kwargs):
+    from shared_code import aio_http
+    if deadline is None:
+        deadline = time.monotonic() + DEFAULT_BUDGET
+    bucket = _bucket(token)
+    for attempt in range(MAX_RETRIES + 1):
+        wait = _reserve(bucket, path, deadline)
+        if wait > 0:
+            with timing.stage("notion_rate_limit_wait"):
+                await asyncio.sleep(wait)
+        _count("requests")
+        try:
+            response = await aio_http.notion_request(method, path, token, deadline=deadline, **kwargs)
+        except (circuit_breaker.CircuitOpen, requests.exceptions.RequestException) as e:
+            delay = _delay_after_error(e, method, path, attempt, deadline)
+        else:
+            delay = _delay_after_response(response, bucket, method, path, attempt, deadline)
+            if delay is None:
+                return response
+        if delay > 0:
+            with timing.stage("notion_backoff"):
+                await asyncio.sleep(delay)
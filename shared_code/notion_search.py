@@ -0,0 +1,61 @@
+import json
+import time
+from shared_code import notion_scheduler
+from shared_code.cache import TTLCache
+from shared_code.notion_api import page_title, page_params, read_page
+from shared_code import settings
+
+#notionの/searchでページを探す処理
+#結果はnext_cursorをたどって1ページ(100件)ずつ読み、タイトルが完全に一致するページが見つかった時点で読むのをやめる
+#(一致するページがないときに全件を読まないよう、MAX_PAGESページで打ち切る)
+#完全に一致したページのIDは(ワークスペース, 検索語)ごとにキャッシュし、同じページを探すときはnotionに問い合わせない
+#キャッシュしたページIDを使って404が返ってきたときは、使った側がforgetを呼んでキャッシュから消す
+CACHE_TTL = settings.NOTION_SEARCH_CACHE_TTL
+CACHE_SIZE = settings.NOTION_SEARCH_CACHE_SIZE
+#一致するページを探すときに読む、検索結果のページ数の上限(1ページ100件)
+MAX_PAGES = settings.NOTION_SEARCH_MAX_PAGES
+
+_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+
+#検索結果のページを順に返す
+#filterはnotionの/searchの形式 1回で返ってくるのは最大100件なので、next_cursorをたどって続きを読む
+#max_pagesを渡すと、そのページ数だけ読んでやめる
+def search(token,query,filter=None,sort=None,deadline=None,max_pages=None):
+    start_cursor = None
+    pages = 0
+    while True:
+        payload = page_params(start_cursor, filter=filter, sort=sort)
+        payload["query"] = query
+        response = notion_scheduler.request("POST", "/search", token, deadline=deadline, data=json.dumps(payload))
+        page, start_cursor = read_page(response)
+        for result in page:
+            yield result
+        pages += 1
+        if start_cursor is None or (max_pages and pages >= max_pages):
+            return
+
+#タイトルがtitleのページのIDを返す 見つからなければNoneを返す
+#完全に一致するページがなければ、notionが最初に返したページにする
+#ただし一致しなかったときの結果はキャッシュしない(次に探すときには一致するページができているかもしれない)
+#workspaceはキャッシュのキー(notionのworkspace_id) 渡さなければtoken(tokenはワークスペースごとに発行される)で分ける
+#deadline(time.monotonic()基準)は検索のすべてのページで共有する
+def find_page_id(token,title,workspace=None,deadline=None):
+    key = (workspace or token, title)
+    page_id = _cache.get(key)
+    if page_id is not None:
+        return page_id
+    if deadline is None:
+        deadline = time.monotonic() + notion_scheduler.DEFAULT_BUDGET
+    first = None
+    pages = search(token, title, filter={"property": "object", "value": "page"}, sort={"direction": "ascending", "timestamp": "last_edited_time"}, deadline=deadline, max_pages=MAX_PAGES)
+    for page in pages:
+        if first is None:
+            first = page["id"]
+        if page_title(page) == title:
+            _cache.set(key, page["id"])
+            return page["id"]
+    return first
+
+#キャッシュしたページIDを使って、そのページが見つからなかった(404)ときに呼び、キャッシュから消す
+def forget(token,title,workspace=None):
+    _cache.invalidate((workspace or token, title))
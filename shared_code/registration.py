@@ -0,0 +1,202 @@
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from azure.common import AzureMissingResourceHttpError
+from azure.cosmosdb.table.models import Entity
+from shared_code.notion_api import list_block_children, list_block_children_async
+from shared_code import user_profile
+from shared_code import storage
+from shared_code import discord_api
+from shared_code import timing
+from shared_code import aio
+from shared_code import settings
+
+#notionのOAuthが終わったあとの登録処理
+#リダイレクトではtokenの交換だけ行って保留中の登録として保存し、
+#テンプレートの探索とNotionTokenテーブルへの登録はキュートリガー(discord-notion-worker)で行う
+PENDING_TABLE_NAME = "PendingRegistrations"
+
+#notionの認証のstate discordのuser_idを暗号化して入れ、リダイレクトで復号してどのユーザーの認証かを知る
+def encrypt_state(user_id):
+    return settings.get_fernet().encrypt(user_id.encode('utf-8')).decode('utf-8')
+
+def decrypt_state(state):
+    return settings.get_fernet().decrypt(state.encode('utf-8')).decode('utf-8')
+
+#tokenの交換結果を保留中の登録として保存する
+@timing.timed("storage", call="table")
+def save_pending_registration(user_id,notion_info):
+    table_service = storage.ensure_table(PENDING_TABLE_NAME)
+    entity = Entity()
+    entity.PartitionKey = "notion"
+    entity.RowKey = user_id
+    entity.notion_info = json.dumps(notion_info,ensure_ascii=False)
+    table_service.insert_or_replace_entity(PENDING_TABLE_NAME, entity)
+
+#保留中の登録(tokenの交換結果)を読む なければNoneを返す
+@timing.timed("storage", call="table")
+def load_pending_registration(user_id):
+    table_service = storage.ensure_table(PENDING_TABLE_NAME)
+    try:
+        entity = table_service.get_entity(PENDING_TABLE_NAME, "notion", user_id)
+    except AzureMissingResourceHttpError:
+        return None
+    return json.loads(entity.notion_info)
+
+@timing.timed("storage", call="table")
+def delete_pending_registration(user_id):
+    storage.ensure_table(PENDING_TABLE_NAME).delete_entity(PENDING_TABLE_NAME, "notion", user_id)
+
+REGISTERED_MESSAGE = "notionとの連携が完了しました。/actコマンドでアクションを記録できます。"
+REGISTER_FAILED_MESSAGE = "notionとの連携に失敗しました。テンプレートを複製したか確認して、もう一度/notion-registerコマンドからやり直してください。"
+
+#保留中の登録を完了させ、結果をdiscordのDMで知らせる
+def complete_registration(user_id):
+    notion_info = load_pending_registration(user_id)
+    if notion_info is None:
+        #同じメッセージが2回処理された場合など
+        logging.warning('pending registration not found : '+user_id)
+        return False
+    if set_notion_info(user_id,notion_info):
+        delete_pending_registration(user_id)
+        content = REGISTERED_MESSAGE
+        result = True
+    else:
+        content = REGISTER_FAILED_MESSAGE
+        result = False
+    try:
+        discord_api.send_direct_message(user_id,content)
+    except Exception as e:
+        logging.error(e)
+    return result
+
+#complete_registrationの非同期版
+#テンプレートの探索は同じ階層のブロックを同時に待ち、登録後の保留中の行の削除とDMも同時に待つ
+async def complete_registration_async(user_id):
+    notion_info = await aio.to_thread(load_pending_registration,user_id)
+    if notion_info is None:
+        logging.warning('pending registration not found : '+user_id)
+        return False
+    try:
+        databases = await get_notion_page_async(notion_info["duplicated_template_id"],notion_info["access_token"])
+        result = await aio.to_thread(set_notion_info,user_id,notion_info,databases)
+    except Exception as e:
+        logging.error(e)
+        result = False
+    pending = [discord_api.send_direct_message_async(user_id,REGISTERED_MESSAGE if result else REGISTER_FAILED_MESSAGE)]
+    if result:
+        pending.append(aio.to_thread(delete_pending_registration,user_id))
+    for error in await asyncio.gather(*pending, return_exceptions=True):
+        if isinstance(error, Exception):
+            logging.error(error)
+    return result
+
+#notionのアクセストークンなどの情報をDBに登録する関数
+#databases(get_notion_pageの結果)を渡さなければ、ここでテンプレートを探索する
+def set_notion_info(user_id,notion_info,databases=None):
+    try:
+        #tokenをDBに登録する
+        #DBに登録するためのオブジェクトを作成
+        table_name = storage.TABLE_NAME
+        #共有のtableserviceオブジェクトを使う(テーブルの存在確認は一度だけ行われる)
+        table_service = storage.get_table_service()
+        #エンティティを作成
+        entity = Entity()
+        entity.PartitionKey = storage.partition_key(user_id)
+        entity.RowKey = user_id
+        #'dict' object has no attribute 'owner'というエラーが出るので、なにかまちがってる
+        entity.notion_user_id = notion_info["owner"]["user"]["id"]
+        entity.notion_access_token = notion_info["access_token"]
+        entity.workspace_name = notion_info["workspace_name"]
+        entity.workspace_icon = notion_info["workspace_icon"]
+        entity.workspace_id = notion_info["workspace_id"]
+        entity.bot_id = notion_info["bot_id"]
+        entity.duplicated_template_id = notion_info["duplicated_template_id"]
+        if databases is None:
+            databases = get_notion_page(entity.duplicated_template_id,notion_info["access_token"])
+        entity.action_page_id = databases["action_page_id"]
+        entity.category_page_id = databases["category_page_id"]
+        entity.task_page_id = databases["task_page_id"]
+        #エンティティを登録または置換
+        table_service.insert_or_replace_entity(table_name, entity)
+        #キャッシュされているプロフィールを捨てる
+        user_profile.invalidate(user_id)
+        return True
+    except Exception as e:
+        logging.error(e)
+        return False
+
+#テンプレートのデータベースを見分けるためのタイトル(部分一致、大文字小文字は区別しない)
+DATABASE_TITLES = {
+    "action_page_id": ["アクション", "action"],
+    "category_page_id": ["カテゴリ", "category"],
+    "task_page_id": ["タスク", "task"]
+}
+#子ブロックを同時に取得する数 notionのレート制限(3リクエスト/秒)に合わせて小さくしている
+DISCOVERY_CONCURRENCY = settings.NOTION_DISCOVERY_CONCURRENCY
+#ルートページから何階層下までデータベースを探すか
+DISCOVERY_MAX_DEPTH = 3
+
+#データベースのタイトルから、どのデータベースかを返す(見分けられなければNone)
+def classify_database(title):
+    title = title.lower()
+    for key, words in DATABASE_TITLES.items():
+        if any(word.lower() in title for word in words):
+            return key
+    return None
+
+#1つの階層の子ブロック(ブロックごとのlist_block_childrenの結果)を見て、
+#見分けたテンプレートのデータベースをdatabasesに加え、次の階層でたどるブロックのIDを返す
+def classify_level(children_by_block,databases):
+    next_level = []
+    for children in children_by_block:
+        for block in children:
+            if block["type"] == "child_database":
+                key = classify_database(block["child_database"]["title"])
+                if key and key not in databases:
+                    databases[key] = block["id"]
+            #ページやデータベースの中までは探さない(カラムなどのレイアウト用のブロックだけたどる)
+            elif block.get("has_children") and block["type"] != "child_page":
+                next_level.append(block["id"])
+    return next_level
+
+#探索をやめてよいか(すべて見つかった、これ以上たどるブロックがない)
+def discovery_done(databases,next_level):
+    return len(databases) == len(DATABASE_TITLES) or not next_level
+
+#見つからなかったデータベースがあればValueErrorを送出する
+def check_databases(databases):
+    missing = [key for key in DATABASE_TITLES if key not in databases]
+    if missing:
+        raise ValueError("notionテンプレートのデータベースが見つかりません : "+",".join(missing))
+    return databases
+
+#ルートページ以下のブロックをたどって、アクション・カテゴリ・タスクのデータベースのIDを取得する関数
+#同じ階層の子ブロックはまとめて並行に取得するので、かかる時間は階層ごとに一番遅い1回分になる
+def get_notion_page(page_id,token):
+    databases = {}
+    level = [page_id]
+    with ThreadPoolExecutor(max_workers=DISCOVERY_CONCURRENCY) as executor:
+        for depth in range(DISCOVERY_MAX_DEPTH):
+            #スレッドプールの中の呼び出しも、同じinteractionの記録に数える
+            level = classify_level(executor.map(timing.bind(lambda block_id: list_block_children(block_id, token)), level), databases)
+            if discovery_done(databases, level):
+                break
+    # 取得した各ページのIDを返す
+    return check_databases(databases)
+
+#get_notion_pageの非同期版
+#同じ階層の子ブロックは、DISCOVERY_CONCURRENCYずつ同時に待つ
+async def get_notion_page_async(page_id,token):
+    databases = {}
+    level = [page_id]
+    semaphore = asyncio.Semaphore(DISCOVERY_CONCURRENCY)
+    async def children_of(block_id):
+        async with semaphore:
+            return await list_block_children_async(block_id, token)
+    for depth in range(DISCOVERY_MAX_DEPTH):
+        level = classify_level(await asyncio.gather(*[children_of(block_id) for block_id in level]), databases)
+        if discovery_done(databases, level):
+            break
+    return check_databases(databases)
@@ -0,0 +1,84 @@
+import re
+import datetime
+from shared_code import rollups
+from shared_code import templates
+
+#/report [range] の処理本体
+#日ごとの集計(rollups)を1回の範囲クエリで読むだけで、notionのデータベースは読まない
+
+#rangeの指定 today / yesterday / week(今日までの7日) / month(今日までの30日) / 日数("14") / 期間("2024/01/01-2024/01/31")
+DEFAULT_RANGE = "week"
+NAMED_RANGES = {"today": (0, 0), "yesterday": (1, 1), "week": (6, 0), "month": (29, 0)}
+#一度に集計できる日数の上限
+MAX_DAYS = 366
+#カテゴリ別・日別に並べる行数の上限(embedのフィールドは1024文字まで)
+MAX_LINES = 15
+
+_PERIOD = re.compile(r"(\d{4}/\d{1,2}/\d{1,2})\s*[-~〜]\s*(\d{4}/\d{1,2}/\d{1,2})")
+
+#rangeの文字列から(開始日, 終了日)を返す 読めなければNone
+def parse_range(text,today=None):
+    today = today or datetime.datetime.now().date()
+    text = (text or DEFAULT_RANGE).strip().lower()
+    if text in NAMED_RANGES:
+        start, end = NAMED_RANGES[text]
+        return today - datetime.timedelta(days=start), today - datetime.timedelta(days=end)
+    if text.isdigit() and 1 <= int(text) <= MAX_DAYS:
+        return today - datetime.timedelta(days=int(text) - 1), today
+    match = _PERIOD.fullmatch(text)
+    if match:
+        try:
+            start, end = [datetime.datetime.strptime(value, "%Y/%m/%d").date() for value in match.groups()]
+        except ValueError:
+            return None
+        if start <= end and (end - start).days < MAX_DAYS:
+            return start, end
+    return None
+
+#秒数を「3時間25分」の形にする
+def format_duration(seconds):
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    if hours:
+        return f"{hours}時間{minutes}分"
+    return f"{minutes}分"
+
+def _lines(rows):
+    lines = [f"{name} : {format_duration(seconds)}" for name, seconds in rows[:MAX_LINES]]
+    if len(rows) > MAX_LINES:
+        lines.append(f"ほか{len(rows) - MAX_LINES}件")
+    return "\n".join(lines) or "なし"
+
+#本人にだけ見える集計のメッセージ("data") 固定の部分は読み込み時に一度だけシリアライズする
+REPORT_MESSAGE = templates.Template({
+    "embeds": [
+        {
+            "title": templates.slot("title"),
+            "color": 0x0060ff,
+            "fields": [
+                {"name": "合計", "value": templates.slot("total"), "inline": True},
+                {"name": "アクション数", "value": templates.slot("action_count"), "inline": True},
+                {"name": "カテゴリ別", "value": templates.slot("categories"), "inline": False},
+                {"name": "日別", "value": templates.slot("days"), "inline": False}
+            ]
+        }
+    ],
+    "flags": 64 #64: ephemeral
+})
+BAD_RANGE_MESSAGE = templates.EPHEMERAL_MESSAGE.render(content="期間の指定が正しくありません。(today / yesterday / week / month / 日数 / yyyy/mm/dd-yyyy/mm/dd)")
+
+#/reportの返信("data")を作成する
+def create_report(user_id,range_text=None,today=None):
+    period = parse_range(range_text,today)
+    if period is None:
+        return BAD_RANGE_MESSAGE
+    start, end = period
+    result = rollups.get_report(user_id,start,end)
+    days = [(day.replace("-", "/"), seconds) for day, seconds in sorted(result["days"].items()) if seconds]
+    title = f"{start:%Y/%m/%d}の記録" if start == end else f"{start:%Y/%m/%d} - {end:%Y/%m/%d}の記録"
+    return REPORT_MESSAGE.render(
+        title=title,
+        total=format_duration(result["total_seconds"]),
+        action_count=f"{result['action_count']}件",
+        categories=_lines(result["categories"]),
+        days=_lines(days)
+    )
@@ -0,0 +1,229 @@
+import json
+import logging
+import datetime
+from azure.common import AzureMissingResourceHttpError, AzureException
+from azure.cosmosdb.table.models import Entity
+from azure.cosmosdb.table.tablebatch import TableBatch
+from shared_code import storage
+from shared_code import timing
+
+#アクションの所要時間を、ユーザーごと・日ごとに集計しておくテーブル(/reportはこれを読むだけで、notionは読まない)
+#PartitionKeyはdiscordのuser_id
+#  RowKey "day-yyyy-mm-dd"  : その日の合計秒数(total_seconds)、開始したアクションの数(action_count)、
+#                             カテゴリごとの秒数(categories: {カテゴリのページID: 秒数}のJSON)、カテゴリ名(category_names)
+#  RowKey "action-ページID" : そのアクションがどの日に何秒足されているか(同じアクションを終了し直したときに差し引く)
+#アクションを終了したときに差分だけ足し(record_action)、全体はscripts/backfill_rollups.pyで作り直す
+ROLLUP_TABLE_NAME = "ActionRollups"
+DAY_PREFIX = "day-"
+ACTION_PREFIX = "action-"
+#同じユーザーの行を同時に更新して競合したときに、読み直してやり直す回数
+MAX_CONFLICT_RETRIES = 5
+#カテゴリなし
+NO_CATEGORY = ""
+
+def day_key(day):
+    return DAY_PREFIX+day.isoformat()
+
+def action_key(page_id):
+    return ACTION_PREFIX+page_id
+
+#ISO8601の日時をdatetime(タイムゾーンなし)にする
+#タイムゾーンつき(notionから読んだ値)はUTCにそろえる(/actの時刻はサーバーの時刻=UTCで入力される)
+def parse_time(value):
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+#アクション1件が集計に足す量 {"days": {"yyyy-mm-dd": 秒数}, "start_day": "yyyy-mm-dd", "category_id": ...}
+#日をまたぐアクションは日ごとに分ける 時刻が読めない・終了が開始より前ならNone
+def contribution(start_time_ISO8601,end_time_ISO8601,category_id=None):
+    try:
+        start = parse_time(start_time_ISO8601)
+        end = parse_time(end_time_ISO8601)
+    except (TypeError, ValueError):
+        return None
+    if end < start:
+        return None
+    days = {}
+    current = start
+    while True:
+        next_day = datetime.datetime.combine(current.date() + datetime.timedelta(days=1), datetime.time())
+        until = min(end, next_day)
+        days[current.date().isoformat()] = days.get(current.date().isoformat(), 0) + int((until - current).total_seconds())
+        if until >= end:
+            break
+        current = until
+    return {"days": days, "start_day": start.date().isoformat(), "category_id": category_id or NO_CATEGORY}
+
+#日の行に、アクション1件分を足す(sign=-1なら引く)
+def apply(day_row,day,item,sign=1,category_name=None):
+    seconds = item["days"].get(day, 0)
+    #引く分の行が先に消えていても、負にはしない
+    day_row["total_seconds"] = max(0, day_row.get("total_seconds", 0) + sign * seconds)
+    if item["start_day"] == day:
+        day_row["action_count"] = max(0, day_row.get("action_count", 0) + sign)
+    categories = day_row.setdefault("categories", {})
+    category_id = item["category_id"]
+    categories[category_id] = categories.get(category_id, 0) + sign * seconds
+    if categories[category_id] <= 0:
+        del categories[category_id]
+    if category_name and category_id:
+        day_row.setdefault("category_names", {})[category_id] = category_name
+
+#Table Storageの行を集計の辞書にする
+def _from_entity(entity):
+    return {
+        "total_seconds": entity.get("total_seconds", 0),
+        "action_count": entity.get("action_count", 0),
+        "categories": json.loads(entity.get("categories") or "{}"),
+        "category_names": json.loads(entity.get("category_names") or "{}")
+    }
+
+#集計の辞書をTable Storageの行にする
+def _to_entity(user_id,day,day_row):
+    entity = Entity()
+    entity.PartitionKey = user_id
+    entity.RowKey = day_key(datetime.date.fromisoformat(day))
+    entity.total_seconds = day_row.get("total_seconds", 0)
+    entity.action_count = day_row.get("action_count", 0)
+    entity.categories = json.dumps(day_row.get("categories", {}), ensure_ascii=False)
+    entity.category_names = json.dumps(day_row.get("category_names", {}), ensure_ascii=False)
+    return entity
+
+def _action_entity(user_id,page_id,item):
+    entity = Entity()
+    entity.PartitionKey = user_id
+    entity.RowKey = action_key(page_id)
+    entity.days = json.dumps(item["days"])
+    entity.start_day = item["start_day"]
+    entity.category_id = item["category_id"]
+    return entity
+
+def _get(table_service,user_id,row_key):
+    try:
+        return table_service.get_entity(ROLLUP_TABLE_NAME, user_id, row_key)
+    except AzureMissingResourceHttpError:
+        return None
+
+#アクションを終了したときに呼び、そのアクションの分だけ日ごとの集計を更新する
+#同じアクションをもう一度終了した(時刻やカテゴリを直した)ときは、前回足した分を引いてから足す
+#関係する行はすべて同じパーティションなので、1回のentity group transactionでまとめて書き込み、
+#etagが変わっていれば(同じユーザーの別の更新と競合したら)読み直してやり直す
+@timing.timed("storage", call="table")
+def record_action(user_id,page_id,start_time_ISO8601,end_time_ISO8601,category_id=None,category_name=None):
+    item = contribution(start_time_ISO8601,end_time_ISO8601,category_id)
+    if item is None:
+        return False
+    table_service = storage.ensure_table(ROLLUP_TABLE_NAME)
+    for attempt in range(MAX_CONFLICT_RETRIES):
+        previous = _get(table_service, user_id, action_key(page_id))
+        old = None
+        if previous is not None:
+            old = {"days": json.loads(previous.get("days") or "{}"), "start_day": previous.get("start_day"), "category_id": previous.get("category_id") or NO_CATEGORY}
+            if old == item:
+                return True
+        days = set(item["days"]) | set(old["days"] if old else [])
+        batch = TableBatch()
+        for day in sorted(days):
+            existing = _get(table_service, user_id, day_key(datetime.date.fromisoformat(day)))
+            day_row = _from_entity(existing) if existing is not None else {}
+            if old:
+                apply(day_row, day, old, sign=-1)
+            apply(day_row, day, item, category_name=category_name)
+            entity = _to_entity(user_id, day, day_row)
+            if existing is None:
+                batch.insert_entity(entity)
+            else:
+                batch.update_entity(entity, if_match=existing.etag)
+        if previous is None:
+            batch.insert_entity(_action_entity(user_id, page_id, item))
+        else:
+            batch.update_entity(_action_entity(user_id, page_id, item), if_match=previous.etag)
+        try:
+            table_service.commit_batch(ROLLUP_TABLE_NAME, batch)
+            return True
+        except AzureException as e:
+            logging.warning('rollup update conflict : '+user_id+' attempt '+str(attempt+1)+' '+type(e).__name__)
+    logging.error('rollup update gave up : '+user_id+' '+page_id)
+    return False
+
+#record_actionの失敗でアクションの終了を失敗させない(集計はbackfillで作り直せる)
+def record_action_safely(user_id,page_id,start_time_ISO8601,end_time_ISO8601,category_id=None,category_name=None):
+    try:
+        return record_action(user_id,page_id,start_time_ISO8601,end_time_ISO8601,category_id,category_name)
+    except Exception as e:
+        logging.error(e)
+        return False
+
+#start_dayからend_dayまで(両端を含む)の日の行を、1回の範囲クエリで読んで合計する
+#{"total_seconds", "action_count", "categories": [(カテゴリ名, 秒数), ...(長い順)], "days": {"yyyy-mm-dd": 秒数}}
+@timing.timed("storage", call="table")
+def get_report(user_id,start_day,end_day):
+    table_service = storage.ensure_table(ROLLUP_TABLE_NAME)
+    rows = table_service.query_entities(
+        ROLLUP_TABLE_NAME,
+        filter=f"PartitionKey eq '{user_id}' and RowKey ge '{day_key(start_day)}' and RowKey le '{day_key(end_day)}'"
+    )
+    total = {}
+    names = {}
+    days = {}
+    action_count = 0
+    for entity in rows:
+        day_row = _from_entity(entity)
+        action_count += day_row["action_count"]
+        for category_id, seconds in day_row["categories"].items():
+            total[category_id] = total.get(category_id, 0) + seconds
+        names.update(day_row["category_names"])
+        days[entity["RowKey"][len(DAY_PREFIX):]] = day_row["total_seconds"]
+    categories = [(names.get(category_id) or ("カテゴリなし" if category_id == NO_CATEGORY else "(名前不明のカテゴリ)"), seconds) for category_id, seconds in total.items()]
+    return {
+        "total_seconds": sum(days.values()),
+        "action_count": action_count,
+        "categories": sorted(categories, key=lambda c: -c[1]),
+        "days": days
+    }
+
+#ユーザーの集計をすべて作り直す(scripts/backfill_rollups.pyから呼ぶ)
+#actionsは(ページID, contributionの結果, カテゴリ名)を順に返すイテレーター(notionのページを1ページずつ読みながら渡す)
+#アクションの行は読んだそばからBATCH_LIMIT件ずつ書き込み、メモリには日ごとの集計と書き込んだRowKeyだけを持つ
+#最後に日の行を置き換え、今回出てこなかった行(notionで消したアクションなど)を消す
+BATCH_LIMIT = 100
+
+def rebuild(user_id,actions,dry_run=False):
+    table_service = storage.ensure_table(ROLLUP_TABLE_NAME)
+    day_rows = {}
+    written = set()
+    pending = []
+    count = 0
+    def flush():
+        if pending and not dry_run:
+            batch = TableBatch()
+            for entity in pending:
+                batch.insert_or_replace_entity(entity)
+            table_service.commit_batch(ROLLUP_TABLE_NAME, batch)
+        del pending[:]
+    for page_id, item, category_name in actions:
+        for day in item["days"]:
+            apply(day_rows.setdefault(day, {}), day, item, category_name=category_name)
+        entity = _action_entity(user_id, page_id, item)
+        written.add(entity.RowKey)
+        pending.append(entity)
+        count += 1
+        if len(pending) >= BATCH_LIMIT:
+            flush()
+    for day, day_row in sorted(day_rows.items()):
+        entity = _to_entity(user_id, day, day_row)
+        written.add(entity.RowKey)
+        pending.append(entity)
+        if len(pending) >= BATCH_LIMIT:
+            flush()
+    flush()
+    stale = [entity["RowKey"] for entity in table_service.query_entities(ROLLUP_TABLE_NAME, filter=f"PartitionKey eq '{user_id}'", select="RowKey") if entity["RowKey"] not in written]
+    if not dry_run:
+        for i in range(0, len(stale), BATCH_LIMIT):
+            batch = TableBatch()
+            for row_key in stale[i:i + BATCH_LIMIT]:
+                batch.delete_entity(user_id, row_key)
+            table_service.commit_batch(ROLLUP_TABLE_NAME, batch)
+    return {"actions": count, "days": len(day_rows), "deleted": len(stale)}
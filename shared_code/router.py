@@ -0,0 +1,142 @@
+import logging
+import azure.functions as func
+from shared_code import timing
+from shared_code import log
+
+#interactionを(type, コマンド名またはcustom_id)でハンドラーに振り分ける
+#  router = Router()
+#  @router.route(2, "act", mode=DEFERRED, fields=["notion_access_token"])
+#  def act(ctx):
+#      return body(bytes)
+#ハンドラーごとに、返し方(mode)と使うプロフィールの列(fields)を宣言する
+#  mode   : SYNC ならその場で処理して返す、DEFERRED ならdeferredで返して続きはキューで行う
+#  fields : 振り分ける前に、これらの列をTable Storageから1回で読んでctx.profileに入れる
+
+SYNC = "sync"
+DEFERRED = "deferred"
+
+#ハンドラーに渡す、1つのinteractionの処理に必要なもの
+class Context:
+    __slots__ = ("interaction", "msg", "deadline", "mode", "profile")
+
+    def __init__(self,interaction,msg,deadline,mode,profile=None):
+        self.interaction = interaction
+        self.msg = msg
+        #notionへのリクエストの締め切り時刻(time.monotonic()基準)
+        self.deadline = deadline
+        #このinteractionで実際に使う返し方(SYNCかDEFERRED)
+        self.mode = mode
+        #fieldsを宣言したハンドラーでは、user_profile.get_profileの結果(未登録ならNone)
+        self.profile = profile
+
+    @property
+    def user(self):
+        return self.interaction["member"]["user"]
+
+    @property
+    def user_id(self):
+        return self.user["id"]
+
+    @property
+    def username(self):
+        return self.user["username"]
+
+    @property
+    def data(self):
+        return self.interaction.get("data", {})
+
+    #slash commandの最初のオプションの値(オプションがなければdefault)
+    def option(self,default=None):
+        options = self.data.get("options")
+        if not options:
+            return default
+        return options[0].get("value", default)
+
+class Route:
+    __slots__ = ("type", "name", "handler", "mode", "fields", "blocking", "async_handler")
+
+    def __init__(self,type,name,handler,mode,fields,blocking):
+        self.type = type
+        self.name = name
+        self.handler = handler
+        self.mode = mode
+        self.fields = list(fields)
+        #ハンドラーがTable Storageやnotionを同期で呼ぶか(非同期で動かすときはスレッドで動かす)
+        self.blocking = blocking
+        #非同期で動かすときのハンドラー(route_asyncで登録する)
+        self.async_handler = None
+
+#interactionの振り分け先を決めるキー
+#slash commandとautocompleteはコマンド名、コンポーネントとモーダルはcustom_idの":"より前
+def route_key(interaction):
+    data = interaction.get("data") or {}
+    if interaction["type"] in (2, 4): #2: slash command, 4: autocomplete
+        return data.get("name")
+    if interaction["type"] in (3, 5): #3: component, 5: modal submit
+        return data.get("custom_id", "").split(":", 1)[0]
+    return None
+
+class Router:
+    #default_modeにSYNCを渡すと、DEFERREDを宣言したハンドラーもその場で処理する
+    def __init__(self,default_mode=DEFERRED):
+        self.default_mode = default_mode
+        self._routes = {}
+
+    def route(self,type,name=None,mode=SYNC,fields=(),blocking=True):
+        def decorator(handler):
+            self._routes[(type, name)] = Route(type, name, handler, mode, fields, blocking)
+            return handler
+        return decorator
+
+    #routeで登録したハンドラーの非同期版(async def)を登録する
+    def route_async(self,type,name=None):
+        def decorator(handler):
+            self._routes[(type, name)].async_handler = handler
+            return handler
+        return decorator
+
+    def find(self,interaction):
+        return self._routes.get((interaction["type"], route_key(interaction)))
+
+    #振り分け先とハンドラーに渡すContextを返す 振り分け先がなければ(None, None)を返す
+    def prepare(self,interaction,msg,deadline):
+        route = self.find(interaction)
+        if route is None:
+            log.event('no route', type=interaction["type"], key=route_key(interaction), level=logging.WARNING)
+            return None, None
+        if route.name:
+            timing.tag("command", route.name)
+        mode = DEFERRED if route.mode == DEFERRED and self.default_mode == DEFERRED else SYNC
+        return route, Context(interaction, msg, deadline, mode)
+
+    #ハンドラーが使う列だけを、1回の読み出しでまとめて取ってくる
+    def prefetch(self,route,ctx):
+        if route.fields:
+            from shared_code import user_profile
+            ctx.profile = user_profile.get_profile(ctx.user_id, route.fields)
+
+    #ハンドラーを呼び、その返り値(レスポンスのbody)を返す 振り分け先がなければNoneを返す
+    def dispatch(self,interaction,msg,deadline):
+        route, ctx = self.prepare(interaction, msg, deadline)
+        if route is None:
+            return None
+        self.prefetch(route, ctx)
+        return route.handler(ctx)
+
+    #非同期で動かすときのハンドラーの呼び出し
+    #非同期版があればそれを待ち、なければ同期のハンドラーを(blockingならスレッドで)呼ぶ
+    async def call_async(self,route,ctx):
+        if route.async_handler:
+            return await route.async_handler(ctx)
+        if route.blocking:
+            from shared_code import aio
+            return await aio.to_thread(route.handler, ctx)
+        return route.handler(ctx)
+
+#ハンドラーの返り値(body)をHTTPのレスポンスにする
+def json_response(body):
+    return func.HttpResponse(
+        status_code=200,
+        mimetype="application/json",
+        body = body
+        )
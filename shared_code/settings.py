@@ -0,0 +1,100 @@
+import os
+import base64
+import threading
+
+#アプリ全体で使う設定と鍵
+#同じFunction Appの関数は1つのワーカープロセスを共有するので、環境変数の読み込みと鍵の作成はプロセスで一度だけ行い、
+#verifier(公開鍵)・http_client(セッション)・storage(tableservice)と同じように全ての関数で使い回す
+
+#discordのアプリの公開鍵(interactionの署名の検証に使う)
+DISCORD_PUBLIC_KEY = os.environ.get("DISCORD_PUBLIC_KEY", "")
+#botのtoken(DMの送信に使う)
+DISCORD_BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN", "")
+#notionの認証のstateに入れるuser_idを暗号化するキー
+DISCORD_USER_ID_ENCRYPT_KEY = os.environ.get("DISCORD_USER_ID_ENCRYPT_KEY", "")
+#notionのOAuthのクライアント
+NOTION_CLIENT_ID = os.environ.get("NOTION_CLIENT_ID", "1747a4a7-f6ba-49b0-9258-9a51b8b6e9a5")
+NOTION_CLIENT_SECRET = os.environ.get("NOTION_CLIENT_SECRET", "")
+NOTION_REDIRECT_URI = os.environ.get("NOTION_REDIRECT_URI", "https://notion-action-register.azurewebsites.net/api/notion-registration-redirect")
+#Table Storage 接続文字列があればそれを使う(ローカルのAzuriteなど)
+STORAGE_CONNECTION_STRING = os.environ.get("STORAGE_CONNECTION_STRING")
+STORAGE_ACCOUNT_NAME = os.environ.get("STORAGE_ACCOUNT_NAME")
+STORAGE_ACCOUNT_KEY = os.environ.get("STORAGE_ACCOUNT_KEY")
+
+#NotionTokenテーブルのPartitionKeyの分割数と、分割を変えたときの移行前の読み出し(storage)
+NOTION_TOKEN_PARTITIONS = int(os.environ.get("NOTION_TOKEN_PARTITIONS", "16"))
+NOTION_TOKEN_LEGACY_FALLBACK = os.environ.get("NOTION_TOKEN_LEGACY_FALLBACK", "true").lower() == "true"
+NOTION_TOKEN_PREVIOUS_PARTITIONS = int(os.environ.get("NOTION_TOKEN_PREVIOUS_PARTITIONS", "0"))
+STORAGE_BOOTSTRAP_RETRY_INTERVAL = float(os.environ.get("STORAGE_BOOTSTRAP_RETRY_INTERVAL", "30"))
+
+#関数の動かし方(aio, discord-notion-register, discord-notion-worker)
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", "sync")
+ACT_RESPONSE_MODE = os.environ.get("ACT_RESPONSE_MODE", "deferred")
+INTERACTION_DEADLINE = float(os.environ.get("INTERACTION_DEADLINE", "2.5"))
+WORKER_MAX_ATTEMPTS = int(os.environ.get("WORKER_MAX_ATTEMPTS", "5"))
+#署名のタイムスタンプと現在時刻のずれの許容範囲(verifier)
+DISCORD_TIMESTAMP_SKEW = int(os.environ.get("DISCORD_TIMESTAMP_SKEW", "300"))
+
+#外部APIの呼び出し ローカルでの負荷試験ではスタブのサーバーに向ける(http_client, discord_api)
+NOTION_API_BASE = os.environ.get("NOTION_API_BASE", "https://api.notion.com/v1")
+DISCORD_API_BASE = os.environ.get("DISCORD_API_BASE", "https://discord.com/api/v10")
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "4"))
+#notionへの送信の間隔と再送(notion_scheduler, circuit_breaker)
+NOTION_RATE_PER_SECOND = float(os.environ.get("NOTION_RATE_PER_SECOND", "3"))
+NOTION_RATE_BURST = float(os.environ.get("NOTION_RATE_BURST", "3"))
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", "3"))
+NOTION_BACKOFF_BASE = float(os.environ.get("NOTION_BACKOFF_BASE", "0.5"))
+NOTION_DEFAULT_BUDGET = float(os.environ.get("NOTION_DEFAULT_BUDGET", "30"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+
+#メモリ上のキャッシュ(user_profile, idempotency, notion_search, categories, autocomplete, registration)
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "1024"))
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "300"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "4096"))
+IDEMPOTENCY_CACHE_TTL = int(os.environ.get("IDEMPOTENCY_CACHE_TTL", "900"))
+IDEMPOTENCY_CLAIM_TIMEOUT = float(os.environ.get("IDEMPOTENCY_CLAIM_TIMEOUT", "10"))
+NOTION_SEARCH_CACHE_SIZE = int(os.environ.get("NOTION_SEARCH_CACHE_SIZE", "1024"))
+NOTION_SEARCH_CACHE_TTL = int(os.environ.get("NOTION_SEARCH_CACHE_TTL", "3600"))
+NOTION_SEARCH_MAX_PAGES = int(os.environ.get("NOTION_SEARCH_MAX_PAGES", "10"))
+CATEGORY_CACHE_SIZE = int(os.environ.get("CATEGORY_CACHE_SIZE", "256"))
+CATEGORY_CACHE_TTL = int(os.environ.get("CATEGORY_CACHE_TTL", "3600"))
+CATEGORY_REFRESH_INTERVAL = int(os.environ.get("CATEGORY_REFRESH_INTERVAL", "60"))
+CATEGORY_PARENT_PROPERTY = os.environ.get("CATEGORY_PARENT_PROPERTY", "親カテゴリ")
+AUTOCOMPLETE_INDEX_SIZE = int(os.environ.get("AUTOCOMPLETE_INDEX_SIZE", "500"))
+AUTOCOMPLETE_CACHE_SIZE = int(os.environ.get("AUTOCOMPLETE_CACHE_SIZE", "1024"))
+AUTOCOMPLETE_CACHE_TTL = int(os.environ.get("AUTOCOMPLETE_CACHE_TTL", "86400"))
+AUTOCOMPLETE_SEED_RETRY_INTERVAL = int(os.environ.get("AUTOCOMPLETE_SEED_RETRY_INTERVAL", "60"))
+NOTION_DISCOVERY_CONCURRENCY = int(os.environ.get("NOTION_DISCOVERY_CONCURRENCY", "3"))
+
+#ログと計測(log, timing)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+APPLICATIONINSIGHTS_CONNECTION_STRING = os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING")
+
+_fernet = None
+_lock = threading.Lock()
+
+#user_idの暗号化・復号に使うFernetオブジェクト
+def get_fernet():
+    global _fernet
+    if _fernet is None:
+        with _lock:
+            if _fernet is None:
+                from cryptography.fernet import Fernet
+                _fernet = Fernet(DISCORD_USER_ID_ENCRYPT_KEY)
+    return _fernet
+
+#notionのtoken交換で使うBasic認証のheaderの値
+def notion_basic_auth():
+    return "Basic "+base64.b64encode((NOTION_CLIENT_ID+":"+NOTION_CLIENT_SECRET).encode('utf-8')).decode('utf-8')
+
+#discordのbotとしてAPIを呼ぶときのheader
+def discord_bot_headers():
+    return {
+        "Authorization": "Bot "+DISCORD_BOT_TOKEN,
+        "Content-Type": "application/json"
+    }
@@ -0,0 +1,98 @@
+import time
+import zlib
+import logging
+import threading
+from azure.cosmosdb.table.tableservice import TableService
+from shared_code import settings
+
+TABLE_NAME = "NotionToken"
+
+#NotionTokenテーブルのPartitionKey
+#全ユーザーを1つのパーティション("discord")に入れるとパーティションあたりのスループットの上限にかかるので、
+#user_idのハッシュでPARTITION_COUNT個のパーティションに分ける(user_idだけでPartitionKeyが決まるので、ポイント読み取りのまま引ける)
+#PARTITION_COUNTを変えるとPartitionKeyが変わるので、変えるときは移行スクリプト(scripts/migrate_partitions.py)で移し替える
+PARTITION_COUNT = settings.NOTION_TOKEN_PARTITIONS
+#移行前の行のPartitionKey
+LEGACY_PARTITION_KEY = "discord"
+#移行が終わるまでは、新しいパーティションに行がなければ移行前のパーティションも読む
+LEGACY_FALLBACK = settings.NOTION_TOKEN_LEGACY_FALLBACK
+#PARTITION_COUNTを変えてから移行が終わるまでの、変える前の分割数(0なら変えていない)
+#新しいパーティションに行がなければ、変える前の分割数で求めたパーティションも読む
+PREVIOUS_PARTITION_COUNT = settings.NOTION_TOKEN_PREVIOUS_PARTITIONS
+
+#ワーカープロセスで共有するtableserviceオブジェクト
+#最初に使うときに作成し、テーブルの存在確認は成功するまで行う(成功したあとは行わない)
+_table_service = None
+#存在を確認済みのテーブル
+_ready_tables = set()
+#いま存在を確認しているテーブル(同時に来たリクエストは確認を待たずに進む)
+_checking = set()
+#テーブルの確認に最後に失敗した時刻(time.monotonic())
+_failed_at = {}
+_lock = threading.Lock()
+#テーブルの確認に失敗したあと、もう一度確認するまでの秒数(ストレージの障害中に確認を繰り返さない)
+BOOTSTRAP_RETRY_INTERVAL = settings.STORAGE_BOOTSTRAP_RETRY_INTERVAL
+
+#user_idの行のPartitionKey 例: "discord-07"
+#プロセスやマシンが変わっても同じ値になるよう、hash()ではなくcrc32を使う
+def partition_key(user_id,partition_count=None):
+    count = partition_count or PARTITION_COUNT
+    return LEGACY_PARTITION_KEY+"-"+format(zlib.crc32(str(user_id).encode("utf-8")) % count, "02x")
+
+#user_idの行が新しいパーティションになかったときに読む、移行前のPartitionKeyを読む順に返す
+def fallback_partition_keys(user_id):
+    keys = []
+    if PREVIOUS_PARTITION_COUNT and PREVIOUS_PARTITION_COUNT != PARTITION_COUNT:
+        keys.append(partition_key(user_id, PREVIOUS_PARTITION_COUNT))
+    if LEGACY_FALLBACK:
+        keys.append(LEGACY_PARTITION_KEY)
+    return keys
+
+#Table Storageにアクセスするためのtableserviceオブジェクトを作成する
+def create_table_service():
+    #接続文字列があればそれを使う(ローカルのAzuriteなど)
+    if settings.STORAGE_CONNECTION_STRING:
+        return TableService(connection_string=settings.STORAGE_CONNECTION_STRING)
+    #Azure Table Storageのアカウント名とキー
+    return TableService(account_name=settings.STORAGE_ACCOUNT_NAME, account_key=settings.STORAGE_ACCOUNT_KEY)
+
+#共有のtableserviceオブジェクトを返す
+#NotionTokenテーブルの確認(作成)に失敗していれば、BOOTSTRAP_RETRY_INTERVALごとにやり直す
+def get_table_service():
+    global _table_service
+    if _table_service is None:
+        with _lock:
+            if _table_service is None:
+                #作成するだけで通信はしない
+                _table_service = create_table_service()
+    _ensure_table(_table_service, TABLE_NAME)
+    return _table_service
+
+#テーブルがなければ作成する 結果を覚えておき、プロセス内で2回目以降は何もしない
+def ensure_table(table_name):
+    table_service = get_table_service()
+    _ensure_table(table_service, table_name)
+    return table_service
+
+#テーブルの作成(通信)はロックの外で行い、同じテーブルを同時に確認するのは1つのリクエストだけにする
+#失敗したら時刻を覚え、BOOTSTRAP_RETRY_INTERVALの間は確認しない(テーブルがなければ、その間の読み書きは失敗する)
+def _ensure_table(table_service,table_name):
+    if table_name in _ready_tables:
+        return
+    with _lock:
+        if table_name in _ready_tables or table_name in _checking:
+            return
+        failed_at = _failed_at.get(table_name)
+        if failed_at is not None and time.monotonic() - failed_at < BOOTSTRAP_RETRY_INTERVAL:
+            return
+        _checking.add(table_name)
+    try:
+        table_service.create_table(table_name, fail_on_exist=False)
+        _ready_tables.add(table_name)
+        _failed_at.pop(table_name, None)
+    except Exception as e:
+        _failed_at[table_name] = time.monotonic()
+        logging.error(e)
+    finally:
+        with _lock:
+            _checking.discard(table_name)
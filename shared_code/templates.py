@@ -0,0 +1,54 @@
+import re
+import json
+
+#discordへ返すJSONのテンプレート
+#固定の部分は読み込み時に一度だけシリアライズしておき、リクエストごとには
+#差し込む値(アクション名や時刻など)だけをエスケープしてつなげる
+#
+#  MESSAGE = Template({"content": slot("content")})
+#  MESSAGE.render(content="こんにちは")  # -> b'{"content":"こんにちは"}'
+
+_SLOT = re.compile(r'"<<slot:(\w+)>>"')
+#差し込む値のエスケープ(json.dumpsと同じ出力で、引数の解釈を省く)
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+#テンプレートの中で、あとから値を差し込む場所の印
+#文字列に限らず、リストや辞書などJSONにできる値を差し込める
+def slot(name):
+    return "<<slot:"+name+">>"
+
+#値をJSONにしたbytesにする(固定のレスポンスやテンプレートに入らない部分用)
+def dumps(value):
+    return _encode(value).encode("utf-8")
+
+class Template:
+    def __init__(self,value):
+        text = _encode(value)
+        #[固定の文字列, 差し込む名前, 固定の文字列, 差し込む名前, ..., 固定の文字列]
+        self._parts = _SLOT.split(text)
+        self.names = self._parts[1::2]
+
+    #差し込む値をすべてキーワード引数で渡す
+    def render(self,**values):
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = _encode(values[parts[i]])
+        return "".join(parts).encode("utf-8")
+
+#interaction responseの"data"(シリアライズ済み)を、typeをつけたレスポンスにする
+def response(type,data):
+    return b'{"type":'+str(type).encode("ascii")+b',"data":'+data+b'}'
+
+#固定のレスポンス https://discord.com/developers/docs/interactions/receiving-and-responding#interaction-response-object-interaction-callback-type
+PONG = dumps({"type": 1}) #1: pong
+DEFERRED_CHANNEL_MESSAGE = dumps({"type": 5}) #5: deferred channel message with source
+DEFERRED_UPDATE_MESSAGE = dumps({"type": 6}) #6: deferred update message
+
+#contentだけのメッセージ("data")
+MESSAGE = Template({"content": slot("content")})
+#本人にだけ見えるメッセージ("data")
+EPHEMERAL_MESSAGE = Template({"content": slot("content"), "flags": 64}) #64: ephemeral
+
+#固定の文言のメッセージ("data")を作っておく
+def message(content):
+    return MESSAGE.render(content=content)
@@ -0,0 +1,220 @@
+import time
+import queue
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from shared_code import log
+from shared_code import settings
+
+#関数の呼び出し(interaction)ごとに、処理の段階(stage)ごとの所要時間と外部への呼び出し回数を記録する
+#  @timing.measured("関数名")   : 関数全体を1回分の記録として計測する(mainにつける)
+#  with timing.stage("verify"): : 段階の所要時間を加算する
+#  timing.count_call("host")    : 外部への呼び出し回数を数える
+#記録はsinkに送られ(Application Insightsのカスタムメトリック、テストではMemorySink)、
+#DEBUGログにはServer-Timingヘッダーの形式でまとめを出す
+
+_current = contextvars.ContextVar("timing_recorder", default=None)
+
+class Recorder:
+    def __init__(self,name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.total = None
+        self.stages = {}
+        self.calls = {}
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def add(self,stage_name,seconds):
+        with self._lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def count(self,target):
+        with self._lock:
+            self.calls[target] = self.calls.get(target, 0) + 1
+
+    #Server-Timingヘッダーの形式 (例: verify;dur=1.2, notion;dur=350.0, total;dur=400.3)
+    def server_timing(self):
+        items = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        if self.total is not None:
+            items.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(items)
+
+#テストやベンチマーク用に、記録をメモリに貯めるsink
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self,recorder):
+        self.records.append(recorder)
+
+#Application Insightsにカスタムメトリックとして送るsink
+#azure-monitor-opentelemetryを使う APPLICATIONINSIGHTS_CONNECTION_STRINGがなければ何もしない
+#configure_azure_monitor()は読み込みと初期化が重いので、返信の経路では行わない
+#emitは記録をキューに入れるだけで、初期化と送信はバックグラウンドのスレッドで行う(warmupからstart()で先に始めておく)
+class AppInsightsSink:
+    #送信が追いつかないときにキューに貯める記録の上限(超えた分は捨てる)
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _setup(self):
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        from opentelemetry import metrics
+        configure_azure_monitor()
+        meter = metrics.get_meter("actiluca")
+        return (
+            meter.create_histogram("interaction.stage.duration", unit="ms"),
+            meter.create_counter("interaction.outbound.calls")
+        )
+
+    #バックグラウンドのスレッドを起動する(起動済みなら何もしない)
+    def start(self):
+        if not settings.APPLICATIONINSIGHTS_CONNECTION_STRING:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="appinsights-sink", daemon=True)
+                    self._thread.start()
+
+    def emit(self,recorder):
+        if not settings.APPLICATIONINSIGHTS_CONNECTION_STRING:
+            return
+        self.start()
+        try:
+            self._queue.put_nowait(recorder)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        try:
+            instruments = self._setup()
+        except ImportError:
+            logging.warning('azure-monitor-opentelemetry is not installed')
+            instruments = None
+        except Exception as e:
+            logging.error(e)
+            instruments = None
+        while True:
+            recorder = self._queue.get()
+            if instruments is None:
+                #初期化できなければ、記録は捨てる
+                continue
+            try:
+                self._record(instruments, recorder)
+            except Exception as e:
+                logging.error(e)
+
+    def _record(self,instruments,recorder):
+        durations, calls = instruments
+        attributes = dict(recorder.tags, function=recorder.name)
+        for name, seconds in recorder.stages.items():
+            durations.record(seconds * 1000, dict(attributes, stage=name))
+        durations.record(recorder.total * 1000, dict(attributes, stage="total"))
+        for target, count in recorder.calls.items():
+            calls.add(count, dict(attributes, target=target))
+
+_sink = AppInsightsSink()
+
+#記録の送り先を変える(テストではMemorySinkを渡す)
+def set_sink(sink):
+    global _sink
+    _sink = sink
+
+#sinkの準備(Application Insightsの初期化)を、最初の記録を待たずに始める warmupから呼ぶ
+def start_sink():
+    start = getattr(_sink, "start", None)
+    if start:
+        start()
+
+def current():
+    return _current.get()
+
+@contextmanager
+def stage(stage_name):
+    recorder = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if recorder is not None:
+            recorder.add(stage_name, time.perf_counter() - started)
+
+def count_call(target):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.count(target)
+
+#記録にタグ(コマンド名など)をつける
+def tag(key,value):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.tags[key] = value
+
+#関数を段階として計測するデコレーター callを指定すると、外部への呼び出しとしても数える
+def timed(stage_name,call=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if call:
+                count_call(call)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#スレッドプールで動かす関数にも、呼び出し元の記録を引き継ぐ
+def bind(func):
+    recorder = _current.get()
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current.set(recorder)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+#関数全体を1回分の記録として計測するデコレーター
+#functools.wrapsで引数と型注釈を引き継ぐので、Azure Functionsのバインディングはそのまま動く
+#async defの関数には、async defのラッパーを返す
+def measured(name):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                recorder = Recorder(name)
+                token = _current.set(recorder)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _finish(recorder, token)
+            return async_wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = Recorder(name)
+            token = _current.set(recorder)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _finish(recorder, token)
+        return wrapper
+    return decorator
+
+#記録を締めてsinkに送る
+def _finish(recorder,token):
+    recorder.total = time.perf_counter() - recorder.started
+    _current.reset(token)
+    if log.logger.isEnabledFor(logging.DEBUG):
+        log.logger.debug('Server-Timing : %s %s calls %s', recorder.name, recorder.server_timing(), recorder.calls)
+    try:
+        _sink.emit(recorder)
+    except Exception as e:
+        logging.error(e)
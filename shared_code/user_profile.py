@@ -0,0 +1,95 @@
+import logging
+from azure.common import AzureMissingResourceHttpError
+from shared_code.cache import TTLCache
+from shared_code import storage
+from shared_code import timing
+from shared_code import settings
+
+#NotionTokenテーブルのユーザー情報(プロフィール)をプロセス内にキャッシュする
+#必要な列だけを一度に読み、2回目以降はTable Storageを読まない
+PROFILE_FIELDS = ["notion_access_token", "action_page_id", "category_page_id", "task_page_id"]
+
+_cache = TTLCache(
+    maxsize=settings.PROFILE_CACHE_SIZE,
+    ttl=settings.PROFILE_CACHE_TTL
+)
+
+#user_idのプロフィールを返す 登録されていなければNoneを返す
+#fieldsを渡すとその列だけを読む(キャッシュにない列があるときだけTable Storageを読み、キャッシュに足す)
+def get_profile(user_id,fields=None):
+    fields = fields or PROFILE_FIELDS
+    profile = _cache.get(user_id)
+    if profile is not None and all(field in profile for field in fields):
+        return profile
+    table_service = storage.get_table_service()
+    entity = _get_entity(table_service, storage.partition_key(user_id), user_id, fields)
+    for partition_key in (storage.fallback_partition_keys(user_id) if entity is None else []):
+        #まだ移行していない行(分割数を変える前のパーティションや、分割する前の"discord"パーティション)
+        entity = _get_entity(table_service, partition_key, user_id, fields)
+        if entity is not None:
+            break
+    if entity is None:
+        #未登録のユーザーはキャッシュしない(登録直後に読めるように)
+        return None
+    profile = dict(profile or {})
+    profile.update({field: entity.get(field) for field in fields})
+    _cache.set(user_id, profile)
+    return profile
+
+#行がなければNoneを返す
+def _get_entity(table_service,partition_key,user_id,fields):
+    timing.count_call("table")
+    try:
+        with timing.stage("storage"):
+            return table_service.get_entity(storage.TABLE_NAME, partition_key, user_id, select=",".join(fields))
+    except AzureMissingResourceHttpError:
+        return None
+
+#settokenやset_notion_infoで書き込んだときに呼び、古いプロフィールを捨てる
+def invalidate(user_id):
+    logging.info('profile cache invalidated : '+user_id)
+    _cache.invalidate(user_id)
+
+#tokenをDBに登録する関数
+#/settokenを受け付けるどの関数からもこれを使う 成功したらTrueを返す
+@timing.timed("storage", call="table")
+def settoken(user_name,user_id,token):
+    from azure.cosmosdb.table.models import Entity
+    try:
+        #共有のtableserviceオブジェクトを使う(テーブルの存在確認は一度だけ行われる)
+        table_service = storage.get_table_service()
+        #エンティティを作成
+        entity = Entity()
+        entity.PartitionKey = storage.partition_key(user_id)
+        entity.RowKey = user_id
+        entity.token = token
+        entity.user_name = user_name
+        #エンティティを登録または置換
+        table_service.insert_or_replace_entity(storage.TABLE_NAME, entity)
+        #キャッシュされているプロフィールを捨てる
+        invalidate(user_id)
+        return True
+    except Exception as e:
+        logging.error(e)
+        return False
+
+#IDからtokenを取得する
+def gettoken(user_id):
+    profile = get_profile(user_id,["notion_access_token"])
+    #なければNoneを返す
+    if not profile:
+        return None
+    #tokenを返す
+    return profile["notion_access_token"]
+
+#IDから各種notion databaseのIDを取得する
+def get_database_id(user_id):
+    profile = get_profile(user_id,["task_page_id", "action_page_id", "category_page_id"])
+    #なければNoneを返す
+    if not profile:
+        return None
+    return {
+        "task_page_id": profile["task_page_id"],
+        "action_page_id": profile["action_page_id"],
+        "category_page_id": profile["category_page_id"]
+    }
@@ -0,0 +1,66 @@
+import re
+import json
+import time
+import logging
+import azure.functions as func
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from cryptography.exceptions import InvalidSignature
+from shared_code import timing
+from shared_code import log
+from shared_code import settings
+
+#署名のタイムスタンプと現在時刻のずれの許容範囲(秒) 0なら確認しない
+TIMESTAMP_SKEW = settings.DISCORD_TIMESTAMP_SKEW
+
+#Ed25519の署名は64バイトなので、hexで128文字
+_SIGNATURE_PATTERN = re.compile(r"[0-9a-fA-F]{128}")
+_TIMESTAMP_PATTERN = re.compile(r"[0-9]{1,12}")
+
+#ワーカープロセスで一度だけ作る公開鍵
+_public_key = None
+
+def get_public_key():
+    global _public_key
+    if _public_key is None:
+        public_key_bytes = bytes.fromhex(settings.DISCORD_PUBLIC_KEY)
+        _public_key = Ed25519PublicKey.from_public_bytes(public_key_bytes)
+    return _public_key
+
+#暗号処理やbodyのデコードの前に、headerの形式だけで明らかに不正なリクエストを弾く
+def precheck(signature,timestamp):
+    if not signature or not timestamp:
+        return False
+    if not _SIGNATURE_PATTERN.fullmatch(signature) or not _TIMESTAMP_PATTERN.fullmatch(timestamp):
+        return False
+    if TIMESTAMP_SKEW and abs(time.time() - int(timestamp)) > TIMESTAMP_SKEW:
+        return False
+    return True
+
+#discordからのリクエストを検証する関数
+#raw_bodyはデコード前のbytes
+@timing.timed("verify")
+def verify(signature,timestamp,raw_body):
+    if not precheck(signature,timestamp):
+        return False
+    try:
+        # Verify the signature
+        get_public_key().verify(bytes.fromhex(signature), timestamp.encode('utf-8') + raw_body)
+        return True
+    except InvalidSignature:
+        return False
+
+#証明書を検証し、discordからのリクエストであることを確認してからinteractionを読む
+#(interaction, None)か、検証に失敗したときは(None, 401のレスポンス)を返す
+def read_interaction(req):
+    #discordからのリクエストでない場合は、401を返す
+    #headerからx-signature-ed25519とx-signature-timestampを取得する
+    #headerの形式やタイムスタンプが不正な場合は、暗号処理やbodyのデコードをせずに401を返す
+    signature = req.headers.get('x-signature-ed25519')
+    timestamp = req.headers.get('x-signature-timestamp')
+    if not verify(signature, timestamp, req.get_body()):
+        return None, func.HttpResponse("Unauthorized", status_code=401)
+    logging.info('signature verified')
+    with timing.stage("parse"):
+        interaction = json.loads(req.get_body().decode('utf-8'))
+    log.payload('interaction', interaction)
+    return interaction, None
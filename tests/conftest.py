@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+
+#関数アプリのルート(shared_codeの親)から読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_code import timing
+
+#記録はApplication Insightsではなくメモリに貯める
+@pytest.fixture(autouse=True)
+def memory_sink():
+    sink = timing.MemorySink()
+    timing.set_sink(sink)
+    yield sink
+    timing.set_sink(timing.AppInsightsSink())
+
+#time.monotonic()の代わりに、進める秒数を指定できる時計
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self,seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,81 @@
+import pytest
+from shared_code import circuit_breaker
+from shared_code.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+@pytest.fixture
+def breaker(monkeypatch,clock):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return CircuitBreaker("api.notion.com", threshold=3, reset_timeout=30)
+
+def test_opens_after_threshold_failures(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+def test_success_resets_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+def test_half_open_lets_one_trial_through(breaker,clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    #試しの結果が出るまでは、他のリクエストは通さない
+    assert not breaker.allow()
+
+def test_trial_success_closes(breaker,clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+def test_trial_failure_reopens(breaker,clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    clock.advance(30)
+    assert breaker.allow()
+
+def test_unrecorded_trial_is_retried_after_timeout(breaker,clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+def test_release_trial_allows_next_trial_immediately(breaker,clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.release_trial()
+    assert breaker.allow()
+    assert not breaker.allow()
+
+def test_release_trial_does_nothing_when_closed(breaker):
+    breaker.release_trial()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
@@ -0,0 +1,130 @@
+import time
+import itertools
+import pytest
+from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError
+from azure.cosmosdb.table.models import Entity
+from shared_code import storage
+from shared_code import timing
+from shared_code import idempotency
+from shared_code.cache import TTLCache
+
+_etags = itertools.count()
+
+#Interactionsテーブルの代わり 挿入の重複とetagの不一致だけを再現する
+class FakeTable:
+    def __init__(self):
+        self.rows = {}
+
+    def _store(self,entity):
+        row = Entity(entity)
+        row.etag = "etag-"+str(next(_etags))
+        self.rows[(entity.PartitionKey, entity.RowKey)] = row
+
+    def insert_entity(self,table_name,entity):
+        if (entity.PartitionKey, entity.RowKey) in self.rows:
+            raise AzureConflictHttpError("conflict", 409)
+        self._store(entity)
+
+    def get_entity(self,table_name,partition_key,row_key):
+        try:
+            return self.rows[(partition_key, row_key)]
+        except KeyError:
+            raise AzureMissingResourceHttpError("not found", 404)
+
+    def update_entity(self,table_name,entity,if_match="*"):
+        current = self.rows.get((entity.PartitionKey, entity.RowKey))
+        if current is None or (if_match != "*" and current.etag != if_match):
+            raise AzureConflictHttpError("precondition failed", 412)
+        self._store(entity)
+
+    def delete_entity(self,table_name,partition_key,row_key):
+        if self.rows.pop((partition_key, row_key), None) is None:
+            raise AzureMissingResourceHttpError("not found", 404)
+
+    #他のインスタンスが書いた行
+    def put(self,interaction_id,response,claimed_at):
+        entity = idempotency._entity(interaction_id, response)
+        entity.claimed_at = claimed_at
+        self._store(entity)
+
+    def row(self,interaction_id):
+        return self.rows.get((idempotency.partition_key(interaction_id), interaction_id))
+
+INTERACTION_ID = "1296800000000000000"
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeTable()
+    monkeypatch.setattr(storage, "ensure_table", lambda table_name: table)
+    #プロセス内のキャッシュはテストごとに空にする
+    monkeypatch.setattr(idempotency, "_seen", TTLCache(maxsize=16, ttl=idempotency.TTL))
+    return table
+
+@timing.measured("test")
+def claim(interaction_id):
+    return idempotency.claim(interaction_id)
+
+def test_partition_key_is_ten_minute_bucket():
+    created = ((int(INTERACTION_ID) >> 22) + idempotency.DISCORD_EPOCH) / 1000
+    key = idempotency.partition_key(INTERACTION_ID)
+    assert key == time.strftime("%Y%m%d%H%M", time.gmtime(created - created % 600))
+    assert key.endswith("0")
+
+def test_first_claim_wins(table):
+    assert claim(INTERACTION_ID) == (True, None)
+    assert table.row(INTERACTION_ID)["response"] == ""
+
+def test_second_claim_uses_process_cache(table,memory_sink):
+    claim(INTERACTION_ID)
+    assert claim(INTERACTION_ID) == (False, None)
+    #2回目はTable Storageを読まない
+    assert memory_sink.records[0].calls == {"table": 1}
+    assert memory_sink.records[1].calls == {}
+
+def test_claim_held_by_other_instance(table):
+    table.put(INTERACTION_ID, "", time.time())
+    assert claim(INTERACTION_ID) == (False, None)
+    #他のインスタンスの処理中の印はキャッシュせず、次の再送ではレスポンスを読みに行く
+    assert idempotency._seen.get(INTERACTION_ID) is None
+    table.put(INTERACTION_ID, '{"type":4}', time.time())
+    assert claim(INTERACTION_ID) == (False, '{"type":4}')
+
+def test_stale_claim_is_taken_over(table):
+    table.put(INTERACTION_ID, "", time.time() - idempotency.CLAIM_TIMEOUT - 1)
+    before = table.row(INTERACTION_ID).etag
+    assert claim(INTERACTION_ID) == (True, None)
+    assert table.row(INTERACTION_ID).etag != before
+    assert idempotency._seen.get(INTERACTION_ID) == ""
+
+def test_takeover_lost_to_other_instance(table,monkeypatch):
+    table.put(INTERACTION_ID, "", time.time() - idempotency.CLAIM_TIMEOUT - 1)
+    get_entity = table.get_entity
+    #読んだあとに、他のインスタンスが先に引き継いだ
+    def get_then_take_over(table_name,partition_key,row_key):
+        entity = get_entity(table_name, partition_key, row_key)
+        table.put(INTERACTION_ID, "", time.time())
+        return entity
+    monkeypatch.setattr(table, "get_entity", get_then_take_over)
+    assert claim(INTERACTION_ID) == (False, None)
+    assert idempotency._seen.get(INTERACTION_ID) is None
+
+def test_claim_released_between_insert_and_read(table,monkeypatch):
+    table.put(INTERACTION_ID, "", time.time())
+    get_entity = table.get_entity
+    def release_then_get(table_name,partition_key,row_key):
+        table.delete_entity(table_name, partition_key, row_key)
+        return get_entity(table_name, partition_key, row_key)
+    monkeypatch.setattr(table, "get_entity", release_then_get)
+    assert claim(INTERACTION_ID) == (True, None)
+
+def test_release_lets_redelivery_claim_again(table):
+    claim(INTERACTION_ID)
+    idempotency.release(INTERACTION_ID)
+    assert table.row(INTERACTION_ID) is None
+    assert claim(INTERACTION_ID) == (True, None)
+
+def test_storage_failure_does_not_block(table,monkeypatch):
+    def fail(table_name,entity):
+        raise RuntimeError("storage down")
+    monkeypatch.setattr(table, "insert_entity", fail)
+    assert claim(INTERACTION_ID) == (True, None)
@@ -0,0 +1,110 @@
+import itertools
+import pytest
+import requests
+from shared_code import http_client
+from shared_code import circuit_breaker
+from shared_code import notion_scheduler
+from shared_code.notion_scheduler import NotionUnavailable
+
+_tokens = itertools.count()
+
+class FakeResponse:
+    def __init__(self,status_code,headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+#http_client.notion_requestの代わりに、決めておいた応答(または例外)を順に返す
+class FakeNotion:
+    def __init__(self,*outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __call__(self,method,path,token,deadline=None,**kwargs):
+        self.calls.append((method, path))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(notion_scheduler, "BACKOFF_BASE", 0.0)
+
+def send(monkeypatch,method,path,*outcomes):
+    notion = FakeNotion(*outcomes)
+    monkeypatch.setattr(http_client, "notion_request", notion)
+    #tokenごとの送信枠を共有しないよう、毎回別のtokenで送る
+    token = "token-"+str(next(_tokens))
+    try:
+        return notion, notion_scheduler.request(method, path, token)
+    except NotionUnavailable as e:
+        return notion, e
+
+def test_idempotent():
+    assert notion_scheduler.idempotent("GET", "/pages/abc")
+    assert notion_scheduler.idempotent("PATCH", "/pages/abc")
+    assert notion_scheduler.idempotent("POST", "/search")
+    assert notion_scheduler.idempotent("POST", "/databases/abc/query")
+    assert not notion_scheduler.idempotent("POST", "/pages")
+
+def test_get_retries_on_5xx(monkeypatch):
+    notion, result = send(monkeypatch, "GET", "/pages/abc", 500, 502, 200)
+    assert result.status_code == 200
+    assert len(notion.calls) == 3
+
+def test_gives_up_after_max_retries(monkeypatch):
+    outcomes = [503] * (notion_scheduler.MAX_RETRIES + 1)
+    notion, result = send(monkeypatch, "GET", "/pages/abc", *outcomes)
+    assert isinstance(result, NotionUnavailable)
+    assert result.sent
+    assert len(notion.calls) == notion_scheduler.MAX_RETRIES + 1
+
+def test_query_post_retries_on_5xx(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/databases/abc/query", 502, 200)
+    assert result.status_code == 200
+    assert len(notion.calls) == 2
+
+def test_create_page_is_not_resent_after_5xx(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/pages", 500, 200)
+    assert isinstance(result, NotionUnavailable)
+    assert result.sent
+    assert len(notion.calls) == 1
+
+def test_create_page_is_resent_after_429(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/pages", 429, 200)
+    assert result.status_code == 200
+    assert len(notion.calls) == 2
+
+def test_create_page_is_resent_after_connect_failure(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/pages", http_client.ConnectFailed("refused"), 200)
+    assert result.status_code == 200
+    assert len(notion.calls) == 2
+
+def test_create_page_is_not_resent_after_read_timeout(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/pages", requests.exceptions.ReadTimeout("timeout"), 200)
+    assert isinstance(result, NotionUnavailable)
+    assert result.sent
+    assert len(notion.calls) == 1
+
+def test_get_is_resent_after_read_timeout(monkeypatch):
+    notion, result = send(monkeypatch, "GET", "/pages/abc", requests.exceptions.ReadTimeout("timeout"), 200)
+    assert result.status_code == 200
+    assert len(notion.calls) == 2
+
+def test_circuit_open_gives_up_without_retry(monkeypatch):
+    notion, result = send(monkeypatch, "POST", "/pages", circuit_breaker.CircuitOpen("api.notion.com"), 200)
+    assert isinstance(result, NotionUnavailable)
+    assert not result.sent
+    assert len(notion.calls) == 1
+
+def test_gives_up_when_rate_limit_wait_passes_deadline(monkeypatch):
+    notion = FakeNotion(200)
+    monkeypatch.setattr(http_client, "notion_request", notion)
+    token = "token-"+str(next(_tokens))
+    #送信枠を使い切っておく
+    bucket = notion_scheduler._bucket(token)
+    bucket.tokens = -10
+    with pytest.raises(NotionUnavailable) as e:
+        notion_scheduler.request("GET", "/pages/abc", token, deadline=notion_scheduler.time.monotonic() + 0.1)
+    assert not e.value.sent
+    assert notion.calls == []
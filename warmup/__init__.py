@@ -0,0 +1,49 @@
+import logging
+import importlib
+import azure.functions as func
+from shared_code import timing
+
+#各HTTPトリガーが遅延して読み込むモジュール
+#ワーカーのsys.modulesに載せておけば、最初のリクエストで読み込みを待たなくてよい
+WARM_MODULES = [
+    "cryptography.fernet",
+    "azure.cosmosdb.table.models",
+    "shared_code.action",
+    "shared_code.active_actions",
+    "shared_code.autocomplete",
+    "shared_code.categories",
+    "shared_code.idempotency",
+    "shared_code.registration",
+    "shared_code.report",
+]
+
+#インスタンスの起動時(runOnStartup)と5分ごとに動き、共有のオブジェクトを作っておく
+#スケールアウトした新しいインスタンスも、最初のinteractionから温まった状態で処理できる
+@timing.measured("warmup")
+def main(timer: func.TimerRequest) -> None:
+    for module_name in WARM_MODULES:
+        with timing.stage("import"):
+            importlib.import_module(module_name)
+    from shared_code import settings
+    from shared_code import verifier
+    from shared_code import http_client
+    from shared_code import storage
+    from shared_code import discord_api
+    #Application Insightsの初期化(バックグラウンドのスレッドで行う)
+    timing.start_sink()
+    #公開鍵
+    with timing.stage("verifier"):
+        verifier.get_public_key()
+    #notionの認証のstateを暗号化・復号するFernetオブジェクト
+    with timing.stage("settings"):
+        settings.get_fernet()
+    #HTTPのセッションと、notion・discordへのTLS接続
+    for url in [http_client.NOTION_API_BASE, discord_api.DISCORD_API_BASE]:
+        try:
+            http_client.request("HEAD", url, timeout=(http_client.CONNECT_TIMEOUT, http_client.CONNECT_TIMEOUT))
+        except Exception as e:
+            logging.warning(e)
+    #tableserviceオブジェクトとテーブルの存在確認
+    with timing.stage("storage"):
+        storage.get_table_service()
+    logging.info('warmup done')